@@ -1,16 +1,24 @@
 
 
-import json
 import time
+import asyncio
+import hashlib
 import aiohttp
 import aioredis
 
-from quart import Quart, render_template, request, g
+from quart import Quart, Response, g, has_request_context, render_template, request
 from quart_cors import cors
 from docopt import docopt
 from wdreconcile.engine import ReconcileEngine
+from wdreconcile.itemstore import ItemStore
 from wdreconcile.suggest import SuggestEngine
+from wdreconcile.propertyindex import PropertyIndex
 from wdreconcile.monitoring import Monitoring
+from wdreconcile.jobs import JobQueue
+from wdreconcile.cache import LRUCache
+from wdreconcile.codec import fast_json
+from wdreconcile import compression
+from wdreconcile import metrics, upstream
 
 from config import *
 try:
@@ -19,6 +27,33 @@ try:
 except ImportError:
     wikibase_name = 'Wikidata'
     wikibase_main_page = 'https://www.wikidata.org/wiki/Wikidata:Main_Page'
+try:
+    from config import stream_chunk_size, stream_max_chunks
+except ImportError:
+    stream_chunk_size = 50
+    stream_max_chunks = 4
+try:
+    from config import server_workers, server_keep_alive_timeout, server_graceful_timeout, server_access_log
+except ImportError:
+    server_workers = 4
+    server_keep_alive_timeout = 5
+    server_graceful_timeout = 10
+    server_access_log = False
+try:
+    from config import job_workers, job_chunk_size, job_lease_time, job_ttl
+except ImportError:
+    job_workers = 1
+    job_chunk_size = 100
+    job_lease_time = 5*60
+    job_ttl = 7*24*60*60
+try:
+    from config import http_cache_max_age
+except ImportError:
+    http_cache_max_age = 5*60
+try:
+    from config import http_compression_min_size
+except ImportError:
+    http_compression_min_size = 1024
 
 app = Quart(__name__, static_url_path='/static/', static_folder='static/')
 app = cors(app, allow_origin='*')
@@ -26,23 +61,100 @@ app = cors(app, allow_origin='*')
 @app.before_serving
 async def setup():
     app.redis_client = aioredis.from_url(redis_uri, encoding='utf-8', decode_responses=True)
-    app.http_connector = aiohttp.TCPConnector(limit_per_host=10)
+    app.http_connector = aiohttp.TCPConnector(limit_per_host=upstream.upstream_max_concurrency)
     app.http_session_obj = aiohttp.ClientSession(connector=app.http_connector)
     app.http_session = await app.http_session_obj.__aenter__()
 
-@app.before_request
-async def request_context():
-    g.reconcile = ReconcileEngine(app.redis_client, app.http_session)
-    g.suggest = SuggestEngine(app.redis_client, app.http_session)
-    g.monitoring = Monitoring(app.redis_client)
+    # The engines (and the in-process caches they hold) are built once
+    # and shared by all requests served by this process
+    app.binary_redis_client = aioredis.from_url(redis_uri)
+    app.item_store = ItemStore(app.redis_client, app.http_session,
+            binary_redis_client=app.binary_redis_client)
+    app.property_index = PropertyIndex(app.http_session)
+    app.reconcile = ReconcileEngine(app.redis_client, app.http_session,
+            item_store=app.item_store, property_index=app.property_index)
+    app.suggest = SuggestEngine(app.redis_client, app.http_session,
+            item_store=app.item_store, property_index=app.property_index)
+    # start loading the properties in the default language
+    app.property_index.get('en')
+    # service manifests, by language (they only change with the label of the default type)
+    app.manifests = LRUCache(max_entries=1000, ttl=app.item_store.ttl)
+    app.manifest_task = asyncio.ensure_future(precompute_manifest('en'))
+    app.monitoring = Monitoring(app.redis_client)
+    app.jobs = JobQueue(app.redis_client, app.reconcile,
+            chunk_size=job_chunk_size, lease_time=job_lease_time, ttl=job_ttl)
+    app.job_workers = [
+        asyncio.ensure_future(app.jobs.run_worker())
+        for _ in range(job_workers)
+    ]
 
 @app.after_serving
 async def teardown():
+    for worker in app.job_workers:
+        worker.cancel()
+    await asyncio.gather(*app.job_workers, return_exceptions=True)
     await app.http_session.__aexit__(None, None, None)
-    app.redis_client.close()
-    await app.redis_client.wait_closed()
+    await app.redis_client.close()
+    await app.binary_redis_client.close()
+
+@app.before_request
+async def start_request_timer():
+    g.route = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.start_time = time.perf_counter()
+    metrics.http_requests_in_progress.inc(route=g.route)
+
+@app.teardown_request
+async def stop_request_timer(exc):
+    if 'start_time' in g:
+        metrics.http_requests_in_progress.dec(route=g.route)
+        metrics.http_request_duration.observe(time.perf_counter() - g.start_time, route=g.route)
+
+@app.after_request
+async def compress_response(response):
+    """
+    Compresses the responses larger than http_compression_min_size
+    with the best content encoding accepted by the client.
+    """
+    if (http_compression_min_size is None or request.method == 'HEAD' or
+            response.status_code in (204, 304) or 'Content-Encoding' in response.headers or
+            not isinstance(response.response, Response.data_body_class)):
+        # streamed responses are not compressed, so that results are not held back
+        return response
+    data = await response.get_data(as_text=False)
+    if len(data) < http_compression_min_size:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(compression.encodings)
+    if encoding is None:
+        return response
+    loop = asyncio.get_event_loop()
+    response.set_data(await loop.run_in_executor(None, compression.compress, data, encoding))
+    response.content_encoding = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # the compressed representation differs from the original one
+        response.set_etag(etag, weak=True)
+    return response
+
+def jsonp(view=None, max_age=None, version=None):
+    """
+    Turns a view taking the arguments of the request (from
+    the query string or the form) into an endpoint, returning
+    JSONP if a callback is given.
+
+    :param max_age: if set, successful GET requests can be cached
+        for this time (in seconds) by clients and proxies (views
+        can also set it for the current request, as g.cache_max_age)
+    :param version: a coroutine function taking the same arguments as the
+        view, returning the version of the data it renders (such as the
+        revisions of the items). If set, the ETag of cached responses is
+        derived from it, so that requests with a matching If-None-Match
+        get a 304 response without rendering the view. Otherwise, the
+        ETag is a hash of the rendered response.
+    """
+    if view is None:
+        return lambda view: jsonp(view, max_age, version)
 
-def jsonp(view):
     async def wrapped(*posargs, **kwargs):
         args = {}
         # if we access the args via get(),
@@ -54,8 +166,18 @@ def jsonp(view):
             args[k] = request.args.get(k)
         callback = args.get('callback')
         status_code = 200
+        etag = None
+        if version and max_age and request.method == 'GET':
+            try:
+                etag = hashlib.sha1('{} {}'.format(request.full_path,
+                    await version(args, *posargs, **kwargs)).encode('utf-8')).hexdigest()
+            except Exception:
+                pass # the view reports the error
+            if etag and request.if_none_match.contains_weak(etag):
+                return await cacheable_response('', max_age, etag)
         try:
-            result = await view(args, *posargs, **kwargs)
+            with upstream.request_owner():
+                result = await view(args, *posargs, **kwargs)
         except (Exception) as e:#ValueError, AttributeError, KeyError) as e:
             import traceback, sys
             traceback.print_exc(file=sys.stdout)
@@ -64,9 +186,14 @@ def jsonp(view):
                     'details': str(e)}
             status_code = 403
         if callback:
-            result = '%s(%s);' % (callback, json.dumps(result))
+            result = '%s(%s);' % (callback, fast_json.dumps(result))
 
         if status_code == 200:
+            if isinstance(result, (dict, list)):
+                result = Response(fast_json.dumps(result), mimetype='application/json')
+            cache_max_age = g.get('cache_max_age', max_age)
+            if cache_max_age and request.method == 'GET':
+                return await cacheable_response(result, cache_max_age, etag)
             return result
         else:
             result['arguments'] = args
@@ -74,6 +201,33 @@ def jsonp(view):
 
     return wrapped
 
+async def cacheable_response(result, max_age, etag=None):
+    """
+    Makes a response which can be cached for max_age seconds, with
+    an ETag (by default, hash of its contents): clients and proxies which
+    already have the same contents get an empty response (304 Not Modified)
+    instead.
+    """
+    response = await app.make_response(result)
+    if etag:
+        response.set_etag(etag)
+    else:
+        await response.add_etag()
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    etag, _ = response.get_etag()
+    if request.if_none_match.contains_weak(etag):
+        response.status_code = 304
+        response.set_data(b'')
+    return response
+
+async def entities_version(args, lang=None):
+    """
+    The version of the previews and flyouts of some entities:
+    they are only rendered again when the entities are edited
+    """
+    return await app.suggest.revisions(args)
+
 @app.route('/api', endpoint='api-default-lang', methods=['GET','POST'])
 @jsonp
 async def api_default_lang(args):
@@ -96,34 +250,47 @@ async def api(args):
 
     if query:
         try:
-       	    query = json.loads(query)
+       	    query = fast_json.loads(query)
         except ValueError:
             query = {'query':query}
-        result = await g.reconcile.process_single_query(query,
+        metrics.queries_per_batch.observe(1)
+        result = await app.reconcile.process_single_query(query,
                 default_language=lang)
         processing_time = time.time() - start_time
-        await g.monitoring.log_request(1, processing_time)
+        await app.monitoring.log_request(1, processing_time)
         return result
 
     elif queries:
-        queries = json.loads(queries)
-        res = await g.reconcile.process_queries(queries,
-                default_language=lang)
+        queries = fast_json.loads(queries)
+        metrics.queries_per_batch.observe(len(queries))
+        timing = metrics.Timing()
+        res = await app.reconcile.process_queries(queries,
+                default_language=lang, timing=timing)
         processing_time = time.time() - start_time
-        await g.monitoring.log_request(len(queries), processing_time)
+        await app.monitoring.log_request(len(queries), processing_time)
+        if args.get('timing') in ['1', 'true']:
+            # time spent in each stage of the batch, for debugging
+            res['timing'] = timing.as_dict()
         return res
 
     elif extend:
-        args['extend'] = json.loads(extend)
-        return await g.reconcile.fetch_properties_by_batch(args)
+        args['extend'] = fast_json.loads(extend)
+        return await app.reconcile.fetch_properties_by_batch(args)
 
     else:
+        # unlike the results of queries, the manifest can be cached by clients
+        if has_request_context():
+            g.cache_max_age = http_cache_max_age
+        # the manifest is computed once for each language
+        identify = app.manifests.get(lang)
+        if identify is not None:
+            return identify
         default_types = []
         if default_type_entity:
             default_types = [
                 {
                     'id': default_type_entity,
-                    'name': await g.reconcile.item_store.get_label(default_type_entity, lang)
+                    'name': await app.reconcile.item_store.get_label(default_type_entity, lang)
                 }
             ]
         identify = {
@@ -217,105 +384,226 @@ async def api(args):
                 ]
             },
         }
+        app.manifests.set(lang, identify)
         return identify
 
+async def precompute_manifest(lang):
+    try:
+        await api({'lang': lang})
+    except Exception:
+        # it will be computed again on the first request
+        import traceback, sys
+        traceback.print_exc(file=sys.stdout)
+
+
+@app.route('/api/stream', endpoint='api-stream-default-lang', methods=['POST'])
+async def api_stream_default_lang():
+    return await api_stream(fix_lang(request.args.get('lang')))
+
+@app.route('/<lang>/api/stream', endpoint='api-stream', methods=['POST'])
+async def api_stream_custom_lang(lang):
+    return await api_stream(fix_lang(lang))
+
+async def api_stream(lang):
+    """
+    Reconciles queries supplied as newline-delimited JSON in the
+    request body (one query per line, with an optional "id" field).
+    The result of each query is streamed back as one line of JSON,
+    as soon as it is available, in no particular order.
+
+    The body is read as it is received, so queries are processed
+    before the whole batch is uploaded.
+    """
+    body = request.body
+
+    async def parse_queries():
+        line_number = -1
+        async for line in read_lines(body):
+            line_number += 1
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                query = fast_json.loads(line)
+            except ValueError:
+                query = None
+            if not isinstance(query, dict):
+                query = {'query':line}
+            query_id = query.pop('id', str(line_number))
+            yield query_id, query
+
+    async def results():
+        start_time = time.time()
+        nb_queries = 0
+        with upstream.request_owner():
+            async for query_id, result in app.reconcile.stream_queries(
+                    parse_queries(), default_language=lang,
+                    chunk_size=stream_chunk_size, max_chunks=stream_max_chunks):
+                nb_queries += 1
+                result['id'] = query_id
+                yield (fast_json.dumps(result) + '\n').encode('utf-8')
+        metrics.queries_per_batch.observe(nb_queries)
+        await app.monitoring.log_request(nb_queries, time.time() - start_time)
+
+    response = Response(results(), mimetype='application/x-ndjson')
+    response.timeout = None # large batches can take longer than the default timeout
+    return response
+
+async def read_lines(body):
+    """
+    Splits a request body into lines of text, as its chunks are received.
+    """
+    remainder = b''
+    async for chunk in body:
+        *lines, remainder = (remainder + chunk).split(b'\n')
+        for line in lines:
+            yield line.decode('utf-8')
+    if remainder:
+        yield remainder.decode('utf-8')
+
+@app.route('/jobs', endpoint='submit-job-default-lang', methods=['POST'])
+@jsonp
+async def submit_job_default_lang(args):
+    return await submit_job(args, fix_lang(args.get('lang')))
 
-@app.route('/suggest/type', endpoint='suggest-type-default-lang', methods=['GET','POST'])
+@app.route('/<lang>/jobs', endpoint='submit-job', methods=['POST'])
 @jsonp
+async def submit_job_custom_lang(args, lang):
+    return await submit_job(args, fix_lang(lang))
+
+async def submit_job(args, lang):
+    """
+    Submits a batch of queries (in the `queries` field, as for the
+    reconciliation endpoint) to be processed in the background.
+    """
+    queries = args.get('queries')
+    if not queries:
+        raise ValueError('No queries provided')
+    return await app.jobs.submit(fast_json.loads(queries), lang)
+
+@app.route('/jobs/<job_id>', endpoint='job-status', methods=['GET','POST'])
+@jsonp
+async def job_status(args, job_id):
+    return await app.jobs.status(job_id)
+
+@app.route('/jobs/<job_id>/results', endpoint='job-results', methods=['GET','POST'])
+@jsonp
+async def job_results(args, job_id):
+    """
+    Returns the available results, starting from the chunk given by
+    `start` (use the `next_chunk` of the previous response to
+    retrieve results incrementally).
+    """
+    return await app.jobs.results(job_id, int(args.get('start') or 0))
+
+@app.route('/suggest/type', endpoint='suggest-type-default-lang', methods=['GET','POST'])
+@jsonp(max_age=http_cache_max_age)
 async def suggest_property(args):
     args['lang'] = fix_lang(args.get('lang'))
-    return await g.suggest.find_type(args)
+    return await app.suggest.find_type(args)
 
 @app.route('/suggest/property', endpoint='suggest-property-default-lang', methods=['GET','POST'])
-@jsonp
+@jsonp(max_age=http_cache_max_age)
 async def suggest_property(args):
     args['lang'] = fix_lang(args.get('lang'))
-    return await g.suggest.find_property(args)
+    return await app.suggest.find_property(args)
 
 @app.route('/suggest/entity', endpoint='suggest-entity-default-lang', methods=['GET','POST'])
-@jsonp
+@jsonp(max_age=http_cache_max_age)
 async def suggest_property(args):
     args['lang'] = fix_lang(args.get('lang'))
-    return await g.suggest.find_entity(args)
+    return await app.suggest.find_entity(args)
 
 @app.route('/preview', endpoint='preview-default-lang', methods=['GET','POST'])
-@jsonp
+@jsonp(max_age=http_cache_max_age, version=entities_version)
 async def preview(args):
     args['lang'] = fix_lang(args.get('lang'))
-    return await g.suggest.preview(args)
+    return await app.suggest.preview(args)
 
 @app.route('/<lang>/suggest/type', endpoint='suggest-type', methods=['GET','POST'])
-@jsonp
+@jsonp(max_age=http_cache_max_age)
 async def suggest_type(args, lang):
     args['lang'] = fix_lang(lang)
-    return await g.suggest.find_type(args)
+    return await app.suggest.find_type(args)
 
 @app.route('/<lang>/suggest/property', endpoint='suggest-property', methods=['GET','POST'])
-@jsonp
+@jsonp(max_age=http_cache_max_age)
 async def suggest_property(args, lang):
     args['lang'] = fix_lang(lang)
-    return await g.suggest.find_property(args)
+    return await app.suggest.find_property(args)
 
 @app.route('/<lang>/suggest/entity', endpoint='suggest-entity', methods=['GET','POST'])
-@jsonp
+@jsonp(max_age=http_cache_max_age)
 async def suggest_entity(args, lang):
     args['lang'] = fix_lang(lang)
-    return await g.suggest.find_entity(args)
+    return await app.suggest.find_entity(args)
 
 @app.route('/<lang>/flyout/type', endpoint='flyout-type', methods=['GET','POST'])
-@jsonp
+@jsonp(max_age=http_cache_max_age, version=entities_version)
 async def flyout_type(args, lang):
     args['lang'] = fix_lang(lang)
-    return await g.suggest.flyout_type(args)
+    return await app.suggest.flyout_type(args)
 
 @app.route('/<lang>/flyout/property', endpoint='flyout-property', methods=['GET','POST'])
-@jsonp
+@jsonp(max_age=http_cache_max_age, version=entities_version)
 async def flyout_property(args, lang):
     args['lang'] = fix_lang(lang)
-    return await g.suggest.flyout_property(args)
+    return await app.suggest.flyout_property(args)
 
 @app.route('/<lang>/flyout/entity', endpoint='flyout-entity', methods=['GET','POST'])
-@jsonp
+@jsonp(max_age=http_cache_max_age, version=entities_version)
 async def flyout_entity(args, lang):
     args['lang'] = fix_lang(lang)
-    return await g.suggest.flyout_entity(args)
+    return await app.suggest.flyout_entity(args)
 
 @app.route('/<lang>/preview', endpoint='preview', methods=['GET','POST'])
-@jsonp
+@jsonp(max_age=http_cache_max_age, version=entities_version)
 async def preview(args, lang):
     args['lang'] = fix_lang(lang)
-    return await g.suggest.preview(args)
+    return await app.suggest.preview(args)
+
+@app.route('/<lang>/preview_by_batch', endpoint='preview-batch', methods=['GET','POST'])
+@jsonp(max_age=http_cache_max_age, version=entities_version)
+async def preview_by_batch(args, lang):
+    args['lang'] = fix_lang(lang)
+    return await app.suggest.preview_by_batch(args)
+
+@app.route('/<lang>/flyout_by_batch', endpoint='flyout-batch', methods=['GET','POST'])
+@jsonp(max_age=http_cache_max_age, version=entities_version)
+async def flyout_by_batch(args, lang):
+    args['lang'] = fix_lang(lang)
+    return await app.suggest.flyout_by_batch(args)
 
 @app.route('/fetch_values', endpoint='fetch-values-default-lang', methods=['GET','POST'])
-@jsonp
+@jsonp(max_age=http_cache_max_age)
 async def fetch_values(args):
     args['lang'] = fix_lang(args.get('lang'))
-    return await g.reconcile.fetch_values(args)
+    return await app.reconcile.fetch_values(args)
 
 @app.route('/<lang>/fetch_values', endpoint='fetch-values', methods=['GET','POST'])
-@jsonp
+@jsonp(max_age=http_cache_max_age)
 async def fetch_values(args, lang):
     args['lang'] = fix_lang(lang)
-    return await g.reconcile.fetch_values(args)
+    return await app.reconcile.fetch_values(args)
 
 @app.route('/<lang>/propose_properties', endpoint='propose-properties', methods=['GET','POST'])
-@jsonp
+@jsonp(max_age=http_cache_max_age)
 async def propose_properties(args, lang):
     args['lang'] = fix_lang(lang)
-    return await g.suggest.propose_properties(args)
+    return await app.suggest.propose_properties(args)
 
 @app.route('/<lang>/fetch_property_by_batch', endpoint='fetch-property-batch', methods=['GET','POST'])
-@jsonp
+@jsonp(max_age=http_cache_max_age)
 async def fetch_property_by_batch(args, lang):
     args['lang'] = fix_lang(lang)
-    return await reconcile.fetch_property_by_batch(args)
+    return await app.reconcile.fetch_property_by_batch(args)
 
 @app.route('/<lang>/fetch_properties_by_batch', endpoint='fetch-properties-batch', methods=['GET','POST'])
-@jsonp
+@jsonp(max_age=http_cache_max_age)
 async def fetch_property_by_batch(args, lang):
     args['lang'] = fix_lang(lang)
-    args['extend'] = json.loads(args.get('extend', '{}'))
-    return await reconcile.fetch_properties_by_batch(args)
+    args['extend'] = fast_json.loads(args.get('extend', '{}'))
+    return await app.reconcile.fetch_properties_by_batch(args)
 
 @app.route('/', endpoint='home')
 async def home():
@@ -329,7 +617,14 @@ async def home():
 
 @app.route('/monitoring')
 async def monitor():
-    return {'stats': await g.monitoring.get_rates()}
+    return {'stats': await app.monitoring.get_rates()}
+
+@app.route('/metrics')
+async def export_metrics():
+    """
+    Metrics of this process, in the Prometheus text format
+    """
+    return Response(metrics.registry.expose(), mimetype='text/plain; version=0.0.4')
 
 def fix_lang(lng):
     if not lng:
@@ -338,6 +633,42 @@ def fix_lang(lng):
         return 'ja'
     return lng
 
+usage = """Reconciliation service for OpenRefine
+
+Usage:
+  app.py [--debug] [--host=<host>] [--port=<port>] [--workers=<n>]
+  app.py -h | --help
+
+Options:
+  --debug          Run the development server (single process, debug mode)
+  --host=<host>    Address to listen on [default: 0.0.0.0]
+  --port=<port>    Port to listen on [default: 8000]
+  --workers=<n>    Number of worker processes (server_workers in the configuration by default)
+"""
+
+def serve(host, port, workers):
+    """
+    Runs the service in production mode, with Hypercorn.
+    Each worker process sets up its own engines and connections.
+    """
+    from hypercorn.config import Config as HypercornConfig
+    from hypercorn.run import run
+    hypercorn_config = HypercornConfig()
+    hypercorn_config.application_path = 'app:app'
+    hypercorn_config.bind = ['%s:%d' % (host, port)]
+    hypercorn_config.workers = workers
+    hypercorn_config.keep_alive_timeout = server_keep_alive_timeout
+    hypercorn_config.graceful_timeout = server_graceful_timeout
+    if server_access_log:
+        hypercorn_config.accesslog = '-'
+    run(hypercorn_config)
+
 if __name__ == '__main__':
-    app.run(debug=True, port=8000, host='0.0.0.0')
+    arguments = docopt(usage)
+    host = arguments['--host']
+    port = int(arguments['--port'])
+    if arguments['--debug']:
+        app.run(debug=True, port=port, host=host)
+    else:
+        serve(host, port, int(arguments['--workers'] or server_workers))
 
@@ -0,0 +1,487 @@
+"""
+An emulation of the Wikibase APIs used by this service, answering
+from the fixtures of the test suite (without any network access).
+"""
+
+import asyncio
+import bisect
+import json
+import os
+import random
+import re
+from collections import defaultdict
+
+import config
+
+fixtures_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'tests')
+
+def _normalize(text):
+    return ' '.join(text.lower().split())
+
+def load_fixtures(entities_dir=None, types_dir=None):
+    """
+    Loads the entities and subclass hierarchies stored
+    in the `tests` directory.
+
+    :returns: a dict of entities (in the JSON format of wbgetentities),
+        and a dict mapping classes to the list of their subclasses
+    """
+    entities = {}
+    entities_dir = entities_dir or os.path.join(fixtures_dir, 'entities')
+    for filename in sorted(os.listdir(entities_dir)):
+        if not filename.endswith('.json'):
+            continue
+        with open(os.path.join(entities_dir, filename), 'r') as f:
+            entity = json.load(f)
+        if entity and 'id' in entity:
+            entities[entity['id']] = entity
+
+    children = {}
+    types_dir = types_dir or os.path.join(fixtures_dir, 'types')
+    for filename in os.listdir(types_dir):
+        if filename.endswith('.json'):
+            with open(os.path.join(types_dir, filename), 'r') as f:
+                children[filename[:-len('.json')]] = json.load(f)
+    return entities, children
+
+synthetic_words = [
+    'amber', 'basalt', 'cedar', 'delta', 'ember', 'fjord', 'granite', 'harbor',
+    'indigo', 'juniper', 'kestrel', 'lagoon', 'meadow', 'nimbus', 'orchid', 'prairie',
+    'quartz', 'raven', 'summit', 'tundra', 'umber', 'valley', 'willow', 'xenon',
+    'yarrow', 'zephyr', 'north', 'south', 'old', 'new', 'upper', 'lower',
+]
+
+synthetic_classes = {
+    # class: (label, parent class)
+    'Q35120': ('entity', None),
+    'Q515': ('city', 'Q35120'),
+    'Q1549591': ('big city', 'Q515'),
+    'Q5': ('human', 'Q35120'),
+    'Q4022': ('river', 'Q35120'),
+    'Q6256': ('country', 'Q35120'),
+}
+
+synthetic_properties = {
+    'P31': ('instance of', 'wikibase-item'),
+    'P279': ('subclass of', 'wikibase-item'),
+    'P17': ('country', 'wikibase-item'),
+    'P571': ('inception', 'time'),
+    'P214': ('VIAF ID', 'external-id'),
+    'P1963': ('properties for this type', 'wikibase-property'),
+}
+
+# properties proposed for the instances of each class (P1963)
+synthetic_class_properties = {
+    'Q35120': ['P31'],
+    'Q515': ['P17', 'P571'],
+    'Q5': ['P214', 'P571'],
+    'Q6256': ['P571'],
+}
+
+def _statement(pid, datatype, value):
+    if datatype in ['wikibase-item', 'wikibase-property']:
+        datavalue = {'type': 'wikibase-entityid', 'value': {
+            'entity-type': datatype.split('-')[1], 'numeric-id': int(value[1:]), 'id': value}}
+    elif datatype == 'time':
+        datavalue = {'type': 'time', 'value': {
+            'time': '+%04d-00-00T00:00:00Z' % value, 'timezone': 0, 'before': 0, 'after': 0,
+            'precision': 9, 'calendarmodel': 'http://www.wikidata.org/entity/Q1985727'}}
+    else:
+        datavalue = {'type': 'string', 'value': value}
+    return {
+        'mainsnak': {'snaktype': 'value', 'property': pid, 'datavalue': datavalue, 'datatype': datatype},
+        'type': 'statement',
+        'rank': 'normal',
+    }
+
+def _entity(entity_id, label, description, claims=(), aliases=(), datatype=None):
+    entity = {
+        'type': 'property' if datatype else 'item',
+        'id': entity_id,
+        'labels': {'en': {'language': 'en', 'value': label}},
+        'descriptions': {'en': {'language': 'en', 'value': description}},
+        'aliases': {'en': [{'language': 'en', 'value': alias} for alias in aliases]} if aliases else {},
+        'claims': {},
+    }
+    for pid, value in claims:
+        entity['claims'].setdefault(pid, []).append(_statement(pid, synthetic_properties[pid][1], value))
+    if datatype:
+        entity['datatype'] = datatype
+    else:
+        entity['sitelinks'] = {'enwiki': {'site': 'enwiki', 'title': label}}
+    return entity
+
+def synthetic_corpus(size, seed=0):
+    """
+    Generates a corpus of items with random labels, types and
+    statements, in the same format as load_fixtures.
+
+    >>> entities, children = synthetic_corpus(10)
+    >>> len([qid for qid in entities if qid.startswith('Q') and qid not in synthetic_classes])
+    10
+    """
+    rng = random.Random(seed)
+    entities = {}
+    for pid, (label, datatype) in synthetic_properties.items():
+        entities[pid] = _entity(pid, label, 'property', datatype=datatype)
+    for qid, (label, parent) in synthetic_classes.items():
+        claims = [('P279', parent)] if parent else []
+        claims += [('P1963', pid) for pid in synthetic_class_properties.get(qid, [])]
+        entities[qid] = _entity(qid, label, 'class', claims=claims)
+    children = {qid: [] for qid in synthetic_classes}
+    for qid in synthetic_classes:
+        ancestor = qid
+        while ancestor:
+            children[ancestor].append(qid)
+            ancestor = synthetic_classes[ancestor][1]
+
+    classes = [qid for qid in synthetic_classes if qid not in ['Q35120', 'Q6256']]
+    countries = []
+    for i in range(size):
+        qid = 'Q%d' % (1000000 + i)
+        words = rng.sample(synthetic_words, rng.choice([1, 2, 2, 3]))
+        label = ' '.join(words).title()
+        if i < max(1, size // 50):
+            typ = 'Q6256'
+            countries.append(qid)
+        else:
+            typ = rng.choice(classes)
+        claims = [('P31', typ), ('P214', str(100000 + i))]
+        if countries and typ != 'Q6256':
+            claims.append(('P17', rng.choice(countries)))
+        if rng.random() < 0.5:
+            claims.append(('P571', rng.randint(1000, 2020)))
+        aliases = [' '.join(reversed(words)).title()] if len(words) > 1 else []
+        description = '%s in the synthetic corpus' % synthetic_classes[typ][0]
+        entities[qid] = _entity(qid, label, description, claims=claims, aliases=aliases)
+    return entities, children
+
+class FixtureWikibase(object):
+    """
+    Answers API calls (MediaWiki API, SPARQL and autodesc)
+    with a given set of entities and subclass hierarchies
+    (by default, those of the test fixtures).
+    """
+    def __init__(self, entities=None, children=None):
+        if entities is None:
+            entities, children = load_fixtures()
+        self.entities = entities
+        self.children = children or {}
+
+        self.sitelinks = {}
+        for qid, entity in self.entities.items():
+            for site, sitelink in entity.get('sitelinks', {}).items():
+                self.sitelinks[(site, sitelink['title'])] = qid
+
+        self.terms = {} # lang -> sorted list of (normalized term, entity id)
+        self.tokens = None
+
+    def handle(self, method, url, params=None, data=None):
+        """
+        Returns the JSON payload which the given call would return.
+        Raises ValueError for calls which are not emulated.
+        """
+        params = {k: str(v) for k, v in (params or {}).items()}
+        if url == config.wikibase_sparql_endpoint:
+            return self.sparql((data or {}).get('query', params.get('query', '')))
+        elif url == config.autodescribe_endpoint:
+            return self.autodesc(params)
+        elif url.endswith('/api.php'):
+            return self.api(params)
+        raise ValueError('Unexpected URL: {}'.format(url))
+
+    def api(self, params):
+        """
+        Answers a call to the MediaWiki API
+        """
+        action = params.get('action')
+        if action == 'wbgetentities':
+            return self.wbgetentities(params)
+        elif action == 'wbsearchentities':
+            return self.wbsearchentities(params)
+        elif action == 'query' and params.get('list') == 'search':
+            return self.search(params)
+        elif action == 'query' and 'titles' in params:
+            return self.redirects(params)
+        raise ValueError('Unexpected API call: {}'.format(params))
+
+    def wbgetentities(self, params):
+        entities = {}
+        if 'ids' in params:
+            for entity_id in params['ids'].split('|'):
+                entities[entity_id] = self.entities.get(entity_id) or {'id': entity_id, 'missing': ''}
+        else:
+            site = params.get('sites')
+            for i, title in enumerate(params.get('titles', '').split('|')):
+                qid = self.sitelinks.get((site, title))
+                if qid:
+                    entities[qid] = {
+                        'id': qid,
+                        'sitelinks': {site: {'site': site, 'title': title}},
+                    }
+                else:
+                    entities[str(-1-i)] = {'site': site, 'title': title, 'missing': ''}
+        return {'entities': entities, 'success': 1}
+
+    def wbsearchentities(self, params):
+        lang = params.get('language', 'en')
+        prefix = _normalize(params.get('search', ''))
+        entity_type = params.get('type', 'item')
+        limit = int(params.get('limit', 7))
+        results = []
+        for entity_id in self._ids_by_prefix(lang, prefix):
+            if (entity_id[0] == 'P') != (entity_type == 'property'):
+                continue
+            entity = self.entities[entity_id]
+            results.append({
+                'id': entity_id,
+                'label': entity.get('labels', {}).get(lang, {}).get('value', entity_id),
+                'description': entity.get('descriptions', {}).get(lang, {}).get('value'),
+            })
+        response = {'search': results[:limit], 'success': 1}
+        if len(results) > limit:
+            response['search-continue'] = limit
+        return response
+
+    def search(self, params):
+        tokens = _normalize(params.get('srsearch', '')).split()
+        limit = int(params.get('srlimit', 10))
+        index = self._token_index()
+        matching = set(index.get(tokens[0], ())) if tokens else set()
+        for token in tokens[1:]:
+            matching &= index.get(token, set())
+        matching = sorted((entity_id for entity_id in matching if entity_id[0] == 'Q'),
+                key=lambda entity_id: int(entity_id[1:]))
+        return {'query': {'search': [
+            {'ns': config.wikibase_namespace_id, 'title': config.wikibase_namespace_prefix + entity_id}
+            for entity_id in matching[:limit]]}}
+
+    def redirects(self, params):
+        return {'batchcomplete': '', 'query': {'pages': {}}}
+
+    def autodesc(self, params):
+        entity = self.entities.get(params.get('q'), {})
+        description = entity.get('descriptions', {}).get(params.get('lang', 'en'), {}).get('value', '')
+        return {'q': params.get('q'), 'result': description}
+
+    def sparql(self, query):
+        """
+        Recognizes the queries issued by this service
+        (subclasses, unique identifier properties, lookups
+        by identifier, properties to propose for a type, terms
+        of all the properties) and answers them from the fixtures.
+        """
+        if 'P279*' in query and '?child' in query:
+            match = re.search(r'wd:(Q\d+)', query)
+            children = self.children.get(match.group(1), []) if match else []
+            bindings = [{'child': {'type': 'uri', 'value': config.identifier_space + qid}} for qid in children]
+        elif query.strip() == config.sparql_query_to_fetch_unique_id_properties.strip():
+            bindings = [{'pid': {'type': 'uri', 'value': config.identifier_space + pid}} for pid in ['P214', 'P1566']]
+        elif 'VALUES ?value' in query:
+            bindings = self._lookup_by_values(query)
+        elif 'gas:service' in query:
+            bindings = self._propose_properties(query)
+        elif 'wikibase:propertyType' in query:
+            bindings = self._property_terms(query)
+        else:
+            bindings = []
+        return {'head': {'vars': []}, 'results': {'bindings': bindings}}
+
+    def _lookup_by_values(self, query):
+        pids = re.findall(r'(P\d+)', query.split('VALUES')[0])
+        values = set(re.findall(r'"((?:[^"\\]|\\.)*)"', query.split('VALUES', 1)[1].split('}')[0]))
+        bindings = []
+        if not pids:
+            return bindings
+        for qid, entity in self.entities.items():
+            for claim in entity.get('claims', {}).get(pids[-1], []):
+                value = claim.get('mainsnak', {}).get('datavalue', {}).get('value')
+                if isinstance(value, str) and value in values:
+                    bindings.append({
+                        'qid': {'type': 'uri', 'value': config.identifier_space + qid},
+                        'value': {'type': 'literal', 'value': value},
+                    })
+        return bindings
+
+    def _propose_properties(self, query):
+        """
+        The properties for the instances of a type and of its
+        superclasses (breadth-first, with their depth), as the
+        GAS query of `sparql_query_to_propose_properties`
+        """
+        base_type = re.search(r'gas:in wd:(Q\d+)', query)
+        link = re.search(r'wdt:(P\d+) \?prop', query)
+        lang = re.search(r'wikibase:language "([^"]+)"', query)
+        limit = re.search(r'LIMIT (\d+)', query)
+        if not base_type or not link:
+            return []
+        lang = lang.group(1) if lang else 'en'
+        bindings = []
+        depths = {base_type.group(1): 0}
+        queue = [base_type.group(1)]
+        while queue:
+            qid = queue.pop(0)
+            claims = self.entities.get(qid, {}).get('claims', {})
+            for claim in claims.get(link.group(1), []):
+                pid = claim['mainsnak'].get('datavalue', {}).get('value', {}).get('id')
+                if pid:
+                    label = self.entities.get(pid, {}).get('labels', {}).get(lang, {}).get('value', pid)
+                    bindings.append({
+                        'prop': {'type': 'uri', 'value': config.identifier_space + pid},
+                        'propLabel': {'type': 'literal', 'value': label},
+                        'depth': {'type': 'literal', 'value': str(depths[qid])},
+                    })
+            for claim in claims.get('P279', []):
+                parent = claim['mainsnak'].get('datavalue', {}).get('value', {}).get('id')
+                if parent and parent not in depths:
+                    depths[parent] = depths[qid] + 1
+                    queue.append(parent)
+        return bindings[:int(limit.group(1))] if limit else bindings
+
+    def _property_terms(self, query):
+        """
+        The datatype, labels, descriptions and aliases of all the
+        properties, as the query of `sparql_query_to_fetch_properties`
+        """
+        languages = re.search(r'IN \(([^)]*)\)', query)
+        languages = set(re.findall(r'"([^"]+)"', languages.group(1))) if languages else {'en'}
+        bindings = []
+        for pid, entity in sorted(self.entities.items()):
+            if not pid.startswith('P'):
+                continue
+            binding = {
+                'pid': {'type': 'uri', 'value': config.identifier_space + pid},
+                # local names of the datatypes, such as ExternalId for external-id
+                'type': {'type': 'uri', 'value': 'http://wikiba.se/ontology#' + ''.join(
+                    part[:1].upper() + part[1:] for part in entity.get('datatype', 'string').split('-'))},
+            }
+            terms = []
+            for term_type, key in [('label', 'labels'), ('description', 'descriptions')]:
+                for lang, term in entity.get(key, {}).items():
+                    terms.append((term_type, lang, term['value']))
+            for lang, aliases in entity.get('aliases', {}).items():
+                terms.extend(('alias', lang, alias['value']) for alias in aliases)
+            terms = [term for term in terms if term[1] in languages]
+            if not terms:
+                bindings.append(binding)
+            for term_type, lang, value in terms:
+                bindings.append(dict(binding,
+                    term={'type': 'literal', 'value': value, 'xml:lang': lang},
+                    termType={'type': 'literal', 'value': term_type}))
+        return bindings
+
+    def build_indices(self, lang):
+        """
+        Builds the search indices (otherwise built on the first search)
+        """
+        list(self._ids_by_prefix(lang, ''))
+        self._token_index()
+
+    def _ids_by_prefix(self, lang, prefix):
+        """
+        The ids of the entities with a label or alias starting
+        with the prefix, in the given language
+        """
+        if lang not in self.terms:
+            terms = set()
+            for entity_id, entity in self.entities.items():
+                for term in self._entity_terms(entity, lang):
+                    terms.add((term, entity_id))
+            self.terms[lang] = sorted(terms)
+        terms = self.terms[lang]
+        seen = set()
+        for i in range(bisect.bisect_left(terms, (prefix, '')), len(terms)):
+            term, entity_id = terms[i]
+            if not term.startswith(prefix):
+                break
+            if entity_id not in seen:
+                seen.add(entity_id)
+                yield entity_id
+
+    def _token_index(self):
+        """
+        The ids of the entities indexed by the words of their
+        labels and aliases, in all languages
+        """
+        if self.tokens is None:
+            self.tokens = defaultdict(set)
+            for entity_id, entity in self.entities.items():
+                for term in self._entity_terms(entity):
+                    for token in term.split():
+                        self.tokens[token].add(entity_id)
+        return self.tokens
+
+    def _entity_terms(self, entity, lang=None):
+        for term_lang, label in entity.get('labels', {}).items():
+            if lang is None or term_lang == lang:
+                yield _normalize(label['value'])
+        for term_lang, aliases in entity.get('aliases', {}).items():
+            if lang is None or term_lang == lang:
+                for alias in aliases:
+                    yield _normalize(alias['value'])
+
+    def sample_labels(self, lang='en', prefix='Q', limit=None):
+        """
+        Labels of the fixture entities, to build benchmark queries
+        """
+        labels = [
+            (entity_id, entity['labels'][lang]['value'])
+            for entity_id, entity in sorted(self.entities.items())
+            if entity_id.startswith(prefix) and lang in entity.get('labels', {})
+        ]
+        return labels[:limit] if limit else labels
+
+class StubResponse(object):
+    def __init__(self, payload, status=200):
+        self.payload = payload
+        self.status = status
+        self.headers = {}
+
+    def raise_for_status(self):
+        pass
+
+    async def json(self):
+        return self.payload
+
+    async def text(self):
+        return json.dumps(self.payload)
+
+class StubRequest(object):
+    """
+    The asynchronous context manager returned by the
+    get and post methods of StubSession
+    """
+    def __init__(self, session, method, url, params, data):
+        self.session = session
+        self.method = method
+        self.url = url
+        self.params = params
+        self.data = data
+
+    async def __aenter__(self):
+        session = self.session
+        await asyncio.sleep(session.latency + random.uniform(0, session.jitter))
+        return StubResponse(session.wikibase.handle(self.method, self.url, self.params, self.data))
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+class StubSession(object):
+    """
+    Replaces the aiohttp client session used by the service,
+    answering requests with a FixtureWikibase after a delay.
+    """
+    def __init__(self, wikibase, latency=0, jitter=0):
+        """
+        :param latency: the minimum delay of each call, in seconds
+        :param jitter: the maximum random delay added to it, in seconds
+        """
+        self.wikibase = wikibase
+        self.latency = latency
+        self.jitter = jitter
+
+    def get(self, url, params=None, **kwargs):
+        return StubRequest(self, 'GET', url, params, None)
+
+    def post(self, url, data=None, params=None, **kwargs):
+        return StubRequest(self, 'POST', url, params, data)
@@ -0,0 +1,218 @@
+"""Offline benchmark of the reconciliation service
+
+Runs the main operations of the service against the Wikibase APIs
+emulated from the test fixtures (with an injected latency), and
+reports their throughput, latency percentiles and upstream calls.
+Only the Redis instance of the configuration is used, on a database
+reserved for the benchmark (whose keys are deleted before each run),
+which must not be the database of the service.
+
+Run it from the root of the repository, with `python -m benchmarks.run`.
+
+Usage:
+  benchmarks.run [--latency=<ms>] [--jitter=<ms>] [--batch-sizes=<sizes>] [--repeat=<n>] [--warm] [--synthetic=<n>] [--redis-db=<n>] [<scenario>...]
+  benchmarks.run -h | --help
+
+Scenarios:
+  reconcile, extend, suggest_property, preview (all of them by default)
+
+Options:
+  --latency=<ms>         Minimum latency of each upstream call [default: 50]
+  --jitter=<ms>          Maximum random latency added to each call [default: 20]
+  --batch-sizes=<sizes>  Comma-separated batch sizes [default: 1,10,100,1000]
+  --repeat=<n>           Number of batches run for each size [default: 5]
+  --warm                 Keep the caches between batches of the same size
+  --synthetic=<n>        Use a synthetic corpus of n items instead of the test fixtures
+  --redis-db=<n>         Redis database used by the benchmark [default: 15]
+"""
+
+import asyncio
+import math
+import os
+import time
+from collections import Counter
+
+import aioredis
+from docopt import docopt
+from quart import Quart
+
+from config import redis_uri, redis_key_prefix
+from wdreconcile import metrics
+from wdreconcile.engine import ReconcileEngine
+from wdreconcile.itemstore import ItemStore, binary_client
+from wdreconcile.suggest import SuggestEngine
+
+from .fixtures import FixtureWikibase, StubSession, synthetic_corpus
+
+templates_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'templates')
+
+def benchmark_redis_client(db):
+    """
+    A client of the Redis instance of the configuration, on
+    another database than the one used by the service.
+    """
+    pool = aioredis.ConnectionPool.from_url(redis_uri, decode_responses=True)
+    client = aioredis.Redis(connection_pool=aioredis.ConnectionPool(
+        connection_class=pool.connection_class,
+        **dict(pool.connection_kwargs, db=db)))
+    check_redis_client(client)
+    return client
+
+def check_redis_client(redis_client):
+    """
+    Refuses Redis clients connected to the database of the
+    service, whose keys would be deleted by the benchmark.
+    """
+    service_db = aioredis.ConnectionPool.from_url(redis_uri).connection_kwargs.get('db', 0)
+    if int(redis_client.connection_pool.connection_kwargs.get('db', 0)) == int(service_db):
+        raise ValueError('The benchmark cannot use the Redis database of the service ({}), '
+                         'as it deletes its keys: choose another one with --redis-db'.format(service_db))
+
+def percentile(values, p):
+    """
+    >>> percentile([1, 2, 3, 4], 50)
+    2
+    >>> percentile([1, 2, 3, 4], 99)
+    4
+    """
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100. * len(ordered)) - 1)]
+
+class Benchmark(object):
+    def __init__(self, redis_client, session, wikibase):
+        check_redis_client(redis_client)
+        self.r = redis_client
+        # shared by the item stores created at each reset
+        self.binary_r = binary_client(redis_client)
+        self.session = session
+        self.wikibase = wikibase
+        self.app = Quart(__name__, template_folder=templates_dir)
+        self.items = wikibase.sample_labels(prefix='Q')
+        self.properties = wikibase.sample_labels(prefix='P')
+        self.reset()
+
+    def reset(self):
+        """
+        Creates new engines, with empty in-process caches
+        """
+        self.item_store = ItemStore(self.r, self.session, binary_redis_client=self.binary_r)
+        self.engine = ReconcileEngine(self.r, self.session, item_store=self.item_store)
+        self.suggest = SuggestEngine(self.r, self.session, item_store=self.item_store)
+
+    async def clear_redis(self):
+        keys = [key async for key in self.r.scan_iter(match=redis_key_prefix+'*')]
+        for i in range(0, len(keys), 1000):
+            await self.r.delete(*keys[i:i+1000])
+
+    def sample(self, values, size, offset):
+        return [values[(offset + i) % len(values)] for i in range(size)]
+
+    async def reconcile(self, size, offset):
+        queries = {
+            'q%d' % i: {'query': label}
+            for i, (qid, label) in enumerate(self.sample(self.items, size, offset))
+        }
+        await self.engine.process_queries(queries, default_language='en')
+
+    async def extend(self, size, offset):
+        await self.engine.fetch_properties_by_batch({
+            'lang': 'en',
+            'extend': {
+                'ids': [qid for qid, _ in self.sample(self.items, size, offset)],
+                'properties': [{'id': 'P17'}, {'id': 'P571'}, {'id': 'P31/P279'}],
+            },
+        })
+
+    async def suggest_property(self, size, offset):
+        prefixes = [label[:3] for _, label in self.sample(self.properties, size, offset)]
+        await asyncio.gather(*[
+            self.suggest.find_property({'prefix': prefix, 'lang': 'en'})
+            for prefix in prefixes
+        ])
+
+    async def preview(self, size, offset):
+        async with self.app.app_context():
+            await asyncio.gather(*[
+                self.suggest.preview({'id': qid, 'lang': 'en'})
+                for qid, _ in self.sample(self.items, size, offset)
+            ])
+
+    async def run(self, scenario, size, repeat, warm):
+        """
+        Runs batches of the given size and returns their statistics
+        """
+        operation = getattr(self, scenario)
+        durations = []
+        calls_before = self.upstream_calls()
+        if warm:
+            self.reset()
+            await self.clear_redis()
+        for i in range(repeat):
+            if not warm:
+                self.reset()
+                await self.clear_redis()
+            start = time.perf_counter()
+            await operation(size, i * size)
+            durations.append(time.perf_counter() - start)
+        calls = self.upstream_calls()
+        calls.subtract(calls_before)
+        return {
+            'scenario': scenario,
+            'batch_size': size,
+            'queries_per_second': size * repeat / sum(durations),
+            'p50': percentile(durations, 50),
+            'p95': percentile(durations, 95),
+            'p99': percentile(durations, 99),
+            'upstream_calls': sum(calls.values()) / repeat,
+            'upstream_calls_by_action': {
+                action: count / repeat for action, count in sorted(calls.items()) if count
+            },
+        }
+
+    def upstream_calls(self):
+        """
+        The number of upstream calls made so far, by API action
+        """
+        calls = Counter()
+        for (action, outcome), count in metrics.upstream_requests.series.items():
+            calls[action] += count
+        return calls
+
+scenarios = ['reconcile', 'extend', 'suggest_property', 'preview']
+
+def print_report(stats):
+    print('{scenario:<18} {batch_size:>6} {queries_per_second:>10.1f} q/s   '
+          'p50 {p50:>8.3f}s  p95 {p95:>8.3f}s  p99 {p99:>8.3f}s  '
+          '{upstream_calls:>8.1f} upstream calls/batch ({actions})'.format(
+            actions=', '.join('%s: %g' % pair for pair in stats['upstream_calls_by_action'].items()),
+            **stats))
+
+async def main(arguments):
+    selected = arguments['<scenario>'] or scenarios
+    for scenario in selected:
+        if scenario not in scenarios:
+            raise ValueError('Unknown scenario: {}'.format(scenario))
+    batch_sizes = [int(size) for size in arguments['--batch-sizes'].split(',')]
+    repeat = int(arguments['--repeat'])
+
+    if arguments['--synthetic']:
+        wikibase = FixtureWikibase(*synthetic_corpus(int(arguments['--synthetic'])))
+    else:
+        wikibase = FixtureWikibase()
+    # build the search indices before measuring anything
+    wikibase.build_indices('en')
+    session = StubSession(wikibase,
+            latency=float(arguments['--latency']) / 1000,
+            jitter=float(arguments['--jitter']) / 1000)
+    redis_client = benchmark_redis_client(int(arguments['--redis-db']))
+    try:
+        benchmark = Benchmark(redis_client, session, wikibase)
+        for scenario in selected:
+            for size in batch_sizes:
+                print_report(await benchmark.run(scenario, size, repeat, arguments['--warm']))
+        await benchmark.clear_redis()
+    finally:
+        await redis_client.close()
+
+if __name__ == '__main__':
+    asyncio.run(main(docopt(__doc__)))
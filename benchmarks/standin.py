@@ -0,0 +1,138 @@
+"""Stand-in for the Wikibase instance, to load-test the service offline
+
+Serves the MediaWiki API (wbgetentities, wbsearchentities, list=search,
+redirect resolution), the SPARQL endpoint and autodesc from the test
+fixtures or from a synthetic corpus, with configurable latency, error
+rate, rate limiting and replication lag.
+
+Run it from the root of the repository, with `python -m benchmarks.standin`,
+and point the configuration of the service to it:
+
+  mediawiki_api_endpoint = 'http://localhost:8001/w/api.php'
+  wikibase_sparql_endpoint = 'http://localhost:8001/sparql'
+  autodescribe_endpoint = 'http://localhost:8001/autodesc'
+  wiki_api_endpoint_pattern = 'http://localhost:8001/{}/{}/w/api.php'
+
+Usage:
+  benchmarks.standin [--host=<host>] [--port=<port>] [--latency=<ms>] [--jitter=<ms>] [--error-rate=<p>] [--rate-limit=<n>] [--lag=<s>] [--synthetic=<n>] [--seed=<n>]
+  benchmarks.standin -h | --help
+
+Options:
+  --host=<host>      Address to listen on [default: localhost]
+  --port=<port>      Port to listen on [default: 8001]
+  --latency=<ms>     Minimum latency of each response [default: 50]
+  --jitter=<ms>      Maximum random latency added to each response [default: 20]
+  --error-rate=<p>   Proportion of requests failing with a 503 error [default: 0]
+  --rate-limit=<n>   Maximum number of requests per second, beyond which
+                     requests are rejected with a 429 error (no limit by default)
+  --lag=<s>          Replication lag reported to API calls with a maxlag parameter [default: 0]
+  --synthetic=<n>    Serve a synthetic corpus of n items instead of the test fixtures
+  --seed=<n>         Random seed of the synthetic corpus [default: 0]
+"""
+
+import asyncio
+import math
+import random
+import time
+
+from aiohttp import web
+from docopt import docopt
+
+from .fixtures import FixtureWikibase, synthetic_corpus
+
+class TokenBucket(object):
+    """
+    Allows `rate` requests per second on average,
+    with bursts of up to `rate` requests.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def take(self):
+        """
+        :returns: 0 if the request is allowed, otherwise the
+            number of seconds to wait before trying again
+        """
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+def make_app(wikibase, latency=0, jitter=0, error_rate=0, rate_limit=None, lag=0):
+    """
+    Builds the stand-in application.
+
+    :param wikibase: the FixtureWikibase answering the requests
+    :param latency: the minimum delay of each response, in seconds
+    :param jitter: the maximum random delay added to it, in seconds
+    :param error_rate: the proportion of requests failing with a 503 error
+    :param rate_limit: the maximum number of requests per second
+    :param lag: the replication lag (in seconds) compared to the maxlag
+        parameter of API calls
+    """
+    bucket = TokenBucket(rate_limit) if rate_limit else None
+
+    @web.middleware
+    async def emulate_conditions(request, handler):
+        if bucket:
+            wait = bucket.take()
+            if wait:
+                return web.Response(status=429, text='Too many requests',
+                        headers={'Retry-After': str(math.ceil(wait))})
+        await asyncio.sleep(latency + random.uniform(0, jitter))
+        if random.random() < error_rate:
+            return web.Response(status=503, text='Service unavailable')
+        return await handler(request)
+
+    async def params_of(request):
+        params = dict(request.query)
+        if request.method == 'POST':
+            params.update(await request.post())
+        return params
+
+    async def api(request):
+        params = await params_of(request)
+        if 'maxlag' in params and lag > float(params['maxlag']):
+            return web.json_response({'error': {
+                'code': 'maxlag',
+                'info': 'Waiting for a database server: {} seconds lagged.'.format(lag),
+                'lag': lag,
+            }}, headers={'Retry-After': '5', 'X-Database-Lag': str(lag)})
+        try:
+            return web.json_response(wikibase.api(params))
+        except ValueError as e:
+            return web.json_response({'error': {'code': 'badvalue', 'info': str(e)}})
+
+    async def sparql(request):
+        params = await params_of(request)
+        return web.json_response(wikibase.sparql(params.get('query', '')))
+
+    async def autodesc(request):
+        return web.json_response(wikibase.autodesc(await params_of(request)))
+
+    app = web.Application(middlewares=[emulate_conditions])
+    app.router.add_route('*', '/w/api.php', api)
+    app.router.add_route('*', '/{lang}/{wiki}/w/api.php', api)
+    app.router.add_route('*', '/sparql', sparql)
+    app.router.add_route('*', '/autodesc', autodesc)
+    return app
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    if arguments['--synthetic']:
+        wikibase = FixtureWikibase(*synthetic_corpus(int(arguments['--synthetic']), seed=int(arguments['--seed'])))
+    else:
+        wikibase = FixtureWikibase()
+    wikibase.build_indices('en')
+    app = make_app(wikibase,
+            latency=float(arguments['--latency']) / 1000,
+            jitter=float(arguments['--jitter']) / 1000,
+            error_rate=float(arguments['--error-rate']),
+            rate_limit=float(arguments['--rate-limit']) if arguments['--rate-limit'] else None,
+            lag=float(arguments['--lag']))
+    web.run_app(app, host=arguments['--host'], port=int(arguments['--port']))
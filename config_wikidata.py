@@ -11,6 +11,11 @@ mediawiki_api_endpoint = 'https://www.wikidata.org/w/api.php'
 # SPARQL endpoint
 wikibase_sparql_endpoint = 'https://query.wikidata.org/sparql'
 
+# Endpoint of the MediaWiki API of the wikis linked to the Wikibase instance
+# (used to resolve redirects of sitelinks), from the language code and the
+# domain of the wiki (for instance 'en' and 'wikipedia')
+wiki_api_endpoint_pattern = 'https://{}.{}.org/w/api.php'
+
 # Name of the Wikibase instance
 wikibase_name = 'Wikidata'
 
@@ -61,6 +66,26 @@ service_name = 'DEV Wikidata'
 # URL (without the trailing slash) where this server runs
 this_host = 'http://localhost:8000'
 
+# Settings of the production server (python app.py, without --debug):
+# number of worker processes, time (in seconds) idle connections are kept open,
+# time given to requests in progress to complete on shutdown, and whether
+# requests should be logged on the standard output
+server_workers = 4
+server_keep_alive_timeout = 5
+server_graceful_timeout = 10
+server_access_log = False
+
+# Time (in seconds) the responses to GET requests on the read-only endpoints
+# (service manifest, suggest, previews, flyouts, data extension) can be cached
+# by clients and proxies. They are sent with an ETag, so that unchanged responses
+# are not sent again (304 Not Modified). 0 to disable.
+http_cache_max_age = 5*60
+
+# Responses larger than this size (in bytes) are compressed, with brotli (if the
+# Brotli package is installed) or gzip, depending on what the client accepts.
+# None to disable (for instance if a proxy in front of the service compresses them).
+http_compression_min_size = 1024
+
 # The default limit on the number of results returned by us
 default_num_results = 25
 
@@ -70,17 +95,132 @@ wd_api_max_search_results = 50 # need a bot account to get more
 # The matching score above which we should automatically match an item
 validation_threshold = 95
 
+# Maximum number of queries of a batch whose candidates are ranked at the same time
+# (ranking can wait for the items used as property values, or for type checks)
+ranking_concurrency = 10
+
+# Queries sent to the streaming endpoint (/api/stream) are processed by chunks
+# of this size, with at most this number of chunks processed at the same time
+stream_chunk_size = 50
+stream_max_chunks = 4
+
+# Batches submitted as jobs (/jobs) are stored in Redis and processed in the background
+# by chunks of job_chunk_size queries, by job_workers workers in each process.
+# A chunk is processed again if it is not done after job_lease_time seconds
+# (for instance if the process died). Results are kept for job_ttl seconds.
+job_workers = 1
+job_chunk_size = 100
+job_lease_time = 5*60
+job_ttl = 7*24*60*60
+
 # Redis client used for caching at various places
 redis_uri = 'redis://localhost:6379/0?encoding=utf-8'
 
 # Redis prefix to use in front of all keys
 redis_key_prefix = 'openrefine_wikidata:'
 
+# Bounds on the in-process cache of items, kept in front of Redis
+# (maximum number of items, and maximum total size in bytes of their serialization
+# with item_cache_codec, as stored in Redis)
+item_cache_max_entries = 10000
+item_cache_max_bytes = 256*1024*1024
+
+# Time (in seconds) items are kept in the caches. The suggest, preview and flyout
+# services share these caches, so the items they fetch also expire after this time
+# (they used to be kept for one day: set it to 24*60*60 to keep them as long).
+item_cache_ttl = 60*60
+
+# Time (in seconds) items and subclasses are kept after they expire: during that
+# time, they are still served (while being refreshed in the background), so that
+# reconciliation does not wait for the Wikibase instance when it is slow or down.
+item_cache_stale_ttl = 24*60*60
+subclass_cache_stale_ttl = 7*24*60*60
+
+# Caching of the results of the search APIs (in Redis and in memory): time (in
+# seconds) results are kept, shorter time for searches without results, and
+# maximum number of searches kept in memory
+search_cache_ttl = 60*60
+search_cache_negative_ttl = 10*60
+search_cache_max_entries = 10000
+
+# Auto-complete (suggest) services: time (in seconds) their results are cached,
+# number of results requested from wbsearchentities (at most 50: the more results,
+# the more often the suggestions for a longer prefix can be derived from them
+# without calling the API again) and number of suggestions returned.
+suggest_cache_ttl = 60*60
+suggest_fetch_limit = 50
+suggest_result_limit = 7
+
+# Time (in seconds) the descriptions generated by autodesc are cached (shorter
+# time when autodesc returns nothing or fails), and time the rendered previews
+# and flyouts are cached (they are rendered again when the item is edited)
+autodesc_cache_ttl = 24*60*60
+autodesc_cache_negative_ttl = 10*60
+preview_cache_ttl = 24*60*60
+
+# Items requested one by one are retrieved together if they are requested
+# within this delay (in seconds). With 0, items requested within the same
+# iteration of the event loop are grouped.
+item_batch_delay = 0
+
+# Serialization of the items stored in Redis: 'json', 'msgpack' (requires
+# the msgpack package) or 'msgpack+zstd' (requires msgpack and zstandard), see
+# requirements-optional.txt. Entries written with any of these formats can be
+# read back, as long as the packages they require are installed.
+item_cache_codec = 'json'
+# Compression level and (optional) path to a trained dictionary for 'msgpack+zstd'
+item_cache_zstd_level = 3
+item_cache_zstd_dictionary = None
+
+# JSON library used to parse the queries and to serialize the responses (and the
+# items cached with the 'json' codec): 'json' or 'orjson' (faster on large
+# responses, requires the orjson package)
+json_library = 'json'
+
 # Headers for the HTTP requests made by the tool
 headers = {
     'User-Agent':service_name + ' (OpenRefine-Wikibase reconciliation service)',
 }
 
+# Limits on the calls made to each upstream endpoint (MediaWiki API, SPARQL, autodesc):
+# maximum number of concurrent calls (reduced automatically when the endpoint
+# asks us to slow down) and maximum number of calls per second (None for no limit).
+# These can be overridden for a given host in upstream_endpoint_limits, for instance:
+# upstream_endpoint_limits = {'query.wikidata.org': {'max_concurrency': 5, 'rate': 10}}
+upstream_max_concurrency = 10
+upstream_rate_limit = None
+upstream_endpoint_limits = {}
+
+# maxlag parameter sent with the calls to the MediaWiki API of the Wikibase
+# instance (calls are delayed when the replication lag exceeds it). None to disable.
+upstream_maxlag = 5
+
+# Deadline (in seconds) of each call to an upstream endpoint, and number of
+# retries after a transient failure (server error, connection error or timeout),
+# made after a random delay of up to upstream_retry_delay * 2^n seconds
+upstream_timeout = 30
+upstream_retries = 2
+upstream_retry_delay = 0.1
+
+# Deadline (in seconds) of each SPARQL query, and number of retries after a
+# transient failure. Queries such as the one loading the property index are
+# expensive for the query service, so they are not retried by default (nor
+# when the query service throttles us).
+sparql_timeout = 60
+sparql_retries = 0
+
+# When at least this proportion of the last calls to an upstream endpoint failed,
+# no call is made to it for some time (in seconds), only serving cached data.
+upstream_circuit_window = 20
+upstream_circuit_failure_ratio = 0.5
+upstream_circuit_cooldown = 30
+
+# Deadline (in seconds) of the calls fetching items from the MediaWiki API,
+# and delay after which a slow call is duplicated (the first response is used).
+# None to disable these duplicate calls.
+item_fetch_timeout = 10
+item_fetch_hedge_delay = None
+
 # Previewing settings
 
 # Dimensions of the preview
@@ -153,6 +293,28 @@ sparql_query_to_fetch_unique_id_properties = """
 SELECT ?pid WHERE { ?pid wdt:P31/wdt:P279* wd:Q19847637 }
 """
 
+# Sparql query used to fetch all the properties with their datatype, labels,
+# descriptions and aliases (in the '$lang' language and in English), to suggest
+# properties without calling the API. Set to None to disable this index.
+sparql_query_to_fetch_properties = """
+SELECT ?pid ?type ?term ?termType WHERE {
+  ?pid wikibase:propertyType ?type .
+  OPTIONAL {
+    { ?pid rdfs:label ?term BIND("label" AS ?termType) }
+    UNION { ?pid schema:description ?term BIND("description" AS ?termType) }
+    UNION { ?pid skos:altLabel ?term BIND("alias" AS ?termType) }
+    FILTER(LANG(?term) IN ("$lang", "en"))
+  }
+}
+"""
+
+# Time (in seconds) after which the properties are fetched again
+property_index_refresh_interval = 24*60*60
+
+# Maximum number of languages for which the properties are kept in memory
+# (the least recently used ones are dropped first)
+property_index_max_languages = 50
+
 # Sparql query used to propose properties to fetch for items of a given class.
 # Set to None if property proposal should be disabled.
 sparql_query_to_propose_properties = """
@@ -4,7 +4,17 @@ def load_tests(loader, tests, ignore):
     from wdreconcile import subfields
     from wdreconcile import wikidatavalue
     from wdreconcile import sitelink
+    from wdreconcile import codec
+    from wdreconcile import metrics
+    from wdreconcile import searchcache
+    from wdreconcile import propertyindex
+    from wdreconcile import compression
     tests.addTests(doctest.DocTestSuite(subfields))
     tests.addTests(doctest.DocTestSuite(wikidatavalue))
     tests.addTests(doctest.DocTestSuite(sitelink))
+    tests.addTests(doctest.DocTestSuite(codec))
+    tests.addTests(doctest.DocTestSuite(metrics))
+    tests.addTests(doctest.DocTestSuite(searchcache))
+    tests.addTests(doctest.DocTestSuite(propertyindex))
+    tests.addTests(doctest.DocTestSuite(compression))
     return tests
@@ -21,9 +21,9 @@ async def test_get_qids(sitelink_fetcher, mocker, mock_aioresponse):
             raise ValueError(f'redirect call not mocked: {lang_code} {project} {titles}')
 
     # Mock HTTP calls
-    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&props=sitelinks&sites=dewiki&titles=Chelsea+Manning',
+    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&props=sitelinks&sites=dewiki&titles=Chelsea+Manning&maxlag=5',
         payload={'entities': {'Q298423': {'type': 'item', 'id': 'Q298423', 'sitelinks': {'dewiki': {'site': 'enwiki', 'title': 'Chelsea Manning', 'badges': []}}}}, 'success': 1})
-    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&props=sitelinks&sites=enwiki&titles=Knuth%E2%80%93Bendix+completion+algorithm',
+    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&props=sitelinks&sites=enwiki&titles=Knuth%E2%80%93Bendix+completion+algorithm&maxlag=5',
         payload={'entities': {'Q2835803': {'type': 'item', 'id': 'Q2835803', 'sitelinks': {'enwiki': {'site': 'enwiki', 'title': 'Knuth–Bendix completion algorithm', 'badges': []}}}}, 'success': 1})
 
     sitelink_fetcher.resolve_redirects_for_titles = mocked_resolve_redirects
@@ -0,0 +1,99 @@
+import gzip
+import json
+import pytest
+from quart import Response
+
+from app import app
+
+pytestmark = pytest.mark.asyncio
+
+@pytest.fixture
+async def client(redis_client, mock_aioresponse, mocker):
+    # no upstream calls are made: the default type is named without the API
+    mocker.patch('wdreconcile.itemstore.ItemStore.get_label', return_value='entity')
+    mocker.patch('wdreconcile.propertyindex.PropertyIndex.get', return_value=None)
+    async with app.test_app():
+        await app.manifest_task
+        yield app.test_client()
+
+async def test_manifest_is_cacheable(client):
+    response = await client.get('/en/api')
+    assert response.status_code == 200
+    assert response.cache_control.public
+    assert response.cache_control.max_age > 0
+    etag = response.headers['ETag']
+
+    not_modified = await client.get('/en/api', headers={'If-None-Match': etag})
+    assert not_modified.status_code == 304
+    assert await not_modified.get_data() == b''
+
+async def test_queries_are_not_cacheable(client, mocker):
+    mocker.patch.object(app.reconcile, 'process_queries', return_value={'q0': {'result': []}})
+    queries = json.dumps({'q0': {'query': 'Douglas Adams'}})
+    response = await client.get('/en/api', query_string={'queries': queries, 'timing': 'true'})
+    assert response.status_code == 200
+    assert 'q0' in json.loads(await response.get_data())
+    assert 'ETag' not in response.headers
+    assert 'Cache-Control' not in response.headers
+
+async def test_stream_reads_queries_as_they_arrive(client, mocker):
+    async def stream_queries(queries, **kwargs):
+        async for query_id, query in queries:
+            yield query_id, {'result': [query['query']]}
+    mocker.patch.object(app.reconcile, 'stream_queries', stream_queries)
+
+    async with client.request('/en/api/stream', method='POST') as connection:
+        # the first query is answered before the end of the body is sent
+        await connection.send(b'{"id": "a", "query": "Douglas')
+        await connection.send(b' Adams"}\nBerl')
+        assert json.loads(await connection.receive()) == {'id': 'a', 'result': ['Douglas Adams']}
+        await connection.send(b'in\n')
+        await connection.send_complete()
+        # lines without an id are numbered
+        assert json.loads(await connection.receive()) == {'id': '1', 'result': ['Berlin']}
+
+async def test_preview_validated_by_revision(client, mocker):
+    item = {'id': 'Q1', 'labels': {'en': 'universe'}, 'lastrevid': 1}
+    mocker.patch.object(app.suggest.store, 'get_items', side_effect=lambda ids: {'Q1': item})
+    mocker.patch.object(app.suggest.store, 'get_item', return_value=item)
+    render = mocker.patch.object(app.suggest, 'cached_preview', return_value='<p>universe</p>')
+    response = await client.get('/en/preview', query_string={'id': 'Q1'})
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+
+    # the preview is not rendered again for the same revision
+    not_modified = await client.get('/en/preview', query_string={'id': 'Q1'}, headers={'If-None-Match': etag})
+    assert not_modified.status_code == 304
+    assert not_modified.headers['ETag'] == etag
+    assert render.call_count == 1
+
+    item['lastrevid'] = 2
+    modified = await client.get('/en/preview', query_string={'id': 'Q1'}, headers={'If-None-Match': etag})
+    assert modified.status_code == 200
+    assert modified.headers['ETag'] != etag
+    assert render.call_count == 2
+
+async def test_compression(client, mocker):
+    large = {'type': 'Q5', 'properties': [{'id': 'P%d' % i, 'name': 'property'} for i in range(200)]}
+    propose = mocker.patch.object(app.suggest, 'propose_properties', return_value=large)
+    response = await client.get('/en/propose_properties', query_string={'type': 'Q5'},
+            headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    # the compressed representation has its own, weak, ETag
+    assert response.headers['ETag'].startswith('W/')
+    assert json.loads(gzip.decompress(await response.get_data())) == large
+
+    # small responses are not compressed
+    propose.return_value = {'type': 'Q5', 'properties': []}
+    response = await client.get('/en/propose_properties', query_string={'type': 'Q5'},
+            headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    assert json.loads(await response.get_data()) == propose.return_value
+
+    # nor are responses which are already encoded
+    encoded = gzip.compress(json.dumps(large).encode('utf-8'))
+    propose.return_value = Response(encoded, headers={'Content-Encoding': 'gzip'})
+    response = await client.get('/en/propose_properties', query_string={'type': 'Q5'},
+            headers={'Accept-Encoding': 'gzip'})
+    assert await response.get_data() == encoded
@@ -0,0 +1,58 @@
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from benchmarks.fixtures import FixtureWikibase, StubSession, synthetic_corpus
+from benchmarks.run import Benchmark, benchmark_redis_client, scenarios
+from benchmarks.standin import make_app
+from config import redis_key_prefix
+from wdreconcile.propertyindex import PropertyIndex
+from wdreconcile.suggest import SuggestEngine
+
+pytestmark = pytest.mark.asyncio
+
+@pytest.fixture
+def wikibase():
+    return FixtureWikibase(*synthetic_corpus(20))
+
+async def test_standin(wikibase):
+    async with TestClient(TestServer(make_app(wikibase))) as client:
+        response = await client.get('/w/api.php', params={'action': 'wbgetentities', 'ids': 'Q1000000', 'format': 'json'})
+        assert (await response.json())['entities']['Q1000000']['id'] == 'Q1000000'
+        response = await client.post('/sparql', data={'query': 'SELECT ?child WHERE { ?child wdt:P279* wd:Q515 }'})
+        children = [b['child']['value'] for b in (await response.json())['results']['bindings']]
+        assert children == ['http://www.wikidata.org/entity/Q515', 'http://www.wikidata.org/entity/Q1549591']
+
+async def test_propose_properties(redis_client, wikibase):
+    suggest = SuggestEngine(redis_client, StubSession(wikibase))
+    result = await suggest.propose_properties({'type': 'Q1549591', 'lang': 'en'})
+    # properties of the superclasses of the type, the closest first
+    assert [p['id'] for p in result['properties']] == ['P17', 'P571', 'P31']
+    assert result['properties'][0]['name'] == 'country'
+
+async def test_property_index(wikibase):
+    index = await PropertyIndex(StubSession(wikibase)).load('en')
+    assert index.label('P214') == 'VIAF ID'
+    assert index.properties['P214']['datatype'] == 'ExternalId'
+    assert [p['id'] for p in index.search('viaf', 10)] == ['P214']
+
+async def test_runner(redis_client, wikibase):
+    wikibase.build_indices('en')
+    # the keys of the service are not deleted
+    with pytest.raises(ValueError):
+        Benchmark(redis_client, StubSession(wikibase), wikibase)
+    with pytest.raises(ValueError):
+        benchmark_redis_client(0)
+    await redis_client.set(redis_key_prefix+'service_key', 'value')
+
+    benchmark_redis = benchmark_redis_client(15)
+    try:
+        benchmark = Benchmark(benchmark_redis, StubSession(wikibase), wikibase)
+        for scenario in scenarios:
+            stats = await benchmark.run(scenario, 2, 1, False)
+            assert stats['scenario'] == scenario
+            assert stats['queries_per_second'] > 0
+            assert stats['upstream_calls'] > 0
+        await benchmark.clear_redis()
+    finally:
+        await benchmark_redis.close()
+    assert await redis_client.get(redis_key_prefix+'service_key') == 'value'
@@ -0,0 +1,51 @@
+import time
+
+from wdreconcile.cache import LRUCache
+
+def test_get_set():
+    cache = LRUCache(max_entries=10)
+    assert cache.get('Q1') is None
+    cache.set('Q1', {'id':'Q1'})
+    assert cache.get('Q1') == {'id':'Q1'}
+    assert 'Q1' in cache
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+def test_evict_least_recently_used():
+    cache = LRUCache(max_entries=2)
+    cache.set('Q1', 1)
+    cache.set('Q2', 2)
+    cache.get('Q1')
+    cache.set('Q3', 3)
+    assert 'Q1' in cache
+    assert 'Q2' not in cache
+    assert len(cache) == 2
+
+def test_evict_by_size():
+    cache = LRUCache(max_entries=10, max_bytes=100)
+    cache.set('Q1', 1, size=60)
+    cache.set('Q2', 2, size=30)
+    cache.set('Q3', 3, size=30)
+    assert 'Q1' not in cache
+    assert cache.total_bytes == 60
+    cache.pop('Q2')
+    assert cache.total_bytes == 30
+
+def test_expiry():
+    cache = LRUCache(ttl=0.01)
+    cache.set('Q1', 1)
+    cache.set('Q2', 2, ttl=60)
+    time.sleep(0.02)
+    assert cache.get('Q1') is None
+    assert cache.get('Q2') == 2
+    assert cache.total_bytes == 1
+
+def test_stale_entries():
+    cache = LRUCache(ttl=0.01, stale_ttl=60)
+    cache.set('Q1', 1)
+    time.sleep(0.02)
+    # expired entries are still available as stale entries
+    assert cache.get('Q1') is None
+    assert cache.lookup('Q1') == (1, True)
+    cache.set('Q1', 2)
+    assert cache.lookup('Q1') == (2, False)
@@ -0,0 +1,81 @@
+import pytest
+import json
+import os
+
+from wdreconcile.codec import CodecRegistry, JSONCodec, make_codec, make_json_library
+
+@pytest.fixture
+def item():
+    datapath = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'entities', 'Q30.json')
+    with open(datapath, 'r') as f:
+        return json.load(f)
+
+@pytest.mark.parametrize('name', ['json', 'msgpack', 'msgpack+zstd'])
+def test_roundtrip(name, item):
+    if name != 'json':
+        pytest.importorskip('msgpack')
+        pytest.importorskip('zstandard')
+    registry = CodecRegistry(make_codec(name))
+    encoded = registry.encode(item)
+    assert registry.decode(encoded) == item
+
+def test_compression(item):
+    pytest.importorskip('msgpack')
+    pytest.importorskip('zstandard')
+    assert len(make_codec('msgpack+zstd').encode(item)) < len(json.dumps(item)) / 3
+
+def test_values_are_raw_bytes(item):
+    pytest.importorskip('msgpack')
+    encoded = make_codec('msgpack').encode(item)
+    assert isinstance(encoded, bytes)
+    # not inflated by a text encoding such as base64
+    assert len(encoded) < len(make_codec('json').encode(item))
+
+def test_read_legacy_json(item):
+    pytest.importorskip('msgpack')
+    registry = CodecRegistry(make_codec('msgpack'))
+    assert registry.decode(json.dumps(item).encode('utf-8')) == item
+
+def test_invalid_value():
+    registry = CodecRegistry(JSONCodec())
+    with pytest.raises(ValueError):
+        registry.decode(b'm2:garbage')
+    with pytest.raises(ValueError):
+        registry.decode(b'not json')
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        make_codec('pickle')
+
+def test_trained_dictionary(item, tmp_path):
+    pytest.importorskip('msgpack')
+    pytest.importorskip('zstandard')
+    from wdreconcile.codec import MsgpackZstdCodec
+    entities_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'entities')
+    samples = []
+    for fname in sorted(os.listdir(entities_dir))[:200]:
+        with open(os.path.join(entities_dir, fname), 'r') as f:
+            sample = json.load(f)
+            if sample:
+                samples.append(sample)
+    dictionary_path = tmp_path / 'items.dict'
+    dictionary_path.write_bytes(MsgpackZstdCodec.train_dictionary(samples, size=16384))
+
+    registry = CodecRegistry(make_codec('msgpack+zstd', zstd_dictionary_path=str(dictionary_path)))
+    assert registry.decode(registry.encode(item)) == item
+    # values compressed with a dictionary cannot be read without it
+    with pytest.raises(ValueError):
+        CodecRegistry(make_codec('msgpack+zstd')).decode(registry.encode(item))
+
+@pytest.mark.parametrize('name', ['json', 'orjson'])
+def test_json_library(name, item):
+    if name == 'orjson':
+        pytest.importorskip('orjson')
+    library = make_json_library(name)
+    assert library.loads(library.dumps(item)) == item
+    # non-string keys are converted, as with the standard library
+    assert library.loads(library.dumps({1: 'Q42'})) == {'1': 'Q42'}
+    with pytest.raises(ValueError):
+        library.loads('not json')
+    with pytest.raises(ValueError):
+        make_json_library('simplejson')
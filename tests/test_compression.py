@@ -0,0 +1,20 @@
+import gzip
+import pytest
+
+from wdreconcile.compression import compress, encodings
+
+def test_gzip():
+    data = b'{"id": "Q42", "name": "Douglas Adams"}' * 100
+    compressed = compress(data, 'gzip')
+    assert len(compressed) < len(data) / 10
+    assert gzip.decompress(compressed) == data
+
+def test_brotli():
+    brotli = pytest.importorskip('brotli')
+    data = b'{"id": "Q42", "name": "Douglas Adams"}' * 100
+    assert encodings[0] == 'br'
+    assert brotli.decompress(compress(data, 'br')) == data
+
+def test_unsupported_encoding():
+    with pytest.raises(ValueError):
+        compress(b'Q42', 'deflate')
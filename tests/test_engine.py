@@ -1,5 +1,11 @@
 import pytest
 import json
+import asyncio
+
+from wdreconcile.engine import ReconcileEngine
+from wdreconcile.suggest import SuggestEngine
+from wdreconcile.metrics import Timing
+from wdreconcile.itemstore import item_cache_ttl
 
 pytestmark = pytest.mark.asyncio
 
@@ -299,3 +305,67 @@ async def test_fetch_years(engine, mock_aioresponse):
             ]
 
         })
+
+async def test_shared_item_store(redis_client, http_session, item_store_stub):
+    shared = ReconcileEngine(redis_client, http_session, item_store=item_store_stub)
+    suggest = SuggestEngine(redis_client, http_session, item_store=item_store_stub)
+    assert shared.item_store is item_store_stub
+    assert suggest.store is item_store_stub
+    assert shared.pf.item_store is item_store_stub
+    # the items fetched for suggestions expire after the configured time
+    assert suggest.store.ttl == item_cache_ttl
+
+async def test_stream_queries(engine):
+    queries = [
+        ('q0', {'query':'Recumbent bicycle'}),
+        ('q1', {'query':'United States', 'type':'Q6256'}),
+        ('q2', {'query':'GER', 'type':'Q6256'}),
+        ('q3', {'type':'Q6256'}),
+    ]
+    results = {}
+    async for query_id, result in engine.stream_queries(iter(queries), chunk_size=1, max_chunks=2):
+        results[query_id] = result
+    assert sorted(results) == ['q0', 'q1', 'q2', 'q3']
+    assert results['q0']['result'][0]['id'] == 'Q750483'
+    assert results['q1']['result'][0]['id'] == 'Q30'
+    assert results['q2']['result'][0]['id'] == 'Q183'
+    assert 'error' in results['q3']
+
+async def test_stage_timing(engine):
+    timing = Timing()
+    await engine.process_queries({
+        'q0': {'query':'Recumbent bicycle'},
+        'q1': {'query':'United States', 'type':'Q6256'},
+    }, timing=timing)
+    stages = timing.as_dict()
+    assert list(stages) == ['prepare_properties', 'unique_ids', 'sitelinks', 'search', 'prefetch', 'ranking']
+    assert all(stage['time'] >= 0 for stage in stages.values())
+
+async def test_concurrent_ranking(engine, mocker):
+    mocker.patch('wdreconcile.engine.ranking_concurrency', 2)
+    queries = {'q%d' % i: {'query': 'query %d' % i} for i in range(6)}
+    mocker.patch.object(engine, '_fetch_candidates', return_value={query_id: [] for query_id in queries})
+    running = []
+    max_running = 0
+    async def rank_items(query, ids, default_language):
+        nonlocal max_running
+        running.append(query['query'])
+        max_running = max(max_running, len(running))
+        # the first queries take longer to rank
+        await asyncio.sleep(0.001 * (6 - int(query['query'][-1])))
+        running.remove(query['query'])
+        return [{'id': query['query']}]
+    mocker.patch.object(engine, '_rank_items', side_effect=rank_items)
+    results = await engine.process_queries(queries)
+    assert max_running == 2
+    # in the order of the queries
+    assert list(results) == list(queries)
+    assert [result['result'][0]['id'] for result in results.values()] == ['query %d' % i for i in range(6)]
+
+async def test_fetch_properties_by_batch_fetches_items_at_once(engine, mocker):
+    fetch = mocker.spy(engine.item_store, '_fetch_items')
+    result = await engine.fetch_properties_by_batch({"lang":"en","extend":{"ids":["Q34433","Q83259","Q142"],
+                            "properties":[{"id":"P17"},{"id":"P17/P297"},{"id":"P2427"}]}})
+    assert result['rows']['Q83259']['P17'] == [{'id': 'Q142', 'name': 'France'}]
+    # the items, the countries (values of P17, apart from Q142 itself) and the properties
+    assert [len(call.args[0]) for call in fetch.call_args_list] == [3, 1, 2]
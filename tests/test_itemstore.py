@@ -1,10 +1,13 @@
 import pytest
 import re
+import asyncio
+import aiohttp
+from aioresponses import CallbackResult
 
 pytestmark = pytest.mark.asyncio
 
 async def test_label(item_store, mock_aioresponse):
-    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&ids=Q3918&props=aliases%7Clabels%7Cdescriptions%7Cclaims%7Csitelinks',
+    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&ids=Q3918&props=aliases%7Clabels%7Cdescriptions%7Cclaims%7Csitelinks&maxlag=5',
         payload={
         "entities": {
         "Q3918": {
@@ -20,7 +23,7 @@ async def test_label(item_store, mock_aioresponse):
     assert label == 'university'
 
 async def test_label_fallback(item_store, mock_aioresponse):
-    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&ids=Q3578062&props=aliases%7Clabels%7Cdescriptions%7Cclaims%7Csitelinks',
+    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&ids=Q3578062&props=aliases%7Clabels%7Cdescriptions%7Cclaims%7Csitelinks&maxlag=5',
         payload={
         "entities": {
         "Q3578062": {
@@ -37,7 +40,7 @@ async def test_label_fallback(item_store, mock_aioresponse):
     assert label == "Escola Nacional d'Administració"
 
 async def test_description_fallback(item_store, mock_aioresponse):
-    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&ids=Q3578062&props=aliases%7Clabels%7Cdescriptions%7Cclaims%7Csitelinks',
+    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&ids=Q3578062&props=aliases%7Clabels%7Cdescriptions%7Cclaims%7Csitelinks&maxlag=5',
         payload={
         "entities": {
         "Q3578062": {
@@ -64,3 +67,109 @@ async def test_preferred_rank(item_store_stub):
     assert item['P38'][0]['mainsnak']['datavalue']['value']['id'] == 'Q259502'
 
 
+
+async def test_cache_tiers(item_store_stub, mocker):
+    fetch = mocker.spy(item_store_stub, '_fetch_items')
+    await item_store_stub.get_items(['Q408', 'Q30'])
+    assert fetch.call_count == 1
+
+    # served from the in-process cache
+    await item_store_stub.get_item('Q408')
+    assert item_store_stub.cache_stats()['local']['hits'] == 1
+    assert item_store_stub.cache_stats()['redis']['hits'] == 0
+
+    # served from Redis, without fetching anything
+    item_store_stub.local_cache.clear()
+    item = await item_store_stub.get_item('Q408')
+    assert item['id'] == 'Q408'
+    assert fetch.call_count == 1
+    assert item_store_stub.cache_stats()['redis']['hits'] == 1
+    assert 'Q408' in item_store_stub.local_cache
+
+async def test_concurrent_fetches_are_coalesced(item_store_stub, mocker):
+    original_fetch = item_store_stub._fetch_items
+    async def slow_fetch(qids):
+        await asyncio.sleep(0.05)
+        return await original_fetch(qids)
+    fetch = mocker.patch.object(item_store_stub, '_fetch_items', side_effect=slow_fetch)
+    results = await asyncio.gather(
+        item_store_stub.get_items(['Q30', 'Q142']),
+        item_store_stub.get_items(['Q142', 'Q5']),
+        item_store_stub.get_item('Q30'),
+    )
+    fetched_qids = [qid for call in fetch.call_args_list for qid in call.args[0]]
+    assert sorted(fetched_qids) == ['Q142', 'Q30', 'Q5']
+    assert results[1]['Q142']['id'] == 'Q142'
+    assert results[2]['id'] == 'Q30'
+    assert not item_store_stub.inflight
+
+async def test_single_item_requests_are_batched(item_store_stub, mocker):
+    fetch = mocker.spy(item_store_stub, '_fetch_items')
+    items = await asyncio.gather(*[
+        item_store_stub.get_item(qid)
+        for qid in ['Q30', 'Q142', 'Q5', 'Q30']
+    ])
+    assert [item['id'] for item in items] == ['Q30', 'Q142', 'Q5', 'Q30']
+    assert fetch.call_count == 1
+    assert sorted(fetch.call_args.args[0]) == ['Q142', 'Q30', 'Q5']
+    assert not item_store_stub.pending_batch
+
+async def test_items_are_stored_with_expiration(item_store_stub, redis_client):
+    await item_store_stub.get_items(['Q30', 'Q142'])
+    for qid in ['Q30', 'Q142']:
+        ttl = await redis_client.ttl(item_store_stub._key_for_qid(qid))
+        assert item_store_stub.ttl < ttl <= item_store_stub.ttl + item_store_stub.stale_ttl
+
+async def test_unreadable_cache_entry(item_store_stub, redis_client):
+    await redis_client.set(item_store_stub._key_for_qid('Q30'), b'z2:corrupted')
+    item = await item_store_stub.get_item('Q30')
+    assert item['id'] == 'Q30'
+
+async def test_batch_splitting(item_store, mock_aioresponse):
+    fetched_batches = []
+    def wbgetentities(url, params=None, **kwargs):
+        ids = params['ids'].split('|')
+        fetched_batches.append(ids)
+        if 'Qfoo' in ids:
+            return CallbackResult(payload={'error': {'code': 'no-such-entity', 'info': 'Could not find an entity with the ID "Qfoo"'}})
+        return CallbackResult(payload={'entities': {qid: {'id': qid, 'labels': {}} for qid in ids}})
+    mock_aioresponse.get(re.compile(r'https://www\.wikidata\.org/w/api\.php\?action=wbgetentities.*'),
+        callback=wbgetentities, repeat=True)
+    # the invalid id does not prevent the other items from being fetched (and cached)
+    items = await item_store.get_items(['Q1', 'Qfoo', 'Q2', 'Q3'])
+    assert set(items.keys()) == {'Q1', 'Q2', 'Q3'}
+    assert await item_store.r.get(item_store._key_for_qid('Q2'))
+    assert len(fetched_batches) == 5
+
+async def test_throttled_batch_is_not_split(item_store, mock_aioresponse):
+    calls = []
+    def wbgetentities(url, params=None, **kwargs):
+        calls.append(params['ids'])
+        return CallbackResult(status=429, headers={'Retry-After': '0'})
+    mock_aioresponse.get(re.compile(r'https://www\.wikidata\.org/w/api\.php\?action=wbgetentities.*'),
+        callback=wbgetentities, repeat=True)
+    with pytest.raises(aiohttp.ClientResponseError):
+        await item_store.get_items(['Q%d' % i for i in range(1, 17)])
+    # the whole batch was retried (with the default max_attempts), never split
+    assert len(calls) <= 5
+    assert all(len(ids.split('|')) == 16 for ids in calls)
+
+async def test_retry_server_errors(item_store, mock_aioresponse):
+    url = 'https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&ids=Q1&props=aliases%7Clabels%7Cdescriptions%7Cclaims%7Csitelinks&maxlag=5'
+    mock_aioresponse.get(url, status=502)
+    mock_aioresponse.get(url, payload={'entities': {'Q1': {'id': 'Q1', 'labels': {}}}})
+    item = await item_store.get_item('Q1')
+    assert item['id'] == 'Q1'
+
+async def test_stale_items_are_served(item_store_stub, mocker):
+    await item_store_stub.get_items(['Q30'])
+    # simulate the expiration of the item in both tiers
+    await item_store_stub.r.expire(item_store_stub._key_for_qid('Q30'), item_store_stub.stale_ttl - 10)
+    item_store_stub.local_cache.clear()
+    fetch = mocker.spy(item_store_stub, '_fetch_items')
+    item = await item_store_stub.get_item('Q30')
+    assert item['id'] == 'Q30'
+    # the item is refreshed in the background
+    await asyncio.gather(*item_store_stub.revalidator.tasks)
+    assert fetch.call_count == 1
+    assert await item_store_stub.r.ttl(item_store_stub._key_for_qid('Q30')) > item_store_stub.stale_ttl
@@ -0,0 +1,50 @@
+import pytest
+
+from wdreconcile.jobs import JobQueue
+
+pytestmark = pytest.mark.asyncio
+
+@pytest.fixture
+def job_queue(redis_client, engine):
+    return JobQueue(redis_client, engine, chunk_size=2)
+
+queries = {
+    'q0': {'query':'Recumbent bicycle'},
+    'q1': {'query':'United States', 'type':'Q6256'},
+    'q2': {'query':'GER', 'type':'Q6256'},
+}
+
+async def test_process_job(job_queue):
+    status = await job_queue.submit(queries, 'en')
+    assert status['status'] == 'queued'
+    assert status['chunks'] == 2
+
+    assert await job_queue.work_once()
+    results = await job_queue.results(status['id'])
+    assert sorted(results['results']) == ['q0', 'q1']
+    assert results['next_chunk'] == 1
+    assert not results['complete']
+
+    assert await job_queue.work_once()
+    assert not await job_queue.work_once()
+    results = await job_queue.results(status['id'], start=results['next_chunk'])
+    assert results['results']['q2']['result'][0]['id'] == 'Q183'
+    assert results['complete']
+    assert (await job_queue.status(status['id']))['status'] == 'done'
+
+async def test_expired_lease(job_queue, redis_client):
+    status = await job_queue.submit({'q0': queries['q0']}, 'en')
+    # a worker takes the chunk and dies
+    await redis_client.eval(
+        'local t = redis.call("RPOP", KEYS[1]); redis.call("ZADD", KEYS[2], ARGV[1], t); return t',
+        2, job_queue.pending_key, job_queue.leases_key, 0)
+    assert not await job_queue.work_once()
+
+    assert await job_queue.requeue_expired() == 1
+    assert await job_queue.work_once()
+    results = await job_queue.results(status['id'])
+    assert results['results']['q0']['result'][0]['id'] == 'Q750483'
+
+async def test_unknown_job(job_queue):
+    with pytest.raises(ValueError):
+        await job_queue.status('1234')
@@ -0,0 +1,46 @@
+from wdreconcile.cache import LRUCache
+from wdreconcile.metrics import Registry, cache_requests, upstream_call, upstream_requests
+
+def test_counter_exposition():
+    registry = Registry()
+    counter = registry.counter('calls_total', 'Number of calls', ['action'])
+    counter.inc(action='sparql')
+    counter.inc(2, action='sparql')
+    assert counter.get(action='sparql') == 3
+    assert 'calls_total{action="sparql"} 3' in registry.expose()
+
+def test_histogram_exposition():
+    registry = Registry()
+    histogram = registry.histogram('latency_seconds', 'Latency', ['route'], buckets=(0.1, 1))
+    histogram.observe(0.05, route='/api')
+    histogram.observe(0.5, route='/api')
+    lines = registry.expose().split('\n')
+    assert 'latency_seconds_bucket{route="/api",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{route="/api",le="1"} 2' in lines
+    assert 'latency_seconds_bucket{route="/api",le="+Inf"} 2' in lines
+    assert 'latency_seconds_count{route="/api"} 2' in lines
+    assert 'latency_seconds_sum{route="/api"} 0.55' in lines
+
+def test_label_escaping():
+    registry = Registry()
+    gauge = registry.gauge('in_progress', 'In progress', ['route'])
+    gauge.inc(route='/"quoted"')
+    gauge.dec(route='/"quoted"')
+    assert 'in_progress{route="/\\"quoted\\""} 0' in registry.expose()
+
+def test_upstream_call_failure():
+    before = upstream_requests.get(action='test', outcome='error')
+    try:
+        with upstream_call('test'):
+            raise ValueError('unavailable')
+    except ValueError:
+        pass
+    assert upstream_requests.get(action='test', outcome='error') == before + 1
+
+def test_named_cache_lookups():
+    cache = LRUCache(name='test')
+    cache.set('Q1', 1)
+    cache.get('Q1')
+    cache.get('Q2')
+    assert cache_requests.get(cache='test', tier='local', result='hit') == 1
+    assert cache_requests.get(cache='test', tier='local', result='miss') == 1
@@ -0,0 +1,93 @@
+import pytest
+
+from wdreconcile.propertyindex import LanguageIndex, PropertyIndex
+from wdreconcile.suggest import SuggestEngine
+
+pytestmark = pytest.mark.asyncio
+
+def binding(pid, term=None, term_type=None, lang='en', datatype='WikibaseItem'):
+    result = {
+        'pid': {'value': 'http://www.wikidata.org/entity/'+pid},
+        'type': {'value': 'http://wikiba.se/ontology#'+datatype},
+    }
+    if term:
+        result['term'] = {'value': term, 'xml:lang': lang}
+        result['termType'] = {'value': term_type}
+    return result
+
+sparql_results = {'results': {'bindings': [
+    binding('P17', 'country', 'label'),
+    binding('P17', 'pays', 'label', lang='fr'),
+    binding('P17', 'sovereign state of this item', 'description'),
+    binding('P17', 'state', 'alias'),
+    binding('P3500', 'Ringgold ID', 'label', datatype='ExternalId'),
+    binding('P3500', 'Ringgold identifier', 'alias', datatype='ExternalId'),
+    binding('P495', 'country of origin', 'label'),
+    binding('P1448', 'official name', 'label'),
+    binding('P9999'),
+]}}
+
+@pytest.fixture
+def properties():
+    return {
+        'P17': {'labels': {'en': 'country', 'fr': 'pays'}, 'descriptions': {'en': 'sovereign state of this item'},
+                'terms': {'country', 'pays', 'state'}, 'datatype': 'WikibaseItem'},
+        'P495': {'labels': {'en': 'country of origin'}, 'descriptions': {},
+                 'terms': {'country of origin'}, 'datatype': 'WikibaseItem'},
+        'P3500': {'labels': {'en': 'Ringgold ID'}, 'descriptions': {},
+                  'terms': {'Ringgold ID', 'Ringgold identifier'}, 'datatype': 'ExternalId'},
+        'P1448': {'labels': {'en': 'official name'}, 'descriptions': {},
+                  'terms': {'official name'}, 'datatype': 'Monolingualtext'},
+    }
+
+def test_search(properties):
+    index = LanguageIndex(properties, 'en')
+    assert [p['id'] for p in index.search('Country', 10)] == ['P17', 'P495']
+    assert [p['id'] for p in index.search('coun', 10)] == ['P17', 'P495']
+    # aliases, words and substrings
+    assert [p['id'] for p in index.search('ringgold identifier', 10)] == ['P3500']
+    assert [p['id'] for p in index.search('origin', 10)] == ['P495']
+    assert [p['id'] for p in index.search('ficial', 10)] == ['P1448']
+    # property ids
+    assert [p['id'] for p in index.search('p3500', 10)] == ['P3500']
+    assert index.search('country', 1)[0]['description'] == 'sovereign state of this item'
+    assert index.search('', 10) == []
+
+def test_language_fallback(properties):
+    index = LanguageIndex(properties, 'fr')
+    assert index.label('P17') == 'pays'
+    assert index.label('P495') == 'country of origin'
+    assert index.label('P1') is None
+    assert [p['id'] for p in index.search('pay', 10)] == ['P17']
+
+async def test_load(http_session, mock_aioresponse):
+    mock_aioresponse.post('https://query.wikidata.org/sparql?format=json', payload=sparql_results)
+    property_index = PropertyIndex(http_session)
+    index = await property_index.load('fr')
+    assert index.label('P17') == 'pays'
+    assert index.properties['P3500']['datatype'] == 'ExternalId'
+    assert index.label('P9999') == 'P9999'
+    assert property_index.get('fr') is index
+    # invalid languages are not loaded
+    assert property_index.get('fr"}') is None
+
+async def test_bounded_languages(http_session, mock_aioresponse):
+    mock_aioresponse.post('https://query.wikidata.org/sparql?format=json', payload=sparql_results, repeat=True)
+    property_index = PropertyIndex(http_session, max_languages=1)
+    # no property has any term in this language
+    assert await property_index.load('xx') is None
+    assert await property_index.load('fr') is not None
+    assert await property_index.load('en') is not None
+    # the least recently used index was dropped
+    assert 'fr' not in property_index.languages
+    assert len(property_index.languages) == 1
+
+async def test_suggest_property(redis_client, http_session, item_store_stub, mock_aioresponse):
+    mock_aioresponse.post('https://query.wikidata.org/sparql?format=json', payload=sparql_results)
+    property_index = PropertyIndex(http_session)
+    await property_index.load('en')
+    suggest = SuggestEngine(redis_client, http_session, item_store=item_store_stub, property_index=property_index)
+    # answered without calling wbsearchentities
+    result = (await suggest.find_property({'prefix': 'Ringg', 'lang': 'en'}))['result']
+    assert result == [{'id': 'P3500', 'name': 'Ringgold ID', 'description': None}]
+    assert await suggest.ft.parse('P17').readable_name('en') == 'country'
@@ -36,6 +36,10 @@ def test_parse(property_factory):
     for sample in samples:
         assert str(property_factory.parse(sample)) == sample
 
+def test_parse_is_memoized(property_factory):
+    assert property_factory.parse('P17/P297') is property_factory.parse('P17/P297')
+    assert property_factory.parse('P17') is not property_factory.parse('P297')
+
 def test_invalid_expression(property_factory):
     with pytest.raises(ValueError):
         property_factory.parse('P') # lexing error
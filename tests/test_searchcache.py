@@ -0,0 +1,47 @@
+import pytest
+import asyncio
+
+from wdreconcile.searchcache import SearchCache
+
+pytestmark = pytest.mark.asyncio
+
+@pytest.fixture
+def search_cache(redis_client):
+    return SearchCache(redis_client)
+
+async def test_cached_search(search_cache):
+    calls = []
+    async def fetch():
+        calls.append(1)
+        return ['Q90']
+    assert await search_cache.get('search', 'Paris', 'en', 0, 10, fetch) == ['Q90']
+    # the same search, after normalization
+    assert await search_cache.get('search', ' paris ', 'en', 0, 10, fetch) == ['Q90']
+    # also found in Redis by other processes
+    search_cache.local_cache.clear()
+    assert await search_cache.get('search', 'PARIS', 'en', 0, 10, fetch) == ['Q90']
+    assert len(calls) == 1
+    # other parameters make other searches
+    assert await search_cache.get('search', 'Paris', 'en', 0, 20, fetch) == ['Q90']
+    assert await search_cache.get('search', 'Paris', 'fr', 0, 10, fetch) == ['Q90']
+    assert len(calls) == 3
+
+async def test_negative_caching(search_cache, redis_client):
+    async def fetch():
+        return []
+    assert await search_cache.get('wbsearchentities', 'xyzzy', 'en', None, 10, fetch) == []
+    ttl = await redis_client.ttl(search_cache._key('wbsearchentities', 'xyzzy', 'en', None, 10))
+    assert 0 < ttl <= search_cache.negative_ttl
+
+async def test_concurrent_searches(search_cache):
+    calls = []
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return ['Q7259']
+    results = await asyncio.gather(*[
+        search_cache.get('search', 'Ada Lovelace', 'en', 0, 10, fetch)
+        for i in range(5)
+    ])
+    assert results == [['Q7259']] * 5
+    assert len(calls) == 1
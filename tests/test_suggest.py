@@ -1,8 +1,9 @@
+import asyncio
 import pytest
 import re
 from wdreconcile.suggest import SuggestEngine, commons_image_url
 
-from aiohttp import ServerTimeoutError
+from config import autodescribe_endpoint
 
 pytestmark = pytest.mark.asyncio
 
@@ -50,14 +51,18 @@ def propose(suggest_engine):
 # Tests start here
 
 async def test_exact(best_match_id, results, mock_aioresponse):
-    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbsearchentities&format=json&language=fr&search=V%C3%A9lo+couch%C3%A9&type=item&uselang=fr',
+    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbsearchentities&format=json&language=fr&search=V%C3%A9lo+couch%C3%A9&type=item&uselang=fr&limit=50&maxlag=5',
         payload={'searchinfo': {'search': 'Vélo couché'}, 'search': [{'id': 'Q750483', 'title': 'Q750483', 'pageid': 706158, 'repository': 'wikidata', 'url': '//www.wikidata.org/wiki/Q750483', 'concepturi': 'http://www.wikidata.org/entity/Q750483',
 'label': 'Vélo couché', 'description': 'Type of bicycle', 'match': {'type': 'label', 'language': 'fr', 'text': 'Vélo couché'}}, {'id': 'Q3564076', 'title': 'Q3564076', 'pageid': 3392974, 'repository': 'wikidata', 'url': '//www.wikidata.org/wiki/Q3564076',
 'concepturi': 'http://www.wikidata.org/entity/Q3564076', 'label': 'vélo couché à traction directe', 'description': 'type de vélo couché', 'match': {'type': 'label', 'language': 'fr', 'text': 'vélo couché à traction directe'}}], 'success': 1})
+    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&ids=Q750483%7CQ3564076&props=labels%7Caliases&languages=en%7Cfr&maxlag=5',
+        payload={'entities': {}, 'success': 1})
 
-    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbsearchentities&format=json&language=en&search=Ringgold+identifier&type=property&uselang=en',
+    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbsearchentities&format=json&language=en&search=Ringgold+identifier&type=property&uselang=en&limit=50&maxlag=5',
         payload={'searchinfo': {'search': 'Ringgold identifier'}, 'search': [{'id': 'P3500', 'title': 'Property:P3500', 'pageid': 30174486, 'repository': 'wikidata', 'url': '//www.wikidata.org/wiki/Property:P3500', 'datatype': 'external-id', 'concepturi':
 'http://www.wikidata.org/entity/P3500', 'label': 'Ringgold ID', 'description': 'identifier for organisations in the publishing industry supply chain', 'match': {'type': 'alias', 'language': 'en', 'text': 'Ringgold identifier'}, 'aliases': ['Ringgold identifier']}], 'success': 1})
+    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&ids=P3500&props=labels%7Caliases&languages=en&maxlag=5',
+        payload={'entities': {}, 'success': 1})
 
 
     item_results = await results('entity', 'Vélo couché', lang='fr')
@@ -72,17 +77,17 @@ async def test_exact(best_match_id, results, mock_aioresponse):
         'P3500')
 
 async def test_sparql(best_match_id, mock_aioresponse):
-    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbsearchentities&format=json&language=en&search=P17/P297&type=property&uselang=en',
+    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbsearchentities&format=json&language=en&search=P17/P297&type=property&uselang=en&limit=50&maxlag=5',
         payload={'success': 1, 'search': []})
-    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbsearchentities&format=json&language=en&search=P17/(P297%7C.)&type=property&uselang=en',
+    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbsearchentities&format=json&language=en&search=P17/(P297%7C.)&type=property&uselang=en&limit=50&maxlag=5',
         payload={'success': 1, 'search': []})
-    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbsearchentities&format=json&language=en&search=Len&type=property&uselang=en',
+    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbsearchentities&format=json&language=en&search=Len&type=property&uselang=en&limit=50&maxlag=5',
         payload={'success': 1, 'search': []})
-    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbsearchentities&format=json&language=en&search=Afr%7CLfr&type=property&uselang=en',
+    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbsearchentities&format=json&language=en&search=Afr%7CLfr&type=property&uselang=en&limit=50&maxlag=5',
         payload={'success': 1, 'search': []})
-    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbsearchentities&format=json&language=en&search=qid&type=property&uselang=en',
+    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbsearchentities&format=json&language=en&search=qid&type=property&uselang=en&limit=50&maxlag=5',
         payload={'success': 1, 'search': []})
-    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbsearchentities&format=json&language=en&search=SPARQL:+P17/P297&type=property&uselang=en',
+    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbsearchentities&format=json&language=en&search=SPARQL:+P17/P297&type=property&uselang=en&limit=50&maxlag=5',
         payload={'success': 1, 'search': []})
 
     assert (
@@ -105,7 +110,7 @@ async def test_sparql(best_match_id, mock_aioresponse):
         'qid')
 
 async def test_sparql_not_first_for_pid(results, mock_aioresponse):
-    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbsearchentities&format=json&language=en&search=P17&type=property&uselang=en',
+    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbsearchentities&format=json&language=en&search=P17&type=property&uselang=en&limit=50&maxlag=5',
         payload={'searchinfo': {'search': 'P17'}, 'search': [{'id': 'P17', 'title': 'Property:P17', 'pageid': 3917520, 'repository': 'wikidata', 'url': '//www.wikidata.org/wiki/Property:P17', 'datatype': 'wikibase-item', 'concepturi': 'http://www.wikidata.org/entity/P17', 'label': 'country', 'description': 'sovereign state of this item (not to be used for human beings)', 'match': {'type': 'entityId', 'text': 'P17'}, 'aliases': ['P17']}], 'success': 1})
 
     results = await results('property', 'P17', lang='en')
@@ -121,7 +126,7 @@ async def test_single_letter(preview, mock_aioresponse, test_app):
         assert ('È' in await preview(id='Q10008', lang='en'))
 
 async def test_preview_autodesc_down(preview, mock_aioresponse, test_app):
-    mock_aioresponse.get(re.compile(r'https://autodesc\.toolforge\.org/.*'), exception=ServerTimeoutError())
+    mock_aioresponse.get(re.compile(re.escape(autodescribe_endpoint)+'.*'), exception=asyncio.TimeoutError())
     async with test_app.app_context():
         assert ('\u53c2\u4e0e\u5546' in
             await preview(id='Q4830453', lang='zh'))
@@ -149,3 +154,80 @@ async def test_flyout(suggest_engine):
 def test_commons_url():
     assert (commons_image_url('Wikidata-logo-en.svg')).endswith('.png')
 
+
+async def test_prefix_refinement(results, mock_aioresponse):
+    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbsearchentities&format=json&language=en&search=Ring&type=property&uselang=en&limit=50&maxlag=5',
+        payload={'search': [
+            {'id': 'P3500', 'label': 'Ringgold ID', 'match': {'type': 'label', 'language': 'en', 'text': 'Ringgold ID'}},
+            {'id': 'P1545', 'label': 'series ordinal', 'match': {'type': 'alias', 'language': 'en', 'text': 'ring number'}, 'aliases': ['ring number']},
+        ], 'success': 1})
+    # the other labels and aliases of these complete results
+    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&ids=P3500%7CP1545&props=labels%7Caliases&languages=en&maxlag=5',
+        payload={'entities': {
+            'P3500': {'id': 'P3500', 'labels': {'en': {'language': 'en', 'value': 'Ringgold ID'}},
+                      'aliases': {'en': [{'language': 'en', 'value': 'Ringgold identifier'}]}},
+            'P1545': {'id': 'P1545', 'labels': {'en': {'language': 'en', 'value': 'series ordinal'}},
+                      'aliases': {'en': [{'language': 'en', 'value': 'ring number'}, {'language': 'en', 'value': 'ringgold index'}]}},
+        }, 'success': 1})
+    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbsearchentities&format=json&language=en&search=Ringg&type=item&uselang=en&limit=50&maxlag=5',
+        payload={'search': [{'id': 'Q1', 'label': 'Ringgold'}], 'search-continue': 1, 'success': 1})
+    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbsearchentities&format=json&language=en&search=Ringgo&type=item&uselang=en&limit=50&maxlag=5',
+        payload={'search': [{'id': 'Q2', 'label': 'Ringgold'}], 'success': 1})
+    mock_aioresponse.get('https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&ids=Q2&props=labels%7Caliases&languages=en&maxlag=5',
+        payload={'entities': {}, 'success': 1})
+
+    assert [r['id'] for r in await results('property', 'Ring')] == ['P3500', 'P1545']
+    # derived from the complete results for 'Ring', without calling the API:
+    # P1545 matches with an alias which was not returned for 'Ring'
+    assert [r['id'] for r in await results('property', 'ringg')] == ['P3500', 'P1545']
+    assert [r['id'] for r in await results('property', 'Ringgold ide')] == ['P3500']
+    assert [r['id'] for r in await results('property', 'Ring n')] == ['P1545']
+    # incomplete results are not refined
+    assert [r['id'] for r in await results('entity', 'Ringg')] == ['Q1']
+    assert [r['id'] for r in await results('entity', 'Ringgo')] == ['Q2']
+
+async def test_cached_flyout(suggest_engine, mock_aioresponse, mocker):
+    item = {'id': 'Q1', 'labels': {'en': 'universe'}, 'descriptions': {'en': 'universe'}, 'lastrevid': 1}
+    mocker.patch.object(suggest_engine.store, 'get_item', return_value=item)
+    autodesc = mocker.patch('wdreconcile.suggest.autodescribe', return_value='totality of space')
+    flyout = await suggest_engine.flyout({'id': 'Q1', 'lang': 'en'})
+    assert 'totality of space' in flyout['html']
+    assert (await suggest_engine.flyout({'id': 'Q1', 'lang': 'en'})) == flyout
+    assert autodesc.call_count == 1
+
+    # a new revision of the item is rendered again, with the cached description
+    item['lastrevid'] = 2
+    item['labels']['en'] = 'Universe'
+    assert (await suggest_engine.flyout({'id': 'Q1', 'lang': 'en'})) == flyout
+    assert autodesc.call_count == 1
+    # the description is fetched again in other languages
+    await suggest_engine.flyout({'id': 'Q1', 'lang': 'fr'})
+    assert autodesc.call_count == 2
+
+async def test_failed_autodesc_is_cached(suggest_engine, mock_aioresponse, redis_client):
+    mock_aioresponse.get(re.compile(re.escape(autodescribe_endpoint)+'.*'), exception=asyncio.TimeoutError())
+    item = {'id': 'Q1', 'descriptions': {'en': 'universe'}}
+    assert await suggest_engine.get_description(item, 'en') == 'universe'
+    # not requested again
+    assert await suggest_engine.get_description(item, 'en') == 'universe'
+    assert len(mock_aioresponse.requests) == 1
+    ttl = await redis_client.ttl(suggest_engine.description_cache._key('autodesc', 'Q1', 'en', None, None))
+    assert 0 < ttl <= suggest_engine.description_cache.negative_ttl
+
+async def test_preview_by_batch(suggest_engine, mock_aioresponse, test_app, mocker):
+    get_items = mocker.spy(suggest_engine.store, 'get_items')
+    async with test_app.app_context():
+        previews = (await suggest_engine.preview_by_batch({'ids': 'Q350|Q10008|Q350', 'lang': 'fr'}))['previews']
+    assert [preview['id'] for preview in previews] == ['Q350', 'Q10008']
+    assert 'ville' in previews[0]['html']
+    # all the items are fetched at once
+    assert get_items.call_count == 1
+
+async def test_flyout_by_batch(suggest_engine, mocker):
+    items = {'Q1': {'id': 'Q1', 'labels': {}, 'descriptions': {'en': 'universe'}, 'lastrevid': 1}}
+    mocker.patch.object(suggest_engine.store, 'get_items', return_value=items)
+    mocker.patch('wdreconcile.suggest.autodescribe', return_value='totality of space')
+    flyouts = (await suggest_engine.flyout_by_batch({'ids': 'Q1|Q404', 'lang': 'en'}))['flyouts']
+    assert 'totality of space' in flyouts[0]['html']
+    # entities which could not be fetched have no flyout
+    assert flyouts[1] == {'id': 'Q404', 'html': None}
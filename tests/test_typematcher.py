@@ -1,6 +1,7 @@
 
 import pytest
 import re
+import asyncio
 
 pytestmark = pytest.mark.asyncio
 
@@ -16,3 +17,31 @@ async def test_correctness(type_matcher, mock_aioresponse):
     assert not (await type_matcher.is_subclass('Q1234', 'Q43229'))
 
 
+
+async def test_stale_children(type_matcher, mocker):
+    fetch = mocker.patch.object(type_matcher, '_fetch_children', return_value=['Q3918', 'Q43229'])
+    assert (await type_matcher.is_subclass('Q3918', 'Q43229'))
+    await type_matcher.r.expire(type_matcher._key_name('Q43229'), 60)
+    type_matcher.local_cache.clear()
+    fetch.return_value = ['Q43229']
+    # the stale children are used while they are being refreshed
+    assert (await type_matcher.is_subclass('Q3918', 'Q43229'))
+    await asyncio.gather(*type_matcher.revalidator.tasks)
+    assert fetch.call_count == 2
+    assert not (await type_matcher.r.sismember(type_matcher._key_name('Q43229'), 'Q3918'))
+
+async def test_subclass_matrix(type_matcher, mocker):
+    children = {'Q43229': ['Q3918', 'Q43229'], 'Q5': ['Q5']}
+    fetch = mocker.patch.object(type_matcher, '_fetch_children', side_effect=lambda qid: children[qid])
+    matrix = await type_matcher.subclass_matrix({'Q3918', 'Q5', 'Q1234'}, ['Q43229', 'Q5'])
+    assert matrix == {
+        ('Q3918', 'Q43229'): True, ('Q5', 'Q43229'): False, ('Q1234', 'Q43229'): False,
+        ('Q3918', 'Q5'): False, ('Q5', 'Q5'): True, ('Q1234', 'Q5'): False,
+    }
+    # the children of each class are fetched once
+    assert fetch.call_count == 2
+    # the matrix is then computed in memory
+    sismember = mocker.spy(type_matcher.r, 'sismember')
+    assert (await type_matcher.subclass_matrix(['Q3918'], ['Q43229'])) == {('Q3918', 'Q43229'): True}
+    assert (await type_matcher.is_subclass('Q5', 'Q5'))
+    assert sismember.call_count == 0
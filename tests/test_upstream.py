@@ -0,0 +1,122 @@
+import pytest
+import asyncio
+
+import aiohttp
+
+from wdreconcile.upstream import AdaptiveLimiter, CircuitBreaker, UpstreamUnavailable
+from wdreconcile.sparqlwikidata import sparql_wikidata
+from wdreconcile.upstream import breaker_for, hedged, request_json, request_owner, throttled_calls
+
+pytestmark = pytest.mark.asyncio
+
+async def test_limit_adapts():
+    limiter = AdaptiveLimiter('test', max_concurrency=8)
+    await limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.limit == 4
+    for i in range(4):
+        await limiter.acquire()
+        limiter.release(succeeded=True)
+    assert 4 < limiter.limit < 5
+    for i in range(10):
+        await limiter.acquire()
+        limiter.release(throttled=True)
+    assert limiter.limit == 1
+
+async def test_fair_sharing():
+    limiter = AdaptiveLimiter('test', max_concurrency=1)
+    granted = []
+
+    async def call(owner_name):
+        await limiter.acquire()
+        granted.append(owner_name)
+        await asyncio.sleep(0)
+        limiter.release(succeeded=True)
+
+    async def batch(owner_name, size):
+        with request_owner():
+            await asyncio.gather(*[call(owner_name) for i in range(size)])
+
+    await asyncio.gather(batch('large', 6), batch('small', 2))
+    # the small request does not wait for the whole large batch
+    assert granted.index('small') <= 2
+    assert granted[:5].count('small') == 2
+
+async def test_pause_after_throttling():
+    limiter = AdaptiveLimiter('test')
+    await limiter.acquire()
+    limiter.release(throttled=True, retry_after=0.2)
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    await limiter.acquire()
+    limiter.release(succeeded=True)
+    assert loop.time() - start >= 0.15
+
+async def test_retry_when_throttled(http_session, mock_aioresponse):
+    url = 'https://throttled.example.org/api'
+    mock_aioresponse.get(url, status=429, headers={'Retry-After': '0'})
+    mock_aioresponse.get(url, payload={'error': {'code': 'maxlag'}}, headers={'Retry-After': '0'})
+    mock_aioresponse.get(url, payload={'result': 'ok'})
+    before = throttled_calls.get(endpoint='throttled.example.org')
+    assert await request_json(http_session, 'get', url, 'test') == {'result': 'ok'}
+    assert throttled_calls.get(endpoint='throttled.example.org') == before + 2
+
+async def test_give_up_when_throttled(http_session, mock_aioresponse):
+    url = 'https://overloaded.example.org/api'
+    mock_aioresponse.get(url, status=429, headers={'Retry-After': '0'}, repeat=True)
+    with pytest.raises(Exception):
+        await request_json(http_session, 'get', url, 'test', max_attempts=2)
+
+async def test_retry_on_timeout(http_session, mock_aioresponse):
+    url = 'https://slow.example.org/api'
+    mock_aioresponse.get(url, exception=asyncio.TimeoutError())
+    mock_aioresponse.get(url, payload={'result': 'ok'})
+    assert await request_json(http_session, 'get', url, 'test') == {'result': 'ok'}
+
+async def test_sparql_queries_are_not_retried(http_session, mock_aioresponse):
+    url = 'https://query.wikidata.org/sparql?format=json'
+    mock_aioresponse.post(url, exception=asyncio.TimeoutError())
+    mock_aioresponse.post(url, payload={'results': {'bindings': []}})
+    with pytest.raises(asyncio.TimeoutError):
+        await sparql_wikidata(http_session, 'SELECT ?item WHERE { ?item wdt:P31 wd:Q5 }')
+    assert len(list(mock_aioresponse.requests.values())[0]) == 1
+
+async def test_hedged_call():
+    calls = []
+
+    async def call():
+        calls.append(len(calls))
+        await asyncio.sleep(1 if len(calls) == 1 else 0)
+        return len(calls)
+
+    # the second call completes first
+    assert await hedged(call, 0.05) == 2
+    assert len(calls) == 2
+    # fast calls are not duplicated
+    calls.clear()
+    assert await hedged(lambda: asyncio.sleep(0, result='fast'), 0.05) == 'fast'
+
+async def test_circuit_breaker():
+    breaker = CircuitBreaker('test', window=4, failure_ratio=0.5, cooldown=0.05)
+    for succeeded in [True, False, True, False]:
+        assert breaker.allow()
+        breaker.record(succeeded)
+    assert breaker.is_open()
+    assert not breaker.allow()
+    await asyncio.sleep(0.06)
+    # a single call is let through after the cooldown
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record(True)
+    assert not breaker.is_open()
+    assert breaker.allow()
+
+async def test_open_circuit_fails_fast(http_session, mock_aioresponse):
+    url = 'https://down.example.org/api'
+    mock_aioresponse.get(url, status=500, repeat=True)
+    for i in range(10):
+        with pytest.raises(aiohttp.ClientError):
+            await request_json(http_session, 'get', url, 'test', raise_for_status=True, retries=1)
+    assert breaker_for(url).is_open()
+    with pytest.raises(UpstreamUnavailable):
+        await request_json(http_session, 'get', url, 'test')
@@ -0,0 +1,160 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from .metrics import count_cache_lookups
+
+class LRUCache(object):
+    """
+    An in-process cache, bounded both by number of entries
+    and by (approximate) total size, where entries also
+    expire after a given time.
+
+    Least recently used entries are evicted first.
+
+    Expired entries can be kept for some more time (stale_ttl),
+    during which they can still be retrieved with `lookup`,
+    to be served while they are being refreshed.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=None, ttl=None, name=None, stale_ttl=0):
+        """
+        :param max_entries: the maximum number of entries to keep
+        :param max_bytes: the maximum total size of the entries, as
+            declared by the caller when setting them (None for no limit)
+        :param ttl: default expiration time of the entries, in seconds
+            (None for no expiration)
+        :param name: the cache family reported in the metrics
+            (None for an unreported cache)
+        :param stale_ttl: the time (in seconds) expired entries
+            are kept, as stale entries
+        """
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.entries = OrderedDict() # key -> (value, size, expiry)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored for this key, or the default value
+        if it is absent or expired. This counts as a hit or a miss.
+        """
+        value, stale = self.lookup(key, count=False)
+        if value is None or stale:
+            self._count(False)
+            return default
+        self._count(True)
+        return value
+
+    def lookup(self, key, count=True):
+        """
+        Returns the value stored for this key (None if it is absent),
+        and whether it is stale (expired, but still kept). Stale values
+        count as hits.
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            value, size, expiry = entry
+            now = time.monotonic()
+            if expiry is None or expiry + self.stale_ttl > now:
+                self.entries.move_to_end(key)
+                if count:
+                    self._count(True)
+                return value, expiry is not None and expiry <= now
+            self.pop(key)
+        if count:
+            self._count(False)
+        return None, False
+
+    def _count(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if self.name:
+            count_cache_lookups(self.name, 'local', int(hit), int(not hit))
+
+    def set(self, key, value, size=1, ttl=None):
+        """
+        Stores a value in the cache.
+
+        :param size: approximate size of the value (in bytes)
+        :param ttl: expiration time in seconds, overriding the default one
+        """
+        self.pop(key)
+        if ttl is None:
+            ttl = self.ttl
+        expiry = time.monotonic() + ttl if ttl is not None else None
+        self.entries[key] = (value, size, expiry)
+        self.total_bytes += size
+        while (len(self.entries) > self.max_entries or
+               (self.max_bytes is not None and self.total_bytes > self.max_bytes and len(self.entries) > 1)):
+            _, (_, evicted_size, _) = self.entries.popitem(last=False)
+            self.total_bytes -= evicted_size
+
+    def pop(self, key):
+        """
+        Removes a key from the cache, if it is present
+        """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def __contains__(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and (entry[2] is None or entry[2] > time.monotonic())
+
+    def __len__(self):
+        return len(self.entries)
+
+class Revalidator(object):
+    """
+    Refreshes stale cache entries in the background, making
+    sure the same key is not refreshed by two tasks at once.
+    """
+
+    def __init__(self):
+        self.refreshing = set()
+        self.tasks = set()
+
+    def schedule(self, keys, refresh):
+        """
+        Starts refreshing the given keys (except those which
+        are already being refreshed).
+
+        :param refresh: a function taking a list of keys and
+            returning a coroutine which refreshes them
+        """
+        keys = [key for key in keys if key not in self.refreshing]
+        if not keys:
+            return
+        self.refreshing.update(keys)
+        task = asyncio.ensure_future(refresh(keys))
+        self.tasks.add(task)
+
+        def done(task):
+            self.tasks.discard(task)
+            self.refreshing.difference_update(keys)
+            if not task.cancelled():
+                # the stale entries will be served again,
+                # until a later refresh succeeds
+                task.exception()
+        task.add_done_callback(done)
@@ -0,0 +1,238 @@
+"""
+Serialization of the minified items stored in Redis.
+
+Each encoded value starts with a short header identifying the codec
+(and its version) which produced it, so that values written with
+different codecs can coexist in the cache. Values without any header
+are JSON, as written by the earlier versions of this service.
+
+Values are bytes: they are stored with a Redis client which does
+not decode the values it reads (see `itemstore.binary_client`).
+
+This module also provides the JSON library used for the requests
+and responses of the service (see `fast_json`).
+"""
+
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from config import json_library
+except ImportError:
+    json_library = 'json'
+
+class JSONLibrary(object):
+    """
+    Serializes and parses JSON with the standard library.
+
+    >>> JSONLibrary().loads(JSONLibrary().dumps({'id': 'Q42'}))
+    {'id': 'Q42'}
+    """
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def loads(self, value):
+        """
+        Raises ValueError if the value is not valid JSON.
+        """
+        return json.loads(value)
+
+class OrjsonLibrary(JSONLibrary):
+    """
+    Serializes and parses JSON with orjson, several times
+    faster than the standard library on large documents.
+    Requires the `orjson` package.
+    """
+    def __init__(self):
+        if orjson is None:
+            raise ValueError('The orjson package is required to use this JSON library')
+
+    def dumps(self, obj):
+        # the standard library also converts keys to strings
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    def loads(self, value):
+        # orjson.JSONDecodeError is a ValueError
+        return orjson.loads(value)
+
+def make_json_library(name):
+    """
+    :param name: 'json' or 'orjson'
+    """
+    if name == 'json':
+        return JSONLibrary()
+    elif name == 'orjson':
+        return OrjsonLibrary()
+    raise ValueError('Unknown JSON library: {}'.format(name))
+
+# JSON library used for the requests and responses of the
+# service, and for the items cached in JSON
+fast_json = make_json_library(json_library)
+
+class ItemCodec(object):
+    """
+    Converts items to bytes and back.
+    """
+    header = None
+
+    def encode(self, item):
+        raise NotImplementedError()
+
+    def decode(self, value):
+        """
+        Decodes a value which starts with the header of this codec.
+        Raises ValueError if it cannot be decoded.
+        """
+        raise NotImplementedError()
+
+class JSONCodec(ItemCodec):
+    """
+    Plain JSON, without any header.
+
+    >>> JSONCodec().decode(JSONCodec().encode({'id':'Q42'}))
+    {'id': 'Q42'}
+    """
+    header = b''
+
+    def encode(self, item):
+        return fast_json.dumps(item).encode('utf-8')
+
+    def decode(self, value):
+        return fast_json.loads(value)
+
+class MsgpackCodec(ItemCodec):
+    """
+    MessagePack, more compact and faster to decode than JSON.
+    Requires the `msgpack` package.
+    """
+    # (values written by the first version, 'm1:', were base64-encoded)
+    header = b'm2:'
+
+    def __init__(self):
+        if msgpack is None:
+            raise ValueError('The msgpack package is required to use this item codec')
+
+    def encode(self, item):
+        return self.header + self._pack(item)
+
+    def decode(self, value):
+        try:
+            return self._unpack(value[len(self.header):])
+        except (ValueError, msgpack.UnpackException) as e:
+            raise ValueError('Invalid cached item: {}'.format(e))
+
+    def _pack(self, item):
+        return msgpack.packb(item, use_bin_type=True)
+
+    def _unpack(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+class MsgpackZstdCodec(MsgpackCodec):
+    """
+    MessagePack compressed with Zstandard, optionally with
+    a dictionary trained on sample items (see train_dictionary).
+    Requires the `msgpack` and `zstandard` packages.
+    """
+    # (values written by the first version, 'z1:', were base64-encoded)
+    header = b'z2:'
+
+    def __init__(self, level=3, dictionary=None):
+        """
+        :param level: the compression level
+        :param dictionary: the contents of a zstd dictionary (bytes), or None
+        """
+        super(MsgpackZstdCodec, self).__init__()
+        if zstandard is None:
+            raise ValueError('The zstandard package is required to use this item codec')
+        dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+        self.compressor = zstandard.ZstdCompressor(level=level, dict_data=dict_data)
+        self.decompressor = zstandard.ZstdDecompressor(dict_data=dict_data)
+
+    def _pack(self, item):
+        return self.compressor.compress(super(MsgpackZstdCodec, self)._pack(item))
+
+    def _unpack(self, data):
+        try:
+            data = self.decompressor.decompress(data)
+        except zstandard.ZstdError as e:
+            raise ValueError(str(e))
+        return super(MsgpackZstdCodec, self)._unpack(data)
+
+    @classmethod
+    def train_dictionary(cls, items, size=112640):
+        """
+        Trains a zstd dictionary on a sample of items (a list of dicts),
+        and returns its contents, which can be saved to a file
+        and supplied to the codec.
+        """
+        if msgpack is None or zstandard is None:
+            raise ValueError('The msgpack and zstandard packages are required to train a dictionary')
+        samples = [msgpack.packb(item, use_bin_type=True) for item in items]
+        return zstandard.train_dictionary(size, samples).as_bytes()
+
+def make_codec(name, zstd_level=3, zstd_dictionary_path=None):
+    """
+    Builds the codec used to encode new items.
+
+    :param name: 'json', 'msgpack' or 'msgpack+zstd'
+    """
+    if name == 'json':
+        return JSONCodec()
+    elif name == 'msgpack':
+        return MsgpackCodec()
+    elif name == 'msgpack+zstd':
+        dictionary = None
+        if zstd_dictionary_path:
+            with open(zstd_dictionary_path, 'rb') as f:
+                dictionary = f.read()
+        return MsgpackZstdCodec(level=zstd_level, dictionary=dictionary)
+    raise ValueError('Unknown item codec: {}'.format(name))
+
+class CodecRegistry(object):
+    """
+    Decodes values written by any known codec, and encodes
+    new values with the selected one.
+
+    >>> registry = CodecRegistry(JSONCodec())
+    >>> registry.decode(b'{"id": "Q42"}')
+    {'id': 'Q42'}
+    """
+    def __init__(self, codec):
+        self.codec = codec
+        self.decoders = {}
+        for candidate in [codec, JSONCodec()]:
+            self.decoders.setdefault(candidate.header, candidate)
+        for cls in [MsgpackCodec, MsgpackZstdCodec]:
+            if cls.header not in self.decoders:
+                try:
+                    self.decoders[cls.header] = cls()
+                except ValueError:
+                    pass # dependency not available
+
+    def encode(self, item):
+        return self.codec.encode(item)
+
+    def decode(self, value):
+        """
+        Raises ValueError if the value cannot be decoded
+        (unknown codec, missing dictionary, corrupted value).
+        """
+        header, sep, _ = value[:8].partition(b':')
+        decoder = self.decoders.get(header + sep) if sep else None
+        if decoder is None:
+            decoder = self.decoders[b'']
+        return decoder.decode(value)
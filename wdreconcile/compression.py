@@ -0,0 +1,34 @@
+"""
+Compression of the responses of the service.
+
+Brotli is only offered if the `Brotli` package is installed,
+otherwise responses are compressed with gzip.
+"""
+
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# by order of preference, when the client accepts several of them
+if brotli is not None:
+    encodings = ['br', 'gzip']
+else:
+    encodings = ['gzip']
+
+def compress(data, encoding):
+    """
+    Compresses a response body with the given content encoding.
+    The levels are chosen for responses compressed on the fly,
+    favouring speed over size.
+
+    >>> gzip.decompress(compress(b'Q42', 'gzip'))
+    b'Q42'
+    """
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    elif encoding == 'br' and brotli is not None:
+        return brotli.compress(data, quality=5)
+    raise ValueError('Unsupported content encoding: {}'.format(encoding))
@@ -13,19 +13,32 @@ from .language import language_fallback
 from .propertypath import PropertyFactory
 from .wikidatavalue import ItemValue
 from .sitelink import SitelinkFetcher
+from .searchcache import SearchCache
+from .metrics import Timing
+from .upstream import request_json
 from config import type_property_path
 from config import default_type_entity
+try:
+    from config import ranking_concurrency
+except ImportError:
+    ranking_concurrency = 10
 
 class ReconcileEngine(object):
     """
-    Main class of the reconciliation system
+    Main class of the reconciliation system.
+
+    An instance is meant to be shared by all the requests
+    served by a process, so that its caches can be reused
+    across batches. An existing ItemStore can be supplied
+    to share it with other engines, as well as a PropertyIndex.
     """
-    def __init__(self, redis_client, http_session):
+    def __init__(self, redis_client, http_session, item_store=None, property_index=None):
         self.http_session = http_session
-        self.item_store = ItemStore(redis_client, http_session)
+        self.item_store = item_store or ItemStore(redis_client, http_session)
         self.type_matcher = TypeMatcher(redis_client, http_session)
-        self.pf = PropertyFactory(self.item_store)
+        self.pf = PropertyFactory(self.item_store, property_index)
         self.sitelink_fetcher = self.item_store.sitelink_fetcher
+        self.search_cache = SearchCache(redis_client)
         self.property_weight = 0.4
         self.validation_threshold_discount_per_property = 5
         self.match_score_gap = 10
@@ -44,8 +57,13 @@ class ReconcileEngine(object):
         return search_results + autocomplete_results
 
     async def _srsearch(self, query_string, num_results):
-        async with self.http_session.get(
-                config.mediawiki_api_endpoint,
+        return await self.search_cache.get('search', query_string, None,
+                config.wikibase_namespace_id, num_results,
+                lambda: self._fetch_srsearch(query_string, num_results))
+
+    async def _fetch_srsearch(self, query_string, num_results):
+        resp = await request_json(self.http_session, 'get',
+                config.mediawiki_api_endpoint, 'search',
                 params={'action':'query',
                 'format':'json',
                 'list':'search',
@@ -53,22 +71,25 @@ class ReconcileEngine(object):
                 'srlimit':num_results,
                 'srsearch':query_string,
                 'srwhat':'text'},
-                headers=config.headers) as r:
-            resp = await r.json()
-            # NOTE: remove the wikibase namespace prefix to only get the QID
-            return [item['title'][len(config.wikibase_namespace_prefix):] for item in resp.get('query', {}).get('search', [])]
+                headers=config.headers)
+        # NOTE: remove the wikibase namespace prefix to only get the QID
+        return [item['title'][len(config.wikibase_namespace_prefix):] for item in resp.get('query', {}).get('search', [])]
 
     async def _wbsearchentities(self, query_string, num_results, default_language):
-        async with self.http_session.get(
-                config.mediawiki_api_endpoint,
+        return await self.search_cache.get('wbsearchentities', query_string, default_language,
+                None, num_results,
+                lambda: self._fetch_wbsearchentities(query_string, num_results, default_language))
+
+    async def _fetch_wbsearchentities(self, query_string, num_results, default_language):
+        resp = await request_json(self.http_session, 'get',
+                config.mediawiki_api_endpoint, 'wbsearchentities',
                 params={'action':'wbsearchentities',
                 'format':'json',
                 'language': default_language,
                 'limit':num_results,
                 'search':query_string},
-                headers=config.headers) as r:
-            resp = await r.json()
-            return [item['id'] for item in resp.get('search', [])]
+                headers=config.headers)
+        return [item['id'] for item in resp.get('search', [])]
 
     async def prepare_property(self, prop, detect_unique_id=True):
         """
@@ -138,7 +159,7 @@ class ReconcileEngine(object):
                                 num_results_before_filter, default_language)
 
 
-    async def process_queries(self, queries, default_language='en'):
+    async def process_queries(self, queries, default_language='en', timing=None):
         """
         This contains the backbone of the reconciliation algorithm.
 
@@ -146,14 +167,41 @@ class ReconcileEngine(object):
           try to use these to find matches by SPARQL
         - Otherwise, do a string search for candidates,
           filter them and rank them.
+
+        :param timing: a Timing object, to retrieve the time spent in
+            each stage (these are recorded in the metrics in any case)
         """
+        timing = timing or Timing()
+        with timing.activate():
+            qids = await self._fetch_candidates(queries, default_language, timing)
+
+            # Perform each query
+            result = {}
+            with timing.stage('ranking'):
+                ranked = await self._for_each_query(queries,
+                    lambda query_id, query: self._rank_items(query, qids[query_id], default_language))
+                for query_id, candidates in zip(queries, ranked):
+                    result[query_id] = {
+                        'result': candidates
+                    }
+
+        return result
 
+    async def _fetch_candidates(self, queries, default_language, timing):
+        """
+        Prepares the properties of the queries and fetches
+        the candidate qids for each query (prefetching the
+        corresponding items).
+
+        :returns: a dict mapping query ids to lists of qids
+        """
         # Prepare all properties
-        for query_id in queries:
-            prepared_properties = []
-            for prop in queries[query_id].get('properties', []):
-                prepared_properties.append(await self.prepare_property(prop))
-            queries[query_id]['properties'] = prepared_properties
+        with timing.stage('prepare_properties'):
+            for query_id in queries:
+                prepared_properties = []
+                for prop in queries[query_id].get('properties', []):
+                    prepared_properties.append(await self.prepare_property(prop))
+                queries[query_id]['properties'] = prepared_properties
 
         # Find primary ids in the queries
         unique_id_values = defaultdict(set)
@@ -166,42 +214,180 @@ class ReconcileEngine(object):
                             unique_id_values[prop['path']].add(individual_value)
 
         # Find Qids and labels by primary id
-        unique_id_to_qid = {
-            path : await path.fetch_qids_by_values(values, default_language)
-            for path, values in unique_id_values.items()
-        }
+        with timing.stage('unique_ids'):
+            unique_id_to_qid = {
+                path : await path.fetch_qids_by_values(values, default_language)
+                for path, values in unique_id_values.items()
+            }
 
         # Resolve all sitelinks to qids
         possible_sitelinks = [query['query'] for query in queries.values()]
         for query in queries.values():
             possible_sitelinks += [p['v'] for p in query.get('properties', [])]
         # (this is cached in redis)
-        sitelinks_to_qids = await self.sitelink_fetcher.sitelinks_to_qids(
-            possible_sitelinks)
+        with timing.stage('sitelinks'):
+            sitelinks_to_qids = await self.sitelink_fetcher.sitelinks_to_qids(
+                possible_sitelinks)
 
         # Fetch all candidate qids for each query
         qids = {}
         qids_to_prefetch = set()
         queries_with_ids = queries.items()
-        candidates = await asyncio.gather(*[
-            self.fetch_candidate_ids(query, unique_id_to_qid, sitelinks_to_qids, default_language)
-            for query_id, query in queries_with_ids
-        ])
+        with timing.stage('search'):
+            candidates = await asyncio.gather(*[
+                self.fetch_candidate_ids(query, unique_id_to_qid, sitelinks_to_qids, default_language)
+                for query_id, query in queries_with_ids
+            ])
         for i, (query_id, query) in enumerate(queries_with_ids):
             qids[query_id] = candidates[i]
             qids_to_prefetch |= set(candidates[i])
 
-        # Prefetch all items
-        await self.item_store.get_items(qids_to_prefetch)
+        # Prefetch all items, and check their types at once
+        with timing.stage('prefetch'):
+            items = await self.item_store.get_items(qids_to_prefetch)
+            target_types = set()
+            for query in queries.values():
+                target_types |= set(self._target_types(query) or [self.avoid_type])
+            await self.type_matcher.subclass_matrix(
+                self._all_types(await self._types_of(items)), target_types - {None})
 
-        # Perform each query
-        result = {}
-        for query_id, query in queries.items():
-            result[query_id] = {
-                'result': await self._rank_items(query, qids[query_id], default_language)
-            }
+        return qids
 
-        return result
+    def _target_types(self, query):
+        """
+        The types the candidates of a query should have (apart from
+        the default type, which all items have)
+        """
+        target_types = query.get('type') or []
+        if type(target_types) != list:
+            target_types = [target_types]
+        # Remove the default type from the list
+        return [ t for t in target_types if t != default_type_entity ]
+
+    async def _types_of(self, qids):
+        """
+        The types of (prefetched) items, as a dict
+        from their qids to lists of qids
+        """
+        types = {}
+        for qid in qids:
+            types[qid] = [val.id for val in await self.p31_property_path.step(ItemValue(id=qid)) if not val.is_novalue()]
+        return types
+
+    def _all_types(self, types):
+        return set(itertools.chain.from_iterable(types.values()))
+
+    async def _for_each_query(self, queries, function):
+        """
+        Awaits function(query_id, query) for each query, for at most
+        ranking_concurrency queries at the same time.
+
+        :returns: the results, in the order of the queries. If one of the calls
+            fails, the others are cancelled.
+        """
+        slots = asyncio.Semaphore(ranking_concurrency)
+        async def run(query_id, query):
+            async with slots:
+                return await function(query_id, query)
+
+        tasks = [asyncio.ensure_future(run(query_id, query)) for query_id, query in queries.items()]
+        try:
+            return await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def stream_queries(self, queries, default_language='en', chunk_size=50, max_chunks=4):
+        """
+        Processes a stream of queries, yielding the result of each
+        query as soon as it is ranked.
+
+        Queries are processed by chunks, and at most `max_chunks` chunks are
+        processed at the same time, so that the memory used does not grow
+        with the number of queries. The results are not yielded in the order
+        of the queries.
+
+        :param queries: an iterable (or an asynchronous iterable,
+            such as a request body being parsed) of (query_id, query) pairs
+        :returns: an asynchronous iterator of (query_id, result) pairs.
+            The result is either {'result': [...]} or {'error': message}
+            if the query (or its chunk) could not be processed.
+        """
+        results = asyncio.Queue(maxsize=chunk_size*max_chunks)
+        slots = asyncio.Semaphore(max_chunks)
+        finished = object()
+
+        async def process_chunk(chunk):
+            try:
+                try:
+                    timing = Timing()
+                    with timing.activate():
+                        qids = await self._fetch_candidates(chunk, default_language, timing)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    for query_id in chunk:
+                        await results.put((query_id, {'error': str(e)}))
+                    return
+                async def rank(query_id, query):
+                    try:
+                        result = {'result': await self._rank_items(query, qids[query_id], default_language)}
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        result = {'error': str(e)}
+                    await results.put((query_id, result))
+                await self._for_each_query(chunk, rank)
+            finally:
+                slots.release()
+
+        running = set()
+        async def start(chunk):
+            await slots.acquire()
+            task = asyncio.ensure_future(process_chunk(chunk))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+        async def iterate(pairs):
+            if hasattr(pairs, '__aiter__'):
+                async for pair in pairs:
+                    yield pair
+            else:
+                for pair in pairs:
+                    yield pair
+
+        async def feed():
+            error = None
+            try:
+                chunk = {}
+                async for query_id, query in iterate(queries):
+                    chunk[query_id] = query
+                    if len(chunk) >= chunk_size:
+                        await start(chunk)
+                        chunk = {}
+                if chunk:
+                    await start(chunk)
+                await asyncio.gather(*running)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = e
+            # let the consumer know that we are done
+            await results.put((finished, error))
+
+        feeder = asyncio.ensure_future(feed())
+        try:
+            while True:
+                query_id, result = await results.get()
+                if query_id is finished:
+                    if result is not None:
+                        raise result
+                    break
+                yield query_id, result
+        finally:
+            feeder.cancel()
+            for task in list(running):
+                task.cancel()
 
     async def _rank_items(self, query, ids, default_language):
         """
@@ -211,14 +397,10 @@ class ReconcileEngine(object):
         """
         search_string = query['query']
         properties = query.get('properties', [])
-        target_types = query.get('type') or []
+        target_types = self._target_types(query)
         type_strict = query.get('type_strict', 'any')
         if type_strict not in ['any','all','should']:
             raise ValueError('Invalid type_strict')
-        if type(target_types) != list:
-            target_types = [target_types]
-        # Remove the default type from the list
-        target_types = [ t for t in target_types if t != default_type_entity ]
 
         discounted_validation_threshold = (config.validation_threshold -
             self.validation_threshold_discount_per_property * len(properties))
@@ -237,24 +419,26 @@ class ReconcileEngine(object):
         scored_items = []
         no_type_items = []
 
+        # Check the types of all the candidates at once
+        # (this was usually done for the whole batch already)
+        candidate_types = await self._types_of(items)
+        subclasses = await self.type_matcher.subclass_matrix(
+            self._all_types(candidate_types),
+            target_types or ([self.avoid_type] if self.avoid_type else []))
+
         types_to_prefetch = set()
         for qid, item in items.items():
-            itemvalue = ItemValue(id=qid)
-
-            # Check the type if we have a type constraint
-            current_types = [val.id for val in await self.p31_property_path.step(itemvalue) if not val.is_novalue()]
+            current_types = candidate_types[qid]
             type_found = len(current_types) > 0
 
             if target_types:
-                good_type = False
-                for target_type in target_types:
-                    for typ in current_types:
-                        good_type = await self.type_matcher.is_subclass(typ, target_type)
-                        if good_type:
-                            break
+                good_type = any(
+                    subclasses[typ, target_type]
+                    for target_type in target_types
+                    for typ in current_types)
             elif self.avoid_type: # Check if we should ignore this item
                 good_type = not all([
-                   await self.type_matcher.is_subclass(typ, self.avoid_type)
+                   subclasses[typ, self.avoid_type]
                    for typ in current_types
                 ])
             else:
@@ -407,12 +591,14 @@ class ReconcileEngine(object):
         if None in items:
             raise ValueError('Invalid Qid provided')
 
-        values = [
-            await path.evaluate(
+        # fetch all the items at once, then evaluate the path on each of them
+        await self.item_store.get_items(items)
+        values = await asyncio.gather(*[
+            path.evaluate(
                 ItemValue(id=qid),
                 lang=lang,
                 fetch_labels=fetch_labels,
-            ) for qid in items ]
+            ) for qid in items ])
 
         return {'prop':prop, 'values':values}
 
@@ -448,16 +634,29 @@ class ReconcileEngine(object):
             for prop in props
         }
 
+        # Fetch all the items at once, then evaluate all the
+        # paths on them concurrently
+        await self.item_store.get_items(ids)
+        async def step(qid, prop):
+            return list(await prop['path'].step(
+                ItemValue(id=qid),
+                prop['settings'].get('references') or 'any',
+                prop['settings'].get('rank') or 'best'))
+        cells = [(qid, pid) for qid in ids for pid in paths]
+        values = dict(zip(cells, await asyncio.gather(*[
+            step(qid, paths[pid]) for qid, pid in cells
+        ])))
+
+        # Fetch all the items used as values at once (for their labels)
+        await self.item_store.prefetch_values(itertools.chain(*values.values()))
+
         rows = {}
         for qid in ids:
             current_row = {}
             for pid, prop in paths.items():
                 current_row[pid] = [
                     await v.as_openrefine_cell(lang, self.item_store)
-                    for v in await prop['path'].step(
-                        ItemValue(id=qid),
-                        prop['settings'].get('references') or 'any',
-                        prop['settings'].get('rank') or 'best')
+                    for v in values[qid, pid]
                 ]
                 try:
                     limit = int(prop['settings'].get('limit') or 0)
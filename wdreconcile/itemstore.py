@@ -1,32 +1,159 @@
 import aiohttp
+import aioredis
 import asyncio
-import json
 from .language import language_fallback
 from .sitelink import SitelinkFetcher
+from .cache import LRUCache, Revalidator
+from .codec import CodecRegistry, make_codec
+from .metrics import count_cache_lookups
+from .upstream import request_json, hedged
 from config import redis_key_prefix, mediawiki_api_endpoint, user_agent
+try:
+    from config import item_cache_max_entries, item_cache_max_bytes
+except ImportError:
+    item_cache_max_entries = 10000
+    item_cache_max_bytes = 256*1024*1024
+try:
+    from config import item_batch_delay
+except ImportError:
+    item_batch_delay = 0
+try:
+    from config import item_fetch_timeout, item_fetch_hedge_delay
+except ImportError:
+    item_fetch_timeout = 10
+    item_fetch_hedge_delay = None
+try:
+    from config import item_cache_stale_ttl
+except ImportError:
+    item_cache_stale_ttl = 24*60*60
+try:
+    from config import item_cache_ttl
+except ImportError:
+    item_cache_ttl = 60*60
+try:
+    from config import item_cache_codec, item_cache_zstd_level, item_cache_zstd_dictionary
+except ImportError:
+    item_cache_codec = 'json'
+    item_cache_zstd_level = 3
+    item_cache_zstd_dictionary = None
+
+def binary_client(redis_client):
+    """
+    A Redis client connected to the same instance as the given one,
+    which does not decode the values it reads (so that binary values
+    can be stored).
+    """
+    pool = redis_client.connection_pool
+    return aioredis.Redis(connection_pool=aioredis.ConnectionPool(
+        connection_class=pool.connection_class,
+        max_connections=pool.max_connections,
+        **dict(pool.connection_kwargs, decode_responses=False)))
+
+class BatchRejected(ValueError):
+    """
+    Raised when the API rejects a batch of items
+    (for instance because one of the ids is invalid)
+    """
 
 class ItemStore(object):
     """
     An interface that caches minified versions
     of Wikidata items.
+
+    Items are cached in two tiers: a bounded in-process
+    LRU cache, in front of Redis. Only the items missing
+    from the first tier are looked up in Redis, and only
+    the items missing from Redis are fetched from the API.
+
+    Items are kept in both tiers for stale_ttl seconds after
+    they expire: such stale items are returned immediately,
+    and refreshed in the background.
     """
-    def __init__(self, redis_client, http_session):
+    def __init__(self, redis_client, http_session, binary_redis_client=None):
+        """
+        :param binary_redis_client: a Redis client which does not decode
+            the values it reads, used for the items (by default, a new
+            client connected to the same instance as redis_client)
+        """
         self.http_session = http_session
         self.r = redis_client
+        # items are stored as bytes (see the codec module)
+        self.binary_r = binary_redis_client or binary_client(redis_client)
         self.prefix = redis_key_prefix+'items'
-        self.ttl = 60*60 # one hour
+        self.ttl = item_cache_ttl
+        self.stale_ttl = item_cache_stale_ttl
         self.max_items_per_fetch = 50 # constraint from the Wikidata API
         self.sitelink_fetcher = SitelinkFetcher(redis_client, http_session)
-        self.local_cache = {}
+        self.codec = CodecRegistry(make_codec(
+            item_cache_codec,
+            zstd_level=item_cache_zstd_level,
+            zstd_dictionary_path=item_cache_zstd_dictionary))
+        self.local_cache = LRUCache(
+            max_entries=item_cache_max_entries,
+            max_bytes=item_cache_max_bytes,
+            name='items',
+            stale_ttl=self.stale_ttl)
+        self.revalidator = Revalidator()
+        self.redis_hits = 0
+        self.redis_misses = 0
+        # futures for the items currently being fetched from the API
+        self.inflight = {}
+        # items requested individually, waiting to be fetched together
+        self.batch_delay = item_batch_delay
+        self.pending_batch = {}
+        self.batch_task = None
 
     async def get_item(self, qid, force=False):
         """
         Get a single minified item from Wikidata (this is cached).
-        It is more efficient to use get_items if you know in advance
+
+        Items which are not in the in-process cache are not
+        retrieved immediately: all the items requested within
+        the same iteration of the event loop (or within batch_delay
+        seconds) are retrieved together.
+        It is still more efficient to use get_items if you know in advance
         that you will fetch more items.
         """
-        result = await self.get_items([qid], force=force)
-        return result[qid]
+        if force:
+            result = await self.get_items([qid], force=force)
+            return result[qid]
+
+        item, stale = self.local_cache.lookup(qid)
+        if item is not None:
+            if stale:
+                self._refresh([qid])
+            return item
+
+        future = self.pending_batch.get(qid)
+        if future is None:
+            future = asyncio.get_event_loop().create_future()
+            self.pending_batch[qid] = future
+            if self.batch_task is None:
+                self.batch_task = asyncio.ensure_future(self._dispatch_batch())
+        item = await asyncio.shield(future)
+        if item is None:
+            raise KeyError(qid)
+        return item
+
+    async def _dispatch_batch(self):
+        """
+        Retrieves all the items requested individually
+        since the last batch was dispatched.
+        """
+        await asyncio.sleep(self.batch_delay)
+        batch = self.pending_batch
+        self.pending_batch = {}
+        self.batch_task = None
+        try:
+            # these were already looked up in the in-process cache
+            items = await self._get_items_redis(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                future.set_exception(e)
+                future.exception() # do not warn if nobody is waiting any more
+            return
+        for qid, future in batch.items():
+            future.set_result(items.get(qid))
 
     async def get_label(self, qid, lang):
         """
@@ -60,54 +187,172 @@ class ItemStore(object):
             to_fetch = qids
         else:
             to_fetch = []
+            stale_qids = []
             for qid in qids:
-                if qid in self.local_cache:
-                    result[qid] = self.local_cache[qid]
+                item, stale = self.local_cache.lookup(qid)
+                if item is not None:
+                    result[qid] = item
+                    if stale:
+                        stale_qids.append(qid)
                 else:
                     to_fetch.append(qid)
+            self._refresh(stale_qids)
 
-        fetched = await self._get_items_redis(qids, force)
-        self.local_cache.update(fetched)
-        result.update(fetched)
+        if to_fetch:
+            result.update(await self._get_items_redis(to_fetch, force))
         return result
 
+    async def prefetch_values(self, values):
+        """
+        Fetches the items among the given values (ItemValues,
+        among other WikidataValues) at once, so that they can
+        then be retrieved individually from memory.
+        """
+        await self.get_items({
+            v.id for v in values
+            if v.value_type == 'wikibase-item' and 'id' in v.json
+        })
+
     async def _get_items_redis(self, qids, force=False):
         """
-        Redis-cached version of _fetch_items
+        Redis-cached version of _fetch_items, which also
+        fills the in-process cache.
         """
         result = {}
         to_fetch = set()
+        stale_qids = []
 
         if force:
             to_fetch = set(qids)
         else:
-            # Retrieve values that are already in the cache
-            current_values = await self.r.mget(*[
-                self._key_for_qid(qid)
-                for qid in qids])
+            # Retrieve values that are already in the cache,
+            # with their remaining time to live
+            keys = [self._key_for_qid(qid) for qid in qids]
+            pipe = self.binary_r.pipeline(transaction=False)
+            pipe.mget(*keys)
+            for key in keys:
+                pipe.pttl(key)
+            current_values, *ttls = await pipe.execute()
             for i, v in enumerate(current_values):
-                if v is None:
+                item = None
+                if v is not None:
+                    try:
+                        item = self.codec.decode(v)
+                    except ValueError:
+                        pass # unreadable entry, fetch it again
+                if item is None:
                     to_fetch.add(qids[i])
                 else:
-                    result[qids[i]] = json.loads(v)
+                    result[qids[i]] = item
+                    # keep it in memory no longer than in Redis
+                    ttl = ttls[i] / 1000. - self.stale_ttl if ttls[i] > 0 else self.ttl
+                    if ttl <= 0:
+                        stale_qids.append(qids[i])
+                    self.local_cache.set(qids[i], item, size=len(v), ttl=ttl)
+            self.redis_hits += len(result)
+            self.redis_misses += len(to_fetch)
+            count_cache_lookups('items', 'redis', len(result), len(to_fetch))
+            self._refresh(stale_qids)
 
         if not to_fetch:
             return result
 
-        items = await self._fetch_items(to_fetch)
+        result.update(await self._fetch_items_coalesced(list(to_fetch)))
+        return result
+
+    def _refresh(self, qids):
+        """
+        Refetches stale items in the background
+        (unless they are already being fetched)
+        """
+        qids = [qid for qid in qids if qid not in self.inflight]
+        if qids:
+            self.revalidator.schedule(qids, self._fetch_items_coalesced)
+
+    async def _fetch_items_coalesced(self, qids):
+        """
+        Fetches items from the API and stores them in the caches,
+        returning their minified versions.
+
+        Items which are already being fetched (by any other
+        coroutine of this process) are not requested again:
+        we wait for the pending fetch instead.
+        """
+        pending = {qid : self.inflight[qid] for qid in qids if qid in self.inflight}
+        own = [qid for qid in qids if qid not in pending]
+
+        result = {}
+        if own:
+            loop = asyncio.get_event_loop()
+            futures = {qid : loop.create_future() for qid in own}
+            self.inflight.update(futures)
+            try:
+                fetched = await self._fetch_and_store(own)
+            except asyncio.CancelledError:
+                for future in futures.values():
+                    future.cancel()
+                raise
+            except Exception as e:
+                for future in futures.values():
+                    future.set_exception(e)
+                    future.exception() # do not warn if nobody was waiting
+                raise
+            finally:
+                for qid in own:
+                    del self.inflight[qid]
+            for qid, future in futures.items():
+                future.set_result(fetched.get(qid))
+            result.update(fetched)
+
+        refetch = []
+        for qid, future in pending.items():
+            try:
+                item = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise # we are being cancelled ourselves
+                # the coroutine fetching this item was cancelled
+                refetch.append(qid)
+                continue
+            if item is not None:
+                result[qid] = item
+        if refetch:
+            result.update(await self._fetch_items_coalesced(refetch))
+        return result
+
+    async def _fetch_and_store(self, qids):
+        """
+        Fetches items from the API, minifies them and
+        stores them in both cache tiers.
+        """
+        items = await self._fetch_items(qids)
 
         fetched = {}
         for qid, item in items.items():
             fetched[qid] = self.minify_item(item)
 
         if fetched:
-            await self.r.mset({self._key_for_qid(qid) : json.dumps(v)
-                         for qid, v in fetched.items()})
-        for qid in fetched:
-            await self.r.expire(self._key_for_qid(qid), self.ttl)
+            # write all the items (with their expiration) in one round-trip
+            pipe = self.binary_r.pipeline(transaction=True)
+            for qid, item in fetched.items():
+                serialized = self.codec.encode(item)
+                pipe.set(self._key_for_qid(qid), serialized, ex=self.ttl + self.stale_ttl)
+                self.local_cache.set(qid, item, size=len(serialized), ttl=self.ttl)
+            await pipe.execute()
 
-        result.update(fetched)
-        return result
+        return fetched
+
+    def cache_stats(self):
+        """
+        Hit and miss counters for both cache tiers
+        """
+        return {
+            'local': self.local_cache.stats(),
+            'redis': {
+                'hits': self.redis_hits,
+                'misses': self.redis_misses,
+            },
+        }
 
     async def _fetch_items(self, qids):
         """
@@ -130,17 +375,43 @@ class ItemStore(object):
 
     async def _fetch_item_batch(self, qid_batch):
         """
-        Fetches a single batch of items from the Wikibase API
+        Fetches a single batch of items from the Wikibase API.
+
+        If the API rejects the batch (for instance because
+        of an invalid id), it is split in two halves which are fetched
+        separately, so that only the items which cannot be fetched
+        are missing from the result. Other errors (server errors or
+        throttling which persisted after the retries, open circuit) are
+        raised instead, as splitting the batch would only make more calls.
         """
-        async with self.http_session.get(mediawiki_api_endpoint,
+        try:
+            return await hedged(lambda: self._call_wbgetentities(qid_batch), item_fetch_hedge_delay)
+        except (aiohttp.ClientResponseError, BatchRejected) as e:
+            if isinstance(e, aiohttp.ClientResponseError) and e.status not in (400, 414):
+                raise
+            if len(qid_batch) == 1:
+                return {}
+            middle = len(qid_batch) // 2
+            first_half, second_half = await asyncio.gather(
+                self._fetch_item_batch(qid_batch[:middle]),
+                self._fetch_item_batch(qid_batch[middle:]))
+            first_half.update(second_half)
+            return first_half
+
+    async def _call_wbgetentities(self, qid_batch):
+        resp = await request_json(self.http_session, 'get',
+                mediawiki_api_endpoint, 'wbgetentities',
                 params={'action':'wbgetentities',
                 'format':'json',
                 'props':'aliases|labels|descriptions|claims|sitelinks',
                 'ids':'|'.join(qid_batch)},
                 headers={'User-Agent':user_agent},
-                raise_for_status=True) as r:
-            resp = await r.json()
-            return resp.get('entities', {})
+                raise_for_status=True,
+                timeout=item_fetch_timeout)
+        if 'error' in resp:
+            # (maxlag errors are retried by request_json)
+            raise BatchRejected(resp['error'].get('info', 'wbgetentities failed'))
+        return resp.get('entities', {})
 
     def minify_item(self, item):
         """
@@ -187,6 +458,9 @@ class ItemStore(object):
         # Add datatype for properties
         simplified['datatype'] = item.get('datatype')
 
+        # Add the revision, to invalidate what is derived from the item
+        simplified['lastrevid'] = item.get('lastrevid')
+
         # Add sitelinks
         simplified['sitelinks'] = {
             key : obj.get('title')
@@ -0,0 +1,225 @@
+import asyncio
+import time
+import uuid
+
+from config import redis_key_prefix
+from .codec import fast_json
+from .upstream import request_owner
+
+# Atomically takes the next chunk to process and leases it
+claim_script = """
+local task = redis.call('RPOP', KEYS[1])
+if task then
+    redis.call('ZADD', KEYS[2], ARGV[1], task)
+end
+return task
+"""
+
+# Puts a chunk back in the queue, unless another worker already did
+requeue_script = """
+if redis.call('ZREM', KEYS[2], ARGV[1]) == 1 then
+    redis.call('RPUSH', KEYS[1], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+class JobQueue(object):
+    """
+    Reconciliation jobs, for batches too large to be processed
+    within a single HTTP request.
+
+    A submitted batch is split into chunks, which are stored in Redis
+    and processed by workers (in this process or any other process using
+    the same Redis instance). Each worker leases the chunk it processes:
+    if it dies before storing the results, the lease expires and the chunk
+    is processed again by another worker.
+    """
+    def __init__(self, redis_client, engine, chunk_size=100, lease_time=300, ttl=7*24*60*60):
+        """
+        :param engine: the ReconcileEngine used to process the queries
+        :param chunk_size: the number of queries per chunk
+        :param lease_time: the time (in seconds) after which a chunk
+            is processed again if its results have not been stored
+        :param ttl: the time (in seconds) jobs and their results are kept
+        """
+        self.r = redis_client
+        self.engine = engine
+        self.chunk_size = chunk_size
+        self.lease_time = lease_time
+        self.ttl = ttl
+        self.max_attempts = 3
+        self.poll_interval = 1
+        self.prefix = redis_key_prefix+'jobs'
+        self.pending_key = self.prefix+':pending'
+        self.leases_key = self.prefix+':leases'
+
+    async def submit(self, queries, lang):
+        """
+        Stores a batch of queries (a dict, as for process_queries)
+        and queues its chunks.
+
+        :returns: the status of the new job
+        """
+        if not isinstance(queries, dict):
+            raise ValueError('Queries should be supplied as a JSON object')
+        job_id = uuid.uuid4().hex
+        query_items = list(queries.items())
+        chunks = [
+            dict(query_items[i:i+self.chunk_size])
+            for i in range(0, len(query_items), self.chunk_size)
+        ]
+
+        pipe = self.r.pipeline(transaction=True)
+        pipe.hset(self._meta_key(job_id), mapping={
+            'lang': lang,
+            'queries': len(query_items),
+            'chunks': len(chunks),
+            'created': time.time(),
+        })
+        pipe.expire(self._meta_key(job_id), self.ttl)
+        for n, chunk in enumerate(chunks):
+            pipe.set(self._chunk_key(job_id, n), fast_json.dumps(chunk), ex=self.ttl)
+        if chunks:
+            pipe.lpush(self.pending_key, *[self._task(job_id, n) for n in range(len(chunks))])
+        await pipe.execute()
+        return await self.status(job_id)
+
+    async def status(self, job_id):
+        """
+        Returns the progress of a job
+        """
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hgetall(self._meta_key(job_id))
+        pipe.hlen(self._results_key(job_id))
+        meta, done = await pipe.execute()
+        if not meta:
+            raise ValueError('Unknown job')
+        chunks = int(meta['chunks'])
+        if done >= chunks:
+            status = 'done'
+        elif done:
+            status = 'running'
+        else:
+            status = 'queued'
+        return {
+            'id': job_id,
+            'status': status,
+            'queries': int(meta['queries']),
+            'chunks': chunks,
+            'done_chunks': done,
+        }
+
+    async def results(self, job_id, start=0):
+        """
+        Returns the results of the chunks which have been processed,
+        from the given chunk on, up to the first one which has not been
+        processed yet.
+
+        :returns: a dict with the results (indexed by query id), and the
+            index of the next chunk to ask for.
+        """
+        status = await self.status(job_id)
+        indices = list(range(start, status['chunks']))
+        results = {}
+        next_chunk = start
+        if indices:
+            values = await self.r.hmget(self._results_key(job_id), *indices)
+            for v in values:
+                if v is None:
+                    break
+                results.update(fast_json.loads(v))
+                next_chunk += 1
+        return {
+            'id': job_id,
+            'status': status['status'],
+            'results': results,
+            'next_chunk': next_chunk,
+            'complete': next_chunk >= status['chunks'],
+        }
+
+    async def work_once(self):
+        """
+        Processes the next chunk in the queue, if any.
+
+        :returns: True if a chunk was processed
+        """
+        task = await self.r.eval(claim_script, 2, self.pending_key, self.leases_key,
+                    time.time() + self.lease_time)
+        if not task:
+            return False
+        job_id, n = task.rsplit(':', 1)
+        lang = await self.r.hget(self._meta_key(job_id), 'lang')
+        chunk = await self.r.get(self._chunk_key(job_id, n))
+        if lang is None or chunk is None:
+            # the job expired
+            await self.r.zrem(self.leases_key, task)
+            return True
+
+        try:
+            with request_owner():
+                results = await self.engine.process_queries(fast_json.loads(chunk), default_language=lang)
+        except asyncio.CancelledError:
+            await self.r.eval(requeue_script, 2, self.pending_key, self.leases_key, task)
+            raise
+        except Exception as e:
+            attempts = await self.r.hincrby(self._meta_key(job_id), 'attempts:'+n, 1)
+            if attempts < self.max_attempts:
+                await self.r.eval(requeue_script, 2, self.pending_key, self.leases_key, task)
+                return True
+            results = {
+                query_id : {'error': str(e)}
+                for query_id in fast_json.loads(chunk)
+            }
+
+        # Storing the results is idempotent, in case another worker
+        # processed the same chunk after our lease expired
+        pipe = self.r.pipeline(transaction=True)
+        pipe.hset(self._results_key(job_id), n, fast_json.dumps(results))
+        pipe.expire(self._results_key(job_id), self.ttl)
+        pipe.delete(self._chunk_key(job_id, n))
+        pipe.zrem(self.leases_key, task)
+        pipe.lrem(self.pending_key, 0, task)
+        await pipe.execute()
+        return True
+
+    async def requeue_expired(self):
+        """
+        Puts back in the queue the chunks whose lease has expired
+        (because the worker processing them died).
+
+        :returns: the number of chunks put back in the queue
+        """
+        expired = await self.r.zrangebyscore(self.leases_key, '-inf', time.time())
+        requeued = 0
+        for task in expired:
+            requeued += await self.r.eval(requeue_script, 2, self.pending_key, self.leases_key, task)
+        return requeued
+
+    async def run_worker(self):
+        """
+        Processes chunks until cancelled
+        """
+        while True:
+            try:
+                await self.requeue_expired()
+                while await self.work_once():
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                import traceback, sys
+                traceback.print_exc(file=sys.stdout)
+            await asyncio.sleep(self.poll_interval)
+
+    def _task(self, job_id, n):
+        return '{}:{}'.format(job_id, n)
+
+    def _meta_key(self, job_id):
+        return ':'.join([self.prefix, job_id])
+
+    def _chunk_key(self, job_id, n):
+        return ':'.join([self.prefix, job_id, 'chunk', str(n)])
+
+    def _results_key(self, job_id):
+        return ':'.join([self.prefix, job_id, 'results'])
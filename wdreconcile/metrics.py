@@ -0,0 +1,270 @@
+"""
+In-process metrics, exposed in the Prometheus text format.
+
+Metrics are aggregated in the memory of each process: when the service
+runs with several worker processes, each of them exposes its own values
+(which should be summed by the monitoring system).
+"""
+
+import contextvars
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+default_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric(object):
+    """
+    A family of time series, one for each combination of label values
+    """
+    metric_type = None
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.series = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('Expected labels {} for metric {}'.format(self.labelnames, self.name))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def expose(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.description),
+            '# TYPE %s %s' % (self.name, self.metric_type),
+        ]
+        for key in sorted(self.series):
+            lines += self._expose_series(key, self.series[key])
+        return lines
+
+    def _expose_series(self, key, value):
+        return ['%s%s %s' % (self.name, _format_labels(self.labelnames, key), _format_value(value))]
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.series[key] = self.series.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.series.get(self._key(labels), 0)
+
+class Gauge(Counter):
+    metric_type = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        self.series[self._key(labels)] = value
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, description, labelnames=(), buckets=default_buckets):
+        super(Histogram, self).__init__(name, description, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = {'buckets': [0] * len(self.buckets), 'sum': 0, 'count': 0}
+            self.series[key] = series
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series['buckets'][i] += 1
+        series['sum'] += value
+        series['count'] += 1
+
+    def get_count(self, **labels):
+        series = self.series.get(self._key(labels))
+        return series['count'] if series else 0
+
+    def _expose_series(self, key, series):
+        lines = [
+            '%s_bucket%s %d' % (self.name, _format_labels(self.labelnames, key, ('le', _format_value(bound))), count)
+            for bound, count in zip(self.buckets, series['buckets'])
+        ]
+        lines.append('%s_sum%s %s' % (self.name, _format_labels(self.labelnames, key), _format_value(float(series['sum']))))
+        lines.append('%s_count%s %d' % (self.name, _format_labels(self.labelnames, key), series['count']))
+        return lines
+
+class Registry(object):
+    """
+    A collection of metrics
+    """
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, description, labelnames=()):
+        return self._register(Counter(name, description, labelnames))
+
+    def gauge(self, name, description, labelnames=()):
+        return self._register(Gauge(name, description, labelnames))
+
+    def histogram(self, name, description, labelnames=(), buckets=default_buckets):
+        return self._register(Histogram(name, description, labelnames, buckets))
+
+    def expose(self):
+        """
+        Renders all metrics in the Prometheus text format
+        """
+        lines = []
+        for name in sorted(self.metrics):
+            lines += self.metrics[name].expose()
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+http_request_duration = registry.histogram(
+    'wdreconcile_http_request_duration_seconds',
+    'Time spent processing HTTP requests, by route',
+    ['route'])
+http_requests_in_progress = registry.gauge(
+    'wdreconcile_http_requests_in_progress',
+    'Number of HTTP requests being processed, by route',
+    ['route'])
+queries_per_batch = registry.histogram(
+    'wdreconcile_queries_per_batch',
+    'Number of reconciliation queries per request',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000))
+upstream_request_duration = registry.histogram(
+    'wdreconcile_upstream_request_duration_seconds',
+    'Time spent in calls to upstream services, by API action',
+    ['action'])
+upstream_requests = registry.counter(
+    'wdreconcile_upstream_requests_total',
+    'Number of calls to upstream services, by API action and outcome',
+    ['action', 'outcome'])
+cache_requests = registry.counter(
+    'wdreconcile_cache_requests_total',
+    'Number of cache lookups, by cache family, tier and result (hit or miss)',
+    ['cache', 'tier', 'result'])
+stage_duration = registry.histogram(
+    'wdreconcile_stage_duration_seconds',
+    'Time spent in each stage of the processing of reconciliation batches',
+    ['stage'])
+
+# The Timing of the batch being processed in the current context, if any
+current_timing = contextvars.ContextVar('current_timing', default=None)
+
+class Timing(object):
+    """
+    Records the wall time, upstream calls and cache lookups
+    of the successive stages of the processing of a batch.
+
+    Upstream calls and cache lookups are attributed to the stage
+    in progress when they happen, in the context where the timing
+    is active.
+
+    >>> timing = Timing()
+    >>> with timing.activate():
+    ...     with timing.stage('search'):
+    ...         with upstream_call('wbsearchentities'):
+    ...             pass
+    >>> timing.as_dict()['search']['upstream_calls']
+    1
+    """
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.current = None
+
+    @contextmanager
+    def activate(self):
+        token = current_timing.set(self)
+        try:
+            yield self
+        finally:
+            current_timing.reset(token)
+
+    @contextmanager
+    def stage(self, name):
+        record = self.stages.get(name)
+        if record is None:
+            record = {'time': 0., 'upstream_calls': 0, 'cache_hits': 0, 'cache_misses': 0}
+            self.stages[name] = record
+        previous = self.current
+        self.current = record
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            elapsed = time.perf_counter() - start
+            record['time'] += elapsed
+            stage_duration.observe(elapsed, stage=name)
+            self.current = previous
+
+    def as_dict(self):
+        """
+        The figures recorded for each stage (times are in seconds)
+        """
+        return OrderedDict(
+            (name, dict(record, time=round(record['time'], 6)))
+            for name, record in self.stages.items()
+        )
+
+def _current_stage():
+    timing = current_timing.get()
+    return timing.current if timing is not None else None
+
+def count_cache_lookups(cache, tier, hits, misses):
+    """
+    Records the outcome of lookups in a cache
+    """
+    stage = _current_stage()
+    if stage is not None:
+        stage['cache_hits'] += hits
+        stage['cache_misses'] += misses
+    if hits:
+        cache_requests.inc(hits, cache=cache, tier=tier, result='hit')
+    if misses:
+        cache_requests.inc(misses, cache=cache, tier=tier, result='miss')
+
+@contextmanager
+def upstream_call(action):
+    """
+    Measures a call to an upstream service:
+
+    >>> with upstream_call('wbgetentities'):
+    ...     pass
+    >>> upstream_requests.get(action='wbgetentities', outcome='ok') > 0
+    True
+    """
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        upstream_request_duration.observe(time.perf_counter() - start, action=action)
+        upstream_requests.inc(action=action, outcome=outcome)
+        stage = _current_stage()
+        if stage is not None:
+            stage['upstream_calls'] += 1
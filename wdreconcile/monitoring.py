@@ -10,22 +10,25 @@ class Monitoring(object):
                 (duration,time.time() // duration))
 
     async def log_request(self, queries, processing_time):
+        pipe = self.r.pipeline(transaction=True)
         for duration in self.req_rate_bucket_durations:
             key = self.redis_bucket(duration)
-            await self.r.incr(key+':req_count')
-            await self.r.expire(key+':req_count', duration)
-            await self.r.incrby(key+':query_count', queries)
-            await self.r.expire(key+':query_count', duration)
-            await self.r.incrbyfloat(key+':processing_time', processing_time)
-            await self.r.expire(key+':processing_time', duration)
+            pipe.incr(key+':req_count')
+            pipe.expire(key+':req_count', duration)
+            pipe.incrby(key+':query_count', queries)
+            pipe.expire(key+':query_count', duration)
+            pipe.incrbyfloat(key+':processing_time', processing_time)
+            pipe.expire(key+':processing_time', duration)
+        await pipe.execute()
 
     async def get_rates(self):
         rates = []
         for duration in self.req_rate_bucket_durations:
             key = self.redis_bucket(duration)
-            req_count = float((await self.r.get(key+':req_count')) or 0)
-            query_count = float((await self.r.get(key+':query_count')) or 0)
-            processing_time = float((await self.r.get(key+':processing_time')) or 0)
+            req_count, query_count, processing_time = [
+                float(v or 0) for v in await self.r.mget(
+                    key+':req_count', key+':query_count', key+':processing_time')
+            ]
             curtime = time.time()
             time_since_bucket_started = curtime - duration*(curtime // duration)
             rates.append({
@@ -0,0 +1,207 @@
+import asyncio
+import bisect
+import re
+import time
+from collections import defaultdict
+from string import Template
+
+from .cache import LRUCache, Revalidator
+from .language import language_fallback
+from .searchcache import SearchCache
+from .sparqlwikidata import sparql_wikidata
+from .utils import to_p
+try:
+    from config import sparql_query_to_fetch_properties, property_index_refresh_interval
+except ImportError:
+    sparql_query_to_fetch_properties = None
+    property_index_refresh_interval = 24*60*60
+try:
+    from config import property_index_max_languages
+except ImportError:
+    property_index_max_languages = 50
+
+def trigrams(term):
+    """
+    >>> sorted(trigrams('ring'))
+    ['ing', 'rin']
+    """
+    return {term[i:i+3] for i in range(len(term) - 2)}
+
+class LanguageIndex(object):
+    """
+    The properties of the Wikibase instance with their
+    terms in one language, indexed by prefix (of their terms
+    and of the words in them) and by trigram.
+    """
+    def __init__(self, properties, lang):
+        """
+        :param properties: a dict from property ids to dicts with
+            'labels' and 'descriptions' (by language), 'terms' (labels
+            and aliases in all languages) and 'datatype' keys
+        """
+        self.lang = lang
+        self.loaded_at = time.monotonic()
+        self.properties = {}
+        # normalized labels and aliases of each property
+        self.property_terms = {}
+        self.trigrams = defaultdict(set)
+        terms = set()
+        for pid, prop in properties.items():
+            label = language_fallback(prop['labels'], lang) or pid
+            self.properties[pid] = {
+                'id': pid,
+                'label': label,
+                'description': language_fallback(prop['descriptions'], lang),
+                'datatype': prop['datatype'],
+            }
+            normalized_label = SearchCache.normalize(label)
+            self.property_terms[pid] = {normalized_label} | {SearchCache.normalize(term) for term in prop['terms']}
+            for term in self.property_terms[pid]:
+                # matches on the label come first
+                rank = 0 if term == normalized_label else 1
+                terms.add((term, pid, rank))
+                words = term.split(' ')
+                for i in range(1, len(words)):
+                    terms.add((' '.join(words[i:]), pid, 2))
+                for trigram in trigrams(term):
+                    self.trigrams[trigram].add(pid)
+        # (term, pid, rank) triples, sorted for prefix search
+        self.terms = sorted(terms)
+
+    def search(self, query, limit):
+        """
+        Returns the properties matching a query, as dicts with
+        'id', 'label', 'description' and 'datatype' keys.
+
+        Properties are ranked by match type: exact matches
+        first, then labels, aliases and words starting with the query,
+        and finally terms containing it.
+        """
+        normalized = SearchCache.normalize(query)
+        if not normalized:
+            return []
+        ranks = {}
+        pid = normalized.upper()
+        if pid in self.properties:
+            ranks[pid] = (-1, 0)
+        for i in range(bisect.bisect_left(self.terms, (normalized,)), len(self.terms)):
+            term, pid, rank = self.terms[i]
+            if not term.startswith(normalized):
+                break
+            ranks[pid] = min(ranks.get(pid, (3, 3)), (int(term != normalized), rank))
+        if len(ranks) < limit and len(normalized) >= 3:
+            candidates = None
+            for trigram in trigrams(normalized):
+                candidates = set(self.trigrams.get(trigram, ())) if candidates is None else candidates & self.trigrams.get(trigram, set())
+            # trigrams only give candidates, which are then checked
+            for pid in candidates - set(ranks):
+                if any(normalized in term for term in self.property_terms[pid]):
+                    ranks[pid] = (2, 3)
+        best = sorted(ranks, key=lambda pid: ranks[pid] + (int(pid[1:]),))
+        return [self.properties[pid] for pid in best[:limit]]
+
+    def label(self, pid):
+        """
+        The label of a property, or None if it is unknown
+        """
+        prop = self.properties.get(pid)
+        return prop['label'] if prop else None
+
+class PropertyIndex(object):
+    """
+    An in-memory index of all the properties of the Wikibase instance,
+    for each language, used to suggest properties and to name them
+    without calling the API.
+
+    The properties are loaded with a single SPARQL query for each
+    language, in the background: until it is loaded, callers fall
+    back on the API. Indices are reloaded after refresh_interval seconds.
+
+    Only the indices of the max_languages most recently used languages
+    are kept, and languages in which no property has any term are not
+    indexed at all.
+    """
+    lang_re = re.compile(r'^[a-z]{1,3}(-[a-z0-9]+)*$')
+
+    def __init__(self, http_session, refresh_interval=property_index_refresh_interval, retry_delay=60,
+                 max_languages=property_index_max_languages):
+        """
+        :param refresh_interval: the time (in seconds) after which
+            the index of a language is reloaded
+        :param retry_delay: the time (in seconds) before the index
+            is loaded again after a failure
+        :param max_languages: the maximum number of indices kept in memory
+        """
+        self.http_session = http_session
+        self.refresh_interval = refresh_interval
+        self.retry_delay = retry_delay
+        self.languages = LRUCache(max_entries=max_languages)
+        # languages whose index was (re)loaded recently
+        self.attempts = LRUCache(max_entries=10*max_languages, ttl=retry_delay)
+        self.revalidator = Revalidator()
+
+    def get(self, lang):
+        """
+        Returns the index of the properties in this language, or None
+        if it is not loaded yet (it is then loaded in the background).
+        """
+        if sparql_query_to_fetch_properties is None or not self.lang_re.match(lang or ''):
+            return None
+        index = self.languages.get(lang)
+        now = time.monotonic()
+        if ((index is None or now > index.loaded_at + self.refresh_interval) and
+                lang not in self.attempts):
+            self.attempts.set(lang, now)
+            self.revalidator.schedule([lang], self._load)
+        return index
+
+    async def load(self, lang):
+        """
+        Loads the index of a language, and returns it
+        """
+        await self._load([lang])
+        return self.languages.get(lang)
+
+    async def _load(self, langs):
+        for lang in langs:
+            properties = await self._fetch_properties(lang)
+            # the SPARQL query also returns the terms in fallback
+            # languages, so unknown language codes still get results
+            known = any(lang in prop['labels'] or lang in prop['descriptions']
+                        for prop in properties.values())
+            if known:
+                # building the index takes some time, so we
+                # do it without blocking the event loop
+                loop = asyncio.get_event_loop()
+                self.languages.set(lang, await loop.run_in_executor(None, LanguageIndex, properties, lang))
+
+    async def _fetch_properties(self, lang):
+        sparql_query = Template(sparql_query_to_fetch_properties).substitute(lang=lang)
+        results = await sparql_wikidata(self.http_session, sparql_query)
+        properties = {}
+        for result in results['bindings']:
+            pid = to_p(result['pid']['value'])
+            if not pid:
+                continue
+            prop = properties.get(pid)
+            if prop is None:
+                prop = {
+                    'labels': {},
+                    'descriptions': {},
+                    'terms': set(),
+                    # local name of the wikibase:propertyType
+                    'datatype': result['type']['value'].split('#')[-1],
+                }
+                properties[pid] = prop
+            term = result.get('term')
+            if not term:
+                continue
+            term_lang = term.get('xml:lang')
+            term_type = result['termType']['value']
+            if term_type == 'description':
+                prop['descriptions'][term_lang] = term['value']
+            else:
+                if term_type == 'label':
+                    prop['labels'][term_lang] = term['value']
+                prop['terms'].add(term['value'])
+        return properties
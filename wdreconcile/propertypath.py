@@ -6,6 +6,7 @@ from funcparserlib.parser import finished
 from funcparserlib.parser import NoParseError
 from funcparserlib.lexer import make_tokenizer
 from funcparserlib.lexer import LexerError
+import asyncio
 import itertools
 from collections import defaultdict
 
@@ -45,11 +46,16 @@ class PropertyFactory(object):
     """
     A class to build property paths
     """
-    def __init__(self, item_store):
+    def __init__(self, item_store, property_index=None):
         self.item_store = item_store
+        self.property_index = property_index
         self.r = self.item_store.r # redis client
         self.unique_ids_key = redis_key_prefix+'unique_ids'
         self.ttl = 1*24*60*60 # 1 day
+        # parsed paths, indexed by their source string.
+        # Paths are immutable so they can be shared between requests.
+        self.parse_cache = {}
+        self.parse_cache_size = 1024
 
         self.parser = forward_decl()
 
@@ -122,12 +128,30 @@ class PropertyFactory(object):
     def parse(self, property_path_string):
         """
         Parses a string representing a property path
+        (memoized).
         """
+        cached = self.parse_cache.get(property_path_string)
+        if cached is not None:
+            return cached
         try:
             tokens = list(tokenize_property(property_path_string))
-            return self.parser.parse(tokens)
+            path = self.parser.parse(tokens)
         except (LexerError, NoParseError) as e:
             raise ValueError("Could not parse '{}': {}".format(property_path_string, str(e)))
+        if len(self.parse_cache) >= self.parse_cache_size:
+            # evict the oldest entry
+            del self.parse_cache[next(iter(self.parse_cache))]
+        self.parse_cache[property_path_string] = path
+        return path
+
+    async def get_property_label(self, pid, lang):
+        """
+        The label of a property, from the property index
+        if it is loaded, or from the item store otherwise
+        """
+        index = self.property_index.get(lang) if self.property_index else None
+        label = index.label(pid) if index else None
+        return label or await self.item_store.get_label(pid, lang)
 
     async def is_identifier_pid(self, pid):
         """
@@ -144,11 +168,13 @@ class PropertyFactory(object):
         if await self.r.exists(self.unique_ids_key):
             return # this list was already fetched
 
-        for pid in await self._fetch_unique_ids():
-            if pid:
-                await self.r.sadd(self.unique_ids_key, pid)
-
-        await self.r.expire(self.unique_ids_key, self.ttl)
+        pids = [pid for pid in await self._fetch_unique_ids() if pid]
+        if not pids:
+            return
+        pipe = self.r.pipeline(transaction=True)
+        pipe.sadd(self.unique_ids_key, *pids)
+        pipe.expire(self.unique_ids_key, self.ttl)
+        await pipe.execute()
 
     async def _fetch_unique_ids(self):
         # Q19847637 is "Wikidata property representing a unique
@@ -206,11 +232,12 @@ class PropertyPath(object):
                 labels = item.get('labels', {})
                 return [language_fallback(labels, lang)]
 
-        values = await self.step(item_value)
+        values = list(await self.step(item_value))
         if fetch_labels:
+            await self.item_store.prefetch_values(values)
             new_values = []
-            for v in values:
-                new_values += await fetch_label(v)
+            for labels in await asyncio.gather(*[fetch_label(v) for v in values]):
+                new_values += labels
             values = new_values
         else:
             values = [
@@ -398,7 +425,8 @@ class QualifierProperty(PropertyPath):
         return []
 
     async def readable_name(self, lang):
-        return await self.item_store.get_label(self.property_pid, lang)+', '+self.item_store.get_label(self.qualifier_pid, lang)
+        return (await self.factory.get_property_label(self.property_pid, lang)+', '+
+                await self.factory.get_property_label(self.qualifier_pid, lang))
 
 
 class LeafProperty(PropertyPath):
@@ -453,7 +481,7 @@ class LeafProperty(PropertyPath):
         return []
 
     async def readable_name(self, lang):
-        return await self.item_store.get_label(self.pid, lang)
+        return await self.factory.get_property_label(self.pid, lang)
 
 class QidProperty(PropertyPath):
     """
@@ -568,11 +596,12 @@ class ConcatenatedPropertyPath(PropertyPath):
         self.b = b
 
     async def step(self, v, referenced='any', rank='any'):
-        intermediate_values = await self.a.step(v, referenced, rank)
-        final_values = [
-            (await self.b.step(v2, referenced, rank))
+        intermediate_values = list(await self.a.step(v, referenced, rank))
+        await self.item_store.prefetch_values(intermediate_values)
+        final_values = await asyncio.gather(*[
+            self.b.step(v2, referenced, rank)
             for v2 in intermediate_values
-        ]
+        ])
         return itertools.chain(*final_values)
 
     def __str__(self, add_prefix=False):
@@ -594,8 +623,9 @@ class DisjunctedPropertyPath(PropertyPath):
         self.b = b
 
     async def step(self, v, referenced='any', rank='any'):
-        va = await self.a.step(v, referenced, rank)
-        vb = await self.b.step(v, referenced, rank)
+        va, vb = await asyncio.gather(
+            self.a.step(v, referenced, rank),
+            self.b.step(v, referenced, rank))
         return itertools.chain(*[va,vb])
 
     def __str__(self, add_prefix=False):
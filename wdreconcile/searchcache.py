@@ -0,0 +1,167 @@
+import asyncio
+import hashlib
+import re
+import unicodedata
+
+from .cache import LRUCache
+from .codec import fast_json
+from .metrics import count_cache_lookups
+from config import redis_key_prefix
+try:
+    from config import search_cache_ttl, search_cache_negative_ttl, search_cache_max_entries
+except ImportError:
+    search_cache_ttl = 60*60
+    search_cache_negative_ttl = 10*60
+    search_cache_max_entries = 10000
+
+class SearchCache(object):
+    """
+    Caches the results of the search APIs, in an
+    in-process cache in front of Redis.
+
+    Searches are identified by the API action, the normalized
+    query string, the language, the namespace and the number of
+    results. Empty results are also cached, for a shorter time.
+    Identical searches made concurrently are only sent once.
+    """
+    def __init__(self, redis_client, name='search', ttl=search_cache_ttl,
+                 negative_ttl=search_cache_negative_ttl, max_entries=search_cache_max_entries,
+                 is_empty=None):
+        """
+        :param name: the name of the cache, in Redis keys and in the metrics
+        :param ttl: the time (in seconds) results are kept
+        :param negative_ttl: the time (in seconds) empty results are kept
+        :param max_entries: the maximum number of results kept in memory
+        :param is_empty: a function telling whether results are empty
+            (by default, whether they are falsy)
+        """
+        self.r = redis_client
+        self.name = name
+        self.prefix = redis_key_prefix+name
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.is_empty = is_empty or (lambda results: not results)
+        self.local_cache = LRUCache(max_entries=max_entries, name=name)
+        # futures for the searches currently being made
+        self.inflight = {}
+
+    @staticmethod
+    def normalize(query_string):
+        """
+        Normalizes a query string, in the same way
+        as the search APIs do.
+
+        >>> SearchCache.normalize(' Ada  Lovelace ')
+        'ada lovelace'
+        >>> SearchCache.normalize('Café') == SearchCache.normalize('Café')
+        True
+        """
+        query_string = unicodedata.normalize('NFC', query_string)
+        return re.sub(r'\s+', ' ', query_string).strip().casefold()
+
+    def _key(self, action, query_string, language, namespace, limit):
+        digest = hashlib.sha1(self.normalize(query_string).encode('utf-8')).hexdigest()
+        return ':'.join([self.prefix, action, language or '', str(namespace or ''), str(limit), digest])
+
+    async def get(self, action, query_string, language, namespace, limit, fetch, refine=None):
+        """
+        Returns the results of a search, from the cache
+        or by awaiting `fetch()` (which are then cached).
+
+        :param refine: a function which, given the results cached for a
+            shorter prefix of the query string, returns the results for this
+            query string (or None if they cannot be derived from them). If
+            supplied, it is used (on the longest prefixes first) before
+            fetching the results.
+        """
+        key = self._key(action, query_string, language, namespace, limit)
+        results = self.local_cache.get(key)
+        if results is not None:
+            return results
+
+        future = self.inflight.get(key)
+        if future is not None:
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise # we are being cancelled ourselves
+                # the coroutine making this search was cancelled
+                return await self.get(action, query_string, language, namespace, limit, fetch, refine)
+
+        future = asyncio.get_event_loop().create_future()
+        self.inflight[key] = future
+        try:
+            results = await self._get_redis(key)
+            if results is None:
+                results = await self._refine(action, query_string, language, namespace, limit, refine)
+            if results is None:
+                results = await self._fetch(key, fetch)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception() # do not warn if nobody was waiting
+            raise
+        else:
+            future.set_result(results)
+        finally:
+            del self.inflight[key]
+        return results
+
+    async def _get_redis(self, key):
+        pipe = self.r.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.pttl(key)
+        cached, ttl = await pipe.execute()
+        count_cache_lookups(self.name, 'redis', int(cached is not None), int(cached is None))
+        if cached is not None:
+            results = fast_json.loads(cached)
+            # keep it in memory no longer than in Redis
+            self.local_cache.set(key, results, ttl=ttl / 1000. if ttl > 0 else self.ttl)
+            return results
+
+    async def _refine(self, action, query_string, language, namespace, limit, refine):
+        """
+        Derives the results of a search from the results
+        cached for the longest possible prefix of its query
+        """
+        if refine is None:
+            return None
+        normalized = self.normalize(query_string)
+        keys = []
+        for length in range(len(normalized) - 1, 0, -1):
+            key = self._key(action, normalized[:length], language, namespace, limit)
+            if key not in keys:
+                keys.append(key)
+        if not keys:
+            return None
+
+        prefix_results = [self.local_cache.lookup(key, count=False)[0] for key in keys]
+        missing = [key for key, results in zip(keys, prefix_results) if results is None]
+        if missing:
+            from_redis = dict(zip(missing, await self.r.mget(*missing)))
+            prefix_results = [
+                results if results is not None else
+                (fast_json.loads(from_redis[key]) if from_redis[key] is not None else None)
+                for key, results in zip(keys, prefix_results)
+            ]
+        for results in prefix_results:
+            if results is not None:
+                refined = refine(results)
+                if refined is not None:
+                    key = self._key(action, query_string, language, namespace, limit)
+                    self.local_cache.set(key, refined, ttl=self._ttl_for(refined))
+                    return refined
+        return None
+
+    def _ttl_for(self, results):
+        return self.negative_ttl if self.is_empty(results) else self.ttl
+
+    async def _fetch(self, key, fetch):
+        results = await fetch()
+        ttl = self._ttl_for(results)
+        await self.r.set(key, fast_json.dumps(results), ex=ttl)
+        self.local_cache.set(key, results, ttl=ttl)
+        return results
@@ -5,7 +5,13 @@ from urllib.parse import quote_plus, unquote_plus
 from collections import defaultdict
 
 from .utils import to_q
+from .metrics import count_cache_lookups
+from .upstream import request_json
 from config import redis_key_prefix, mediawiki_api_endpoint
+try:
+    from config import wiki_api_endpoint_pattern
+except ImportError:
+    wiki_api_endpoint_pattern = 'https://{}.{}.org/w/api.php'
 
 class SitelinkFetcher(object):
     """
@@ -137,13 +143,13 @@ class SitelinkFetcher(object):
                  'titles': title_string,
                  'format': 'json'}
         try:
-            async with self.http_session.get(mediawiki_api_endpoint, params=params, raise_for_status=True) as r:
-                json_resp = await r.json()
-                for qid, item in json_resp.get('entities', {}).items():
-                    own_title = item.get('sitelinks', {}).get(wiki_id, {}).get('title')
-                    if own_title:
-                        idx = titles.index(own_title)
-                        results[idx] = qid
+            json_resp = await request_json(self.http_session, 'get',
+                    mediawiki_api_endpoint, 'wbgetentities', params=params, raise_for_status=True)
+            for qid, item in json_resp.get('entities', {}).items():
+                own_title = item.get('sitelinks', {}).get(wiki_id, {}).get('title')
+                if own_title:
+                    idx = titles.index(own_title)
+                    results[idx] = qid
 
         except aiohttp.ClientResponseError as e:
             print(e)
@@ -153,27 +159,27 @@ class SitelinkFetcher(object):
         return results
 
     async def resolve_redirects_for_titles(self, lang_code, wiki, titles):
-        async with self.http_session.get('https://{}.{}.org/w/api.php'.format(lang_code, wiki),
+        json_response = await request_json(self.http_session, 'get',
+                wiki_api_endpoint_pattern.format(lang_code, wiki), 'redirects',
                 params={
                     'action': 'query',
                     'format': 'json',
                     'redirects': '1',
                     'titles': '|'.join(titles),
                 },
-                raise_for_status=True) as r:
-            json_response = await r.json()
-            response = json_response['query'].get('redirects', [])
-            redirect_map = {
-                redirect['from']:redirect['to']
-                for redirect in response
-            }
-
-            results = []
-            for title in titles:
-                while title in redirect_map:
-                    title = redirect_map[title]
-                results.append(title)
-            return results
+                raise_for_status=True)
+        response = json_response['query'].get('redirects', [])
+        redirect_map = {
+            redirect['from']:redirect['to']
+            for redirect in response
+        }
+
+        results = []
+        for title in titles:
+            while title in redirect_map:
+                title = redirect_map[title]
+            results.append(title)
+        return results
 
     async def get_qids(self, sitelinks):
         """
@@ -231,6 +237,7 @@ class SitelinkFetcher(object):
                 to_fetch.add(non_nulls[i])
             else:
                 result[non_nulls[i]] = v
+        count_cache_lookups('sitelinks', 'redis', len(result), len(to_fetch))
 
         to_fetch = list(to_fetch)
         to_write = {}
@@ -243,10 +250,10 @@ class SitelinkFetcher(object):
 
         # Write newly-fetched qids to the cache
         if to_write:
-            await self.r.mset({self._key_for_sitelink(sitelink) : qid
-                    for sitelink, qid in to_write.items()})
-        for sitelink in to_write:
-            await self.r.expire(self._key_for_sitelink(sitelink), self.ttl)
+            pipe = self.r.pipeline(transaction=True)
+            for sitelink, qid in to_write.items():
+                pipe.set(self._key_for_sitelink(sitelink), qid, ex=self.ttl)
+            await pipe.execute()
 
         return result
 
@@ -1,11 +1,18 @@
 import config
+from .upstream import request_json
+try:
+    from config import sparql_timeout, sparql_retries
+except ImportError:
+    sparql_timeout = 60
+    sparql_retries = 0
 
 async def sparql_wikidata(http_session, query_string):
-    async with http_session.post(
-            config.wikibase_sparql_endpoint,
+    # queries can be expensive for the query service, so they have their own
+    # deadline, and are not retried (even when throttled) unless configured
+    results = await request_json(http_session, 'post',
+            config.wikibase_sparql_endpoint, 'sparql',
             data={'query': query_string},
             params={'format': 'json'},
-            headers={'User-Agent': config.user_agent}
-            ) as r:
-        results = await r.json()
-        return results['results']
+            headers={'User-Agent': config.user_agent},
+            timeout=sparql_timeout, max_attempts=1, retries=sparql_retries)
+    return results['results']
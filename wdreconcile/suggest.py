@@ -1,3 +1,4 @@
+import asyncio
 from quart import render_template
 from markupsafe import escape
 import hashlib
@@ -11,6 +12,8 @@ from .utils import to_p
 from .propertypath import PropertyFactory
 from .sparqlwikidata import sparql_wikidata
 from .wikidatavalue import ItemValue
+from .upstream import UpstreamUnavailable, request_json
+from .searchcache import SearchCache
 
 from config import preview_height, preview_width, thumbnail_width
 from config import image_properties, this_host
@@ -20,6 +23,18 @@ from config import mediawiki_api_endpoint, autodescribe_endpoint
 from config import fallback_image_url, fallback_image_alt
 from config import identifier_space, schema_space
 from config import sparql_query_to_propose_properties
+try:
+    from config import suggest_cache_ttl, suggest_fetch_limit, suggest_result_limit
+except ImportError:
+    suggest_cache_ttl = 60*60
+    suggest_fetch_limit = 50
+    suggest_result_limit = 7
+try:
+    from config import autodesc_cache_ttl, autodesc_cache_negative_ttl, preview_cache_ttl
+except ImportError:
+    autodesc_cache_ttl = 24*60*60
+    autodesc_cache_negative_ttl = 10*60
+    preview_cache_ttl = 24*60*60
 
 def commons_image_url(filename):
     filename = filename.replace(' ', '_')
@@ -35,36 +50,54 @@ def commons_image_url(filename):
 
 async def autodescribe(http_session, qid, lang):
     """
-    Calls the autodesc API by Magnus
+    Calls the autodesc API by Magnus. Returns an empty
+    description if it fails (so that it is cached as such).
     """
     if not autodescribe_endpoint:
         return ''
     try:
-        async with http_session.get(autodescribe_endpoint,
+        # this is only a nice-to-have, so we do not retry if it fails
+        resp = await request_json(http_session, 'get', autodescribe_endpoint, 'autodesc',
                     params={'q':qid,
                     'format':'json',
                     'mode':'short',
                     'links':'wikidata',
                     'get_infobox':'yes',
                     'lang':lang},
-                    timeout=2) as r:
-            desc = (await r.json()).get('result', '')
-            desc = desc.replace('<a href', '<a target="_blank" href')
-            return desc
-    except ClientError as e:
+                    timeout=2, max_attempts=1, retries=0)
+        desc = resp.get('result', '')
+        desc = desc.replace('<a href', '<a target="_blank" href')
+        return desc
+    except (ClientError, UpstreamUnavailable, asyncio.TimeoutError) as e:
+        # aiohttp raises a plain TimeoutError when the call takes too long
         return ''
     except ValueError as e:
         return ''
 
 class SuggestEngine(object):
-    def __init__(self, redis_client, http_session):
+    def __init__(self, redis_client, http_session, item_store=None, property_index=None):
         self.r = redis_client
         self.http_session = http_session
         self.property_path_re = re.compile(r'(SPARQL ?:? ?)?(\(*(P\d+|[LADS][a-z\-]+)[/\|@].*)$')
         self.pid_re = re.compile('^P[1-9][0-9]*$')
-        self.store = ItemStore(self.r, http_session)
-        self.ft = PropertyFactory(self.store)
-        self.store.ttl = 24*60*60 # one day
+        self.entity_id_re = re.compile(r'^[a-z]\d')
+        if item_store:
+            # share the caches of an existing store, and its ttl
+            # (item_cache_ttl, rather than one day as below)
+            self.store = item_store
+        else:
+            self.store = ItemStore(self.r, http_session)
+            self.store.ttl = 24*60*60 # one day
+        self.property_index = property_index
+        self.ft = PropertyFactory(self.store, property_index)
+        self.search_cache = SearchCache(self.r, name='suggest',
+            ttl=suggest_cache_ttl, negative_ttl=suggest_cache_ttl,
+            is_empty=lambda results: not results['search'])
+        # empty descriptions are also returned when autodesc fails
+        self.description_cache = SearchCache(self.r, name='autodesc',
+            ttl=autodesc_cache_ttl, negative_ttl=autodesc_cache_negative_ttl)
+        self.preview_cache = SearchCache(self.r, name='previews',
+            ttl=preview_cache_ttl, negative_ttl=preview_cache_ttl)
         if image_properties:
             self.image_path = self.ft.parse('|'.join(image_properties))
         else:
@@ -93,12 +126,35 @@ class SuggestEngine(object):
 
     async def preview(self, args):
         id = args['id']
-        item_value = ItemValue(id=id)
         item = await self.store.get_item(id)
-        lang = args.get('lang')
-        image = await self.get_image_for_item(item_value, item, lang)
+        return await self.cached_preview(item, args.get('lang'))
 
-        desc = await self.get_description(item, lang)
+    async def preview_by_batch(self, args):
+        """
+        Renders the previews of several items at once (their ids
+        are separated by '|' in `ids`), fetching all the items together.
+        """
+        lang = args.get('lang')
+        ids = self.parse_ids(args)
+        items = await self.store.get_items(ids)
+        previews = await asyncio.gather(*[
+            self.cached_preview(items[id], lang) if id in items else self.no_html()
+            for id in ids])
+        return {'previews': [{'id':id, 'html':html} for id, html in zip(ids, previews)]}
+
+    async def cached_preview(self, item, lang):
+        # the revision of the item is part of the key,
+        # so that previews are rendered again when it is edited
+        return await self.preview_cache.get('preview', item['id'], lang, item.get('lastrevid'), None,
+                lambda: self.render_preview(item, lang))
+
+    async def render_preview(self, item, lang):
+        id = item['id']
+        item_value = ItemValue(id=id)
+        # autodesc is called while the image is looked up
+        image, desc = await asyncio.gather(
+            self.get_image_for_item(item_value, item, lang),
+            self.get_description(item, lang))
 
         args = {
             'id':id,
@@ -111,6 +167,27 @@ class SuggestEngine(object):
         }
         return await render_template('preview.html', **args)
 
+    def parse_ids(self, args):
+        """
+        The distinct entity ids of a batch, in their original order
+        """
+        ids = [id.strip() for id in (args.get('ids') or '').split('|')]
+        return list(dict.fromkeys(id for id in ids if id))
+
+    async def revisions(self, args):
+        """
+        The revisions of the entities previewed for a request (`id`, or
+        `ids` separated by '|'), from the item cache. As the rendered
+        previews and flyouts are cached by revision, this identifies them.
+        """
+        ids = self.parse_ids(args) if args.get('ids') else [args['id']]
+        items = await self.store.get_items(ids)
+        return ' '.join('{}@{}'.format(id, items.get(id, {}).get('lastrevid')) for id in ids)
+
+    async def no_html(self):
+        # for the entities which could not be fetched
+        return None
+
     def get_label(self, item, target_lang):
         """
         Gets a label from items returned from search
@@ -129,31 +206,120 @@ class SuggestEngine(object):
         if lang in descriptions and ' ' in descriptions[lang]:
             return escape(descriptions[lang])
         else:
-            return await autodescribe(self.http_session, item['id'], lang) or descriptions.get(lang) or ''
+            desc = await self.description_cache.get('autodesc', item['id'], lang, None, None,
+                    lambda: autodescribe(self.http_session, item['id'], lang))
+            return desc or descriptions.get(lang) or ''
 
     async def find_something(self, args, typ='item', prefix=''):
         lang = args.get('lang', 'en')
-        async with self.http_session.get(mediawiki_api_endpoint,
+        search = args['prefix']
+        results = await self.search_cache.get('wbsearchentities', search, lang, typ,
+                suggest_fetch_limit,
+                lambda: self._search_entities(search, typ, lang),
+                lambda shorter_results: self._refine(shorter_results, search))
+
+        result = [
+            {
+            'id': item['id'],
+            'name': self.get_label(item, lang),
+            'description': item.get('description'),
+            }
+            for item in results['search'][:suggest_result_limit]]
+        return {'result':result}
+
+    async def _search_entities(self, search, typ, lang):
+        """
+        Calls wbsearchentities, only keeping what is needed to
+        suggest the entities (and to refine the results for
+        longer prefixes).
+        """
+        resp = await request_json(self.http_session, 'get',
+                mediawiki_api_endpoint, 'wbsearchentities',
                 params={'action':'wbsearchentities',
                  'format':'json',
                  'type':typ,
-                 'search':args['prefix'],
+                 'search':search,
                  'language':lang,
                  'uselang':lang,
+                 'limit':suggest_fetch_limit,
                  },
-                raise_for_status=True) as r:
-            resp = await r.json()
+                raise_for_status=True)
 
-            search_results = resp.get('search',[])
-
-            result = [
-                {
+        search_results = []
+        for item in resp.get('search',[]):
+            terms = [item.get('label')] + item.get('aliases', []) + [item.get('match', {}).get('text')]
+            result = {
                 'id': item['id'],
-                'name': self.get_label(item, lang),
                 'description': item.get('description'),
-                }
-                for item in search_results]
-            return {'result':result}
+                'terms': [SearchCache.normalize(term) for term in terms if term],
+            }
+            if 'label' in item:
+                result['label'] = item['label']
+            search_results.append(result)
+        # otherwise, more results are available
+        complete = 'search-continue' not in resp
+        if self.entity_id_re.match(SearchCache.normalize(search)):
+            # results for entity ids are not refined (see _refine)
+            complete = False
+        if complete and search_results:
+            # wbsearchentities only returns the term matched by each entity:
+            # all their labels and aliases are needed to refine the results
+            terms = await self._fetch_terms([result['id'] for result in search_results], lang)
+            if terms is None:
+                complete = False
+            else:
+                for result in search_results:
+                    result['terms'] = sorted(set(result['terms']) | set(terms.get(result['id'], [])))
+        return {
+            'search': search_results,
+            'complete': complete,
+        }
+
+    async def _fetch_terms(self, ids, lang):
+        """
+        Fetches the normalized labels and aliases of entities, in
+        the language of a search and in English (its fallback).
+        Returns None if they cannot be fetched.
+        """
+        try:
+            resp = await request_json(self.http_session, 'get',
+                    mediawiki_api_endpoint, 'wbgetentities',
+                    params={'action':'wbgetentities',
+                     'format':'json',
+                     'ids':'|'.join(ids),
+                     'props':'labels|aliases',
+                     'languages':'|'.join(sorted({lang, 'en'})),
+                     },
+                    raise_for_status=True)
+        except (ClientError, asyncio.TimeoutError):
+            return None
+        if 'error' in resp:
+            return None
+        terms = {}
+        for entity_id, entity in resp.get('entities', {}).items():
+            values = [label['value'] for label in entity.get('labels', {}).values()]
+            values += [alias['value'] for aliases in entity.get('aliases', {}).values() for alias in aliases]
+            terms[entity_id] = [SearchCache.normalize(value) for value in values]
+        return terms
+
+    def _refine(self, results, search):
+        """
+        Derives the suggestions for a prefix from the complete list of
+        suggestions for a shorter prefix, by keeping the entities having
+        a label or alias starting with the longer prefix (all their
+        labels and aliases are stored with complete results).
+        """
+        normalized = SearchCache.normalize(search)
+        if not results['complete'] or self.entity_id_re.match(normalized):
+            # entity ids are also matched exactly, so they cannot be refined
+            return None
+        return {
+            'search': [
+                item for item in results['search']
+                if any(term.startswith(normalized) for term in item['terms'])
+            ],
+            'complete': True,
+        }
 
     async def find_type(self, args):
         return await self.find_something(args)
@@ -172,8 +338,18 @@ class SuggestEngine(object):
         except ValueError:
             pass
 
-        # search for simple properties
-        search_results = (await self.find_something(args, 'property', "Property:"))['result']
+        # search for simple properties, locally if the properties are indexed
+        index = self.property_index.get(args.get('lang', 'en')) if self.property_index else None
+        if index:
+            search_results = [
+                {
+                'id': prop['id'],
+                'name': prop['label'],
+                'description': prop['description'],
+                }
+                for prop in index.search(args['prefix'], suggest_result_limit)]
+        else:
+            search_results = (await self.find_something(args, 'property', "Property:"))['result']
         return {'result':sparql_match + search_results}
 
     async def flyout_type(self, args):
@@ -191,9 +367,29 @@ class SuggestEngine(object):
         html = None
         if id:
             item = await self.store.get_item(id)
-            html = '<p style="font-size: 0.8em; color: black;">%s</p>' % (await self.get_description(item, lang))
+            html = await self.cached_flyout(item, lang)
         return {'id':id, 'html':html}
 
+    async def flyout_by_batch(self, args):
+        """
+        Renders the flyouts of several entities at once (their ids
+        are separated by '|' in `ids`), fetching all of them together.
+        """
+        lang = args.get('lang', 'en')
+        ids = self.parse_ids(args)
+        items = await self.store.get_items(ids)
+        flyouts = await asyncio.gather(*[
+            self.cached_flyout(items[id], lang) if id in items else self.no_html()
+            for id in ids])
+        return {'flyouts': [{'id':id, 'html':html} for id, html in zip(ids, flyouts)]}
+
+    async def cached_flyout(self, item, lang):
+        return await self.preview_cache.get('flyout', item['id'], lang, item.get('lastrevid'), None,
+                lambda: self.render_flyout(item, lang))
+
+    async def render_flyout(self, item, lang):
+        return '<p style="font-size: 0.8em; color: black;">%s</p>' % (await self.get_description(item, lang))
+
     async def find_entity(self, args):
         return await self.find_something(args)
 
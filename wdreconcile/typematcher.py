@@ -1,12 +1,25 @@
+import asyncio
+from collections import defaultdict
+
 from .utils import to_q
 from .sparqlwikidata import sparql_wikidata
+from .cache import LRUCache, Revalidator
+from .metrics import count_cache_lookups
 import config
 from string import Template
+try:
+    from config import subclass_cache_stale_ttl
+except ImportError:
+    subclass_cache_stale_ttl = 7*24*60*60
 
 class TypeMatcher(object):
     """
     Interface that caches the subclasses of parent classes.
     Cached using Redis sets, with expiration.
+
+    The sets are kept for stale_ttl seconds after they expire,
+    during which they are still used while they are refreshed
+    in the background.
     """
 
     def __init__(self, redis_client, http_session):
@@ -14,7 +27,10 @@ class TypeMatcher(object):
         self.http_session = http_session
         self.prefix = config.redis_key_prefix+':children'
         self.ttl = 24*60*60 # 1 day
-        self.local_cache = {}
+        self.stale_ttl = subclass_cache_stale_ttl
+        self.local_cache = LRUCache(max_entries=100000, ttl=self.ttl, name='subclasses',
+            stale_ttl=self.stale_ttl)
+        self.revalidator = Revalidator()
 
     async def is_subclass(self, qid_1, qid_2):
         """
@@ -29,28 +45,96 @@ class TypeMatcher(object):
         relation.
         """
         cache_key = qid_1+'_'+qid_2
-        cache_hit = self.local_cache.get(cache_key)
+        cache_hit, stale = self.local_cache.lookup(cache_key)
         if cache_hit is not None:
+            if stale:
+                self.revalidator.schedule([(qid_1, qid_2)], self._revalidate)
             return cache_hit
+        return await self._is_subclass(qid_1, qid_2)
+
+    async def _is_subclass(self, qid_1, qid_2):
         await self.prefetch_children(qid_2)
         result =  await self.r.sismember(self._key_name(qid_2), qid_1)
-        self.local_cache[cache_key] = result
+        self.local_cache.set(qid_1+'_'+qid_2, result)
         return result
 
+    async def subclass_matrix(self, qids, parents):
+        """
+        Checks which of the given items are subclasses of
+        each of the given parent classes, at once.
+
+        The children of each parent class are prefetched once,
+        and the pairs which are not in memory are all checked with
+        a single call to Redis.
+
+        :returns: a dict mapping each (qid, parent) pair to a boolean
+        """
+        matrix = {}
+        missing = defaultdict(list) # parent -> qids
+        stale_pairs = []
+        for parent in parents:
+            for qid in qids:
+                cache_hit, stale = self.local_cache.lookup(qid+'_'+parent)
+                if cache_hit is None:
+                    missing[parent].append(qid)
+                else:
+                    matrix[qid, parent] = cache_hit
+                    if stale:
+                        stale_pairs.append((qid, parent))
+        if stale_pairs:
+            self.revalidator.schedule(stale_pairs, self._revalidate)
+        if not missing:
+            return matrix
+
+        await asyncio.gather(*[self.prefetch_children(parent) for parent in missing])
+        pairs = [(qid, parent) for parent, parent_qids in missing.items() for qid in parent_qids]
+        pipe = self.r.pipeline(transaction=False)
+        for qid, parent in pairs:
+            pipe.sismember(self._key_name(parent), qid)
+        for (qid, parent), result in zip(pairs, await pipe.execute()):
+            matrix[qid, parent] = bool(result)
+            self.local_cache.set(qid+'_'+parent, bool(result))
+        return matrix
+
+    async def _revalidate(self, pairs):
+        for qid_1, qid_2 in pairs:
+            await self._is_subclass(qid_1, qid_2)
+
     async def prefetch_children(self, qid, force=False):
         """
-        Prefetches (in Redis) all the children of a given class
+        Prefetches (in Redis) all the children of a given class.
+        If they are already there but stale, they are refreshed
+        in the background.
         """
         key_name = self._key_name(qid)
 
-        if await self.r.exists(key_name):
-            return # children are already prefetched
+        if not force:
+            ttl = await self.r.pttl(key_name)
+            if ttl != -2:
+                count_cache_lookups('subclasses', 'redis', 1, 0)
+                if 0 <= ttl <= self.stale_ttl * 1000:
+                    self.revalidator.schedule([qid], self._refresh_children)
+                return # children are already prefetched
+            count_cache_lookups('subclasses', 'redis', 0, 1)
+
+        await self._store_children(qid)
 
-        for child_qid in await self._fetch_children(qid):
-            await self.r.sadd(key_name, child_qid)
+    async def _refresh_children(self, qids):
+        for qid in qids:
+            await self._store_children(qid)
 
+    async def _store_children(self, qid):
+        key_name = self._key_name(qid)
+        children = await self._fetch_children(qid)
+        if not children:
+            return
+        pipe = self.r.pipeline(transaction=True)
+        # replace the previous children, if any
+        pipe.delete(key_name)
+        pipe.sadd(key_name, *children)
         # set expiration
-        await self.r.expire(key_name, self.ttl)
+        pipe.expire(key_name, self.ttl + self.stale_ttl)
+        await pipe.execute()
 
     async def _fetch_children(self, qid):
         sparql_query = Template(config.sparql_query_to_fetch_subclasses).substitute(qid=qid)
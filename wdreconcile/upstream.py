@@ -0,0 +1,425 @@
+"""
+Calls to the upstream services (MediaWiki API, SPARQL endpoint, autodesc).
+
+The calls to each endpoint (identified by its host) go through an
+AdaptiveLimiter, which bounds their rate and concurrency. The concurrency
+limit adapts to the load of the endpoint: it grows slowly as calls succeed
+and is halved when the endpoint asks us to slow down (HTTP 429, or a
+maxlag error from the MediaWiki API), in which case no call is made to the
+endpoint until the delay given by its Retry-After header has passed.
+Throttled calls are then retried, so that an overloaded endpoint results
+in a slowdown rather than in failures. Transient failures (server errors,
+connection errors and timeouts) are also retried a few times, after a
+random delay growing exponentially with the number of failures.
+
+Each endpoint also has a CircuitBreaker: when most of the recent calls
+to an endpoint failed, calls to it fail immediately (with UpstreamUnavailable)
+for a while, so that the caches can serve their stale entries instead of
+waiting for the endpoint.
+
+Waiting calls are granted slots in turns, one for each request of the
+service (see request_owner), so that a large batch does not starve
+the requests made concurrently.
+"""
+
+import asyncio
+import contextvars
+import random
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from .metrics import registry, upstream_call
+from config import mediawiki_api_endpoint
+try:
+    from config import upstream_max_concurrency, upstream_rate_limit, upstream_maxlag
+except ImportError:
+    upstream_max_concurrency = 10
+    upstream_rate_limit = None
+    upstream_maxlag = 5
+try:
+    from config import upstream_endpoint_limits
+except ImportError:
+    upstream_endpoint_limits = {}
+try:
+    from config import upstream_timeout, upstream_retries, upstream_retry_delay
+except ImportError:
+    upstream_timeout = 30
+    upstream_retries = 2
+    upstream_retry_delay = 0.1
+try:
+    from config import upstream_circuit_window, upstream_circuit_failure_ratio, upstream_circuit_cooldown
+except ImportError:
+    upstream_circuit_window = 20
+    upstream_circuit_failure_ratio = 0.5
+    upstream_circuit_cooldown = 30
+
+# Failures after which a call is retried
+retried_statuses = {500, 502, 503, 504}
+retried_errors = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+concurrency_limit = registry.gauge(
+    'wdreconcile_upstream_concurrency_limit',
+    'Current limit on the number of concurrent calls to each upstream endpoint',
+    ['endpoint'])
+throttled_calls = registry.counter(
+    'wdreconcile_upstream_throttled_total',
+    'Number of calls to each upstream endpoint which were asked to slow down',
+    ['endpoint'])
+circuit_open = registry.gauge(
+    'wdreconcile_upstream_circuit_open',
+    'Whether calls to each upstream endpoint are suspended after too many failures',
+    ['endpoint'])
+
+# The request of the service on behalf of which upstream calls are made
+current_owner = contextvars.ContextVar('upstream_owner', default=None)
+
+@contextmanager
+def request_owner():
+    """
+    Marks the upstream calls made in this context (including
+    in the tasks it creates) as belonging to the same request,
+    for fair sharing of the capacity of the endpoints.
+    """
+    token = current_owner.set(object())
+    try:
+        yield
+    finally:
+        current_owner.reset(token)
+
+class AdaptiveLimiter(object):
+    """
+    Limits the calls to an endpoint, with:
+    - a token bucket, bounding the rate of calls;
+    - a concurrency limit, adapted with an additive increase
+      (when calls succeed) and a multiplicative decrease
+      (when the endpoint throttles us);
+    - a pause, when the endpoint asks us to retry later.
+    """
+    def __init__(self, name, max_concurrency=10, min_concurrency=1, rate=None):
+        """
+        :param max_concurrency: the maximum number of concurrent calls
+        :param min_concurrency: the lowest value of the adaptive limit
+        :param rate: the maximum number of calls per second (None for no limit)
+        """
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(max_concurrency)
+        self.rate = rate
+        self.tokens = float(rate or 0)
+        self.tokens_updated = time.monotonic()
+        self.paused_until = 0
+        self.active = 0
+        self.waiters = OrderedDict() # owner -> deque of futures
+        self.wakeup = None
+        self.loop = asyncio.get_event_loop()
+        concurrency_limit.set(self.limit, endpoint=name)
+
+    async def acquire(self):
+        """
+        Waits for a slot to make a call. Each slot must be
+        released with `release` once the call is done.
+        """
+        owner = current_owner.get()
+        future = self.loop.create_future()
+        self.waiters.setdefault(owner, deque()).append(future)
+        self._grant()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was granted just before we got cancelled
+                self.release()
+            else:
+                self._discard(owner, future)
+            raise
+
+    def release(self, succeeded=False, throttled=False, retry_after=None):
+        """
+        Releases a slot, adapting the concurrency limit
+        depending on the outcome of the call.
+
+        :param succeeded: whether the call succeeded
+        :param throttled: whether the endpoint asked us to slow down
+        :param retry_after: the delay (in seconds) before the next call
+        """
+        self.active -= 1
+        if throttled:
+            throttled_calls.inc(endpoint=self.name)
+            self.limit = max(self.min_concurrency, self.limit / 2)
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        elif succeeded:
+            self.limit = min(self.max_concurrency, self.limit + 1. / self.limit)
+        concurrency_limit.set(self.limit, endpoint=self.name)
+        self._grant()
+
+    def _grant(self):
+        """
+        Grants slots to the waiting calls, taking turns between their owners
+        """
+        while self.waiters and self.active < int(self.limit):
+            delay = self._delay()
+            if delay > 0:
+                self._schedule(delay)
+                return
+            owner, queue = next(iter(self.waiters.items()))
+            future = queue.popleft()
+            if queue:
+                self.waiters.move_to_end(owner)
+            else:
+                del self.waiters[owner]
+            if future.done():
+                continue
+            if self.rate:
+                self.tokens -= 1
+            self.active += 1
+            future.set_result(None)
+
+    def _delay(self):
+        """
+        The time to wait before the next call can be made
+        """
+        now = time.monotonic()
+        if self.paused_until > now:
+            return self.paused_until - now
+        if self.rate:
+            self.tokens = min(self.rate, self.tokens + (now - self.tokens_updated) * self.rate)
+            self.tokens_updated = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+        return 0
+
+    def _schedule(self, delay):
+        if self.wakeup is None:
+            def wakeup():
+                self.wakeup = None
+                self._grant()
+            self.wakeup = self.loop.call_later(delay, wakeup)
+
+    def _discard(self, owner, future):
+        queue = self.waiters.get(owner)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            if not queue:
+                del self.waiters[owner]
+
+class UpstreamUnavailable(aiohttp.ClientError):
+    """
+    Raised instead of calling an endpoint whose circuit breaker is open
+    """
+
+class CircuitBreaker(object):
+    """
+    Keeps track of the outcome of the last calls to an endpoint.
+    When too many of them failed, the circuit is open: no call is
+    made to the endpoint for `cooldown` seconds. After that, a single
+    call is let through (every `cooldown` seconds), which closes the
+    circuit if it succeeds.
+    """
+    def __init__(self, name, window=20, failure_ratio=0.5, cooldown=30):
+        """
+        :param window: the number of recent calls considered
+        :param failure_ratio: the proportion of failed calls
+            among them above which the circuit opens
+        :param cooldown: the time (in seconds) during which
+            no call is made once the circuit is open
+        """
+        self.name = name
+        self.outcomes = deque(maxlen=window)
+        self.failure_ratio = failure_ratio
+        self.cooldown = cooldown
+        self.opened_at = None
+        self.probed_at = None
+        circuit_open.set(0, endpoint=name)
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """
+        Whether a call can be made to the endpoint
+        """
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now < max(self.opened_at, self.probed_at or 0) + self.cooldown:
+            return False
+        self.probed_at = now
+        return True
+
+    def record(self, succeeded):
+        """
+        Records the outcome of a call
+        """
+        if self.opened_at is not None:
+            if self.probed_at is not None:
+                # outcome of the call let through
+                self.probed_at = None
+                if succeeded:
+                    self.opened_at = None
+                    self.outcomes.clear()
+                    circuit_open.set(0, endpoint=self.name)
+                else:
+                    self.opened_at = time.monotonic()
+            return
+        self.outcomes.append(succeeded)
+        if (len(self.outcomes) == self.outcomes.maxlen and
+                self.outcomes.count(False) >= self.failure_ratio * len(self.outcomes)):
+            self.opened_at = time.monotonic()
+            circuit_open.set(1, endpoint=self.name)
+
+limiters = {}
+breakers = {}
+
+def limiter_for(url):
+    """
+    The limiter of the endpoint of a URL (shared by all the calls
+    to the same host made by this process, in the same event loop)
+    """
+    host = urlsplit(url).netloc
+    limiter = limiters.get(host)
+    if limiter is None or limiter.loop is not asyncio.get_event_loop():
+        settings = {'max_concurrency': upstream_max_concurrency, 'rate': upstream_rate_limit}
+        settings.update(upstream_endpoint_limits.get(host, {}))
+        limiter = AdaptiveLimiter(host, **settings)
+        limiters[host] = limiter
+        breakers[host] = CircuitBreaker(host,
+                window=upstream_circuit_window,
+                failure_ratio=upstream_circuit_failure_ratio,
+                cooldown=upstream_circuit_cooldown)
+    return limiter
+
+def breaker_for(url):
+    """
+    The circuit breaker of the endpoint of a URL
+    (renewed with its limiter)
+    """
+    limiter_for(url)
+    return breakers[urlsplit(url).netloc]
+
+def _retry_after(response, default=1):
+    try:
+        return max(0, float(response.headers.get('Retry-After')))
+    except (TypeError, ValueError):
+        return default
+
+def _throttled_error(response):
+    return aiohttp.ClientResponseError(response.request_info, response.history,
+            status=response.status, message='Throttled by the upstream endpoint',
+            headers=response.headers)
+
+class _Retry(Exception):
+    """
+    Raised when an attempt to call an endpoint must be retried
+    """
+    def __init__(self, retry_after=None, throttled=False):
+        self.retry_after = retry_after
+        self.throttled = throttled
+
+async def request_json(http_session, method, url, action, params=None, raise_for_status=False,
+                       max_attempts=5, retries=None, timeout=None, **kwargs):
+    """
+    Calls an upstream endpoint and returns its JSON response.
+
+    :param method: 'get' or 'post'
+    :param action: the name of the API action, for the metrics
+    :param raise_for_status: raise aiohttp.ClientResponseError for HTTP errors
+    :param max_attempts: the maximum number of attempts when we are throttled
+    :param retries: the number of retries after transient failures
+        (upstream_retries by default)
+    :param timeout: the deadline of each attempt, in seconds
+        (upstream_timeout by default)
+    :param kwargs: other arguments passed to aiohttp
+    """
+    limiter = limiter_for(url)
+    breaker = breaker_for(url)
+    params = dict(params or {})
+    if upstream_maxlag is not None and url == mediawiki_api_endpoint:
+        params['maxlag'] = upstream_maxlag
+    if retries is None:
+        retries = upstream_retries
+    timeout = aiohttp.ClientTimeout(total=timeout or upstream_timeout)
+    throttled = 0
+    failures = 0
+    while True:
+        if not breaker.allow():
+            raise UpstreamUnavailable('Too many recent failures of {}'.format(breaker.name))
+        await limiter.acquire()
+        retry = None
+        succeeded = False
+        try:
+            with upstream_call(action):
+                try:
+                    async with getattr(http_session, method)(url, params=params, timeout=timeout, **kwargs) as r:
+                        if r.status == 429 or (r.status == 503 and 'Retry-After' in r.headers):
+                            # the endpoint is up, but overloaded
+                            breaker.record(True)
+                            throttled += 1
+                            if throttled >= max_attempts:
+                                raise _throttled_error(r)
+                            raise _Retry(_retry_after(r), throttled=True)
+                        breaker.record(r.status not in retried_statuses)
+                        if r.status in retried_statuses and failures < retries:
+                            raise _Retry()
+                        if raise_for_status:
+                            r.raise_for_status()
+                        resp = await r.json()
+                        if isinstance(resp, dict) and (resp.get('error') or {}).get('code') == 'maxlag':
+                            throttled += 1
+                            if throttled >= max_attempts:
+                                raise _throttled_error(r)
+                            raise _Retry(_retry_after(r, default=5), throttled=True)
+                        succeeded = True
+                        return resp
+                except retried_errors:
+                    breaker.record(False)
+                    if failures >= retries:
+                        raise
+                    raise _Retry()
+        except _Retry as e:
+            retry = e
+        finally:
+            limiter.release(succeeded=succeeded,
+                    throttled=retry is not None and retry.throttled,
+                    retry_after=retry and retry.retry_after)
+        if retry.throttled:
+            # the limiter is paused until the retry delay has passed,
+            # with some jitter so that throttled calls do not all retry at once
+            await asyncio.sleep(random.uniform(0, 0.1) * throttled)
+        else:
+            failures += 1
+            await asyncio.sleep(random.uniform(0, upstream_retry_delay * 2 ** failures))
+
+async def hedged(call, delay):
+    """
+    Awaits `call()` and, if it has not completed after `delay` seconds,
+    makes the same call again in parallel: the first successful result
+    is returned, and the other call is cancelled.
+
+    :param call: a function returning a new coroutine at each call
+    :param delay: the delay before the second call (None to never make it)
+    """
+    if delay is None:
+        return await call()
+    tasks = [asyncio.ensure_future(call())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            tasks.append(asyncio.ensure_future(call()))
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()